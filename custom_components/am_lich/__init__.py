@@ -1,23 +1,61 @@
 import os
 import voluptuous as vol
-from homeassistant.core import HomeAssistant
+from homeassistant.core import HomeAssistant, SupportsResponse
+from homeassistant.exceptions import HomeAssistantError
 from homeassistant.const import CONF_PATH
 from homeassistant.helpers import config_validation as cv
 from homeassistant.helpers.entity_registry import async_get as async_get_entity_registry
 from homeassistant.helpers.event import async_track_time_change  # noqa
+from homeassistant.helpers.event import async_track_time_interval
 from homeassistant.core import callback  # noqa
 import logging
 import traceback
 import asyncio
+from datetime import timedelta
 from .const import AMLICH_ICS_PATH
 
 _LOGGER = logging.getLogger(__name__)
 
 DOMAIN = "amlich"
 
+# Chu kỳ kiểm tra mtime của file ICS để tự động cập nhật
+ICS_POLL_INTERVAL = timedelta(seconds=30)
+
+# Giới hạn số ngày cho một lần gọi service convert_range
+MAX_CONVERT_RANGE_DAYS = 366 * 50
+
+CONVERT_RANGE_SCHEMA = vol.Schema({
+    vol.Required('start'): cv.date,
+    vol.Required('end'): cv.date,
+})
+
+# Số câu hỏi tối đa trong một lần gọi service query_batch
+MAX_BATCH_QUERIES = 50
+
+QUERY_SCHEMA = vol.Schema({
+    vol.Required('query'): cv.string,
+    vol.Optional('use_humor'): cv.boolean,
+})
+
+QUERY_BATCH_SCHEMA = vol.Schema({
+    vol.Required('queries'): vol.All(
+        cv.ensure_list, [cv.string], vol.Length(min=1, max=MAX_BATCH_QUERIES)
+    ),
+    vol.Optional('use_humor'): cv.boolean,
+})
+
 CONFIG_SCHEMA = vol.Schema({
     vol.Required(DOMAIN): vol.Schema({
         vol.Optional('api_key', default=""): cv.string,
+        vol.Optional('query_debounce', default=0.4): vol.All(
+            vol.Coerce(float), vol.Range(min=0, max=5)
+        ),
+        vol.Optional('query_budget', default=8): vol.All(
+            vol.Coerce(float), vol.Range(min=1, max=60)
+        ),
+        vol.Optional('occurrence_horizon', default=3): vol.All(
+            vol.Coerce(int), vol.Range(min=1, max=10)
+        ),
     })
 }, extra=vol.ALLOW_EXTRA)
 
@@ -67,11 +105,18 @@ async def async_setup(hass: HomeAssistant, config: dict) -> bool:
         # Lưu cấu hình
         hass.data.setdefault(DOMAIN, {})
         hass.data[DOMAIN] = {'ics_path': ics_path, 'api_key': api_key}
+        if DOMAIN in config:
+            hass.data[DOMAIN]['query_debounce'] = config[DOMAIN]['query_debounce']
+            hass.data[DOMAIN]['occurrence_horizon'] = config[DOMAIN]['occurrence_horizon']
         _LOGGER.debug("Đã lưu cấu hình vào hass.data")
 
         # Kiểm tra import amlich_core
         try:
-            from .amlich_core import load_ics_file, set_api_key
+            from .amlich_core import (
+                load_ics_file, set_api_key, convert_range,
+                ics_changed, reload_ics_incremental, open_response_cache,
+                query_date, set_query_budget,
+            )
         except ImportError as e:
             _LOGGER.error(f"Lỗi import amlich_core: {str(e)}")
             return False
@@ -80,10 +125,15 @@ async def async_setup(hass: HomeAssistant, config: dict) -> bool:
         try:
             await hass.async_add_executor_job(set_api_key, api_key)
             _LOGGER.debug("Đã đặt API key")
+            if DOMAIN in config:
+                set_query_budget(config[DOMAIN]['query_budget'])
         except Exception as e:
             _LOGGER.error(f"Lỗi khi đặt API key: {str(e)}")
             return False
 
+        # Mở bộ đệm phản hồi Gemini; không mở được thì vẫn chạy, chỉ mất bộ đệm
+        await hass.async_add_executor_job(open_response_cache)
+
         # Tải file ICS
         try:
             if not await hass.async_add_executor_job(load_ics_file, ics_path):
@@ -94,13 +144,35 @@ async def async_setup(hass: HomeAssistant, config: dict) -> bool:
             _LOGGER.error(f"Lỗi khi tải file ICS: {str(e)}")
             return False
 
+        # Theo dõi file ICS: kiểm tra size/mtime định kỳ, có thay đổi thì chỉ
+        # cập nhật các VEVENT khác biệt
+        ics_update_lock = asyncio.Lock()
+
+        async def check_ics_changed(now):
+            if ics_update_lock.locked():
+                return
+            async with ics_update_lock:
+                if not await hass.async_add_executor_job(ics_changed, ics_path):
+                    return
+                _LOGGER.info(f"Phát hiện file ICS thay đổi: {ics_path}")
+                if not await hass.async_add_executor_job(
+                    reload_ics_incremental, ics_path
+                ):
+                    _LOGGER.error("Không thể cập nhật dữ liệu ICS đã thay đổi")
+
+        async_track_time_interval(hass, check_ics_changed, ICS_POLL_INTERVAL)
+        _LOGGER.debug("Đã bật theo dõi thay đổi file ICS")
+
         # KHÔNG forward entry ở đây! Để Home Assistant tự gọi async_setup_entry.
 
         # Đăng ký service reload_ics
         async def reload_ics_service(call):
             _LOGGER.debug("Gọi service reload_ics")
             try:
-                if not await hass.async_add_executor_job(load_ics_file, ics_path):
+                # Không chạy song song với lần nạp lại do theo dõi file ICS
+                async with ics_update_lock:
+                    loaded = await hass.async_add_executor_job(load_ics_file, ics_path)
+                if not loaded:
                     _LOGGER.error("Không thể làm mới dữ liệu ICS")
                     return
                 _LOGGER.debug("Đã làm mới dữ liệu ICS")
@@ -121,6 +193,68 @@ async def async_setup(hass: HomeAssistant, config: dict) -> bool:
         hass.services.async_register(DOMAIN, "reload_ics", reload_ics_service)
         _LOGGER.debug("Đã đăng ký service reload_ics")
 
+        # Đăng ký service convert_range: đổi cả khoảng ngày sang âm lịch, trả về response
+        async def convert_range_service(call):
+            start = call.data['start']
+            end = call.data['end']
+            if end < start:
+                raise HomeAssistantError(f"Ngày kết thúc {end} trước ngày bắt đầu {start}")
+            if (end - start).days >= MAX_CONVERT_RANGE_DAYS:
+                raise HomeAssistantError(
+                    f"Khoảng ngày quá dài (tối đa {MAX_CONVERT_RANGE_DAYS} ngày)"
+                )
+            try:
+                columns = await hass.async_add_executor_job(convert_range, start, end)
+            except ValueError as e:
+                raise HomeAssistantError(str(e)) from e
+            return {
+                'start': start.isoformat(),
+                'end': end.isoformat(),
+                'day': [int(v) for v in columns['day']],
+                'month': [int(v) for v in columns['month']],
+                'year': [int(v) for v in columns['year']],
+                'leap': [bool(v) for v in columns['leap']],
+            }
+
+        hass.services.async_register(
+            DOMAIN, "convert_range", convert_range_service,
+            schema=CONVERT_RANGE_SCHEMA,
+            supports_response=SupportsResponse.ONLY,
+        )
+        _LOGGER.debug("Đã đăng ký service convert_range")
+
+        # Đăng ký service query / query_batch: tra cứu trả kết quả trực tiếp,
+        # không cần ghi vào input_text.tracuu rồi chờ sensor cập nhật
+        async def query_service(call):
+            return await query_date(
+                hass, call.data['query'], use_humor=call.data.get('use_humor')
+            )
+
+        async def query_batch_service(call):
+            queries = call.data['queries']
+            use_humor = call.data.get('use_humor')
+            results = await asyncio.gather(*(
+                query_date(hass, query, use_humor=use_humor) for query in queries
+            ))
+            return {
+                'results': [
+                    dict(result, query=query)
+                    for query, result in zip(queries, results)
+                ]
+            }
+
+        hass.services.async_register(
+            DOMAIN, "query", query_service,
+            schema=QUERY_SCHEMA,
+            supports_response=SupportsResponse.ONLY,
+        )
+        hass.services.async_register(
+            DOMAIN, "query_batch", query_batch_service,
+            schema=QUERY_BATCH_SCHEMA,
+            supports_response=SupportsResponse.ONLY,
+        )
+        _LOGGER.debug("Đã đăng ký service query và query_batch")
+
         # Tự động tạo helper input_text.tracuu nếu chưa có
         input_text_entity_id = "input_text.tracuu"
         if input_text_entity_id not in hass.states.async_entity_ids():
@@ -162,6 +296,9 @@ async def async_setup(hass: HomeAssistant, config: dict) -> bool:
 
 
 async def async_setup_entry(hass, entry):
+    from .amlich_core import invalidate_query_cache, pin_current_years
+    from .event_repository import async_get_repository
+
     hass.data.setdefault(DOMAIN, {})[entry.entry_id] = {}
     await hass.config_entries.async_forward_entry_setups(
         entry, ["sensor", "calendar", "switch"]
@@ -171,13 +308,23 @@ async def async_setup_entry(hass, entry):
     @callback
     async def midnight_update(now):
         _LOGGER.info("AmLichVN: Đang cập nhật dữ liệu lúc 0h")
+        # Câu hỏi tương đối như 'hôm nay' có đáp án mới sau nửa đêm
+        invalidate_query_cache()
+        # Sang năm mới thì các năm ghim trong bảng âm lịch cũng dời theo
+        await hass.async_add_executor_job(pin_current_years)
+        # Nới chỉ mục lần xuất hiện của sự kiện thêm một ngày
+        repository = await async_get_repository(hass)
+        repository.extend_occurrences(now.date())
 
-    async_track_time_change(
-        hass,
-        midnight_update,
-        hour=0,
-        minute=0,
-        second=10,
+    # Hủy hẹn giờ khi entry bị gỡ/nạp lại để không chạy trùng nhiều lần mỗi đêm
+    entry.async_on_unload(
+        async_track_time_change(
+            hass,
+            midnight_update,
+            hour=0,
+            minute=0,
+            second=10,
+        )
     )
 
     # Đăng ký service để reload entry (có thể gọi từ code khác)
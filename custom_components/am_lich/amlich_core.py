@@ -1,33 +1,513 @@
 import re
 import json
-import requests
+import asyncio
+import aiohttp
 from datetime import datetime, timedelta
 from dateutil.parser import parse
 from icalendar import Calendar
 import logging
+import copy
+import io
 import os
+import pickle
+import tempfile
+import time
+import hashlib
+import itertools
+from array import array
+from bisect import bisect_right
+from collections import Counter, OrderedDict, namedtuple
 from homeassistant.core import HomeAssistant
-from .const import AMLICH_ICS_PATH
+from homeassistant.helpers.aiohttp_client import async_get_clientsession
+from .const import AMLICH_ICS_PATH, RESPONSE_CACHE_PATH
+from .lunar_tables import LunarDayTable, EventIndex, LunarData, SegmentNotLoaded
+from . import amlich_engine
+from .response_cache import ResponseCache
+from .circuit_breaker import CircuitBreaker, CLOSED
+from .spelling import FuzzyCorrector
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 _LOGGER = logging.getLogger(__name__)
 
 GEMINI_API_KEY = None
 GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent"
 
+# Giới hạn thời gian cho mỗi lời gọi Gemini (kết nối, đọc, tổng)
+GEMINI_TIMEOUT = aiohttp.ClientTimeout(total=20, connect=5, sock_read=15)
+# Lời gọi bị hủy sau chừng này giây vẫn được cầu dao tính là Gemini chậm
+GEMINI_SLOW_SECONDS = 5
+
+# Thời gian tối đa (giây) cho một lần query_date; quá hạn thì trả lời bằng
+# phân tích cục bộ, không viết lại hài hước. Đổi bằng tùy chọn query_budget.
+QUERY_BUDGET_SECONDS = 8.0
+
 def set_api_key(api_key):
     global GEMINI_API_KEY
     GEMINI_API_KEY = api_key
     _LOGGER.debug(f"Đã đặt Gemini API key: {'***' if api_key else 'None'}")
 
-_lunar_dates = {}
-_solar_dates = {}
-_events = {}
+def set_query_budget(seconds):
+    global QUERY_BUDGET_SECONDS
+    QUERY_BUDGET_SECONDS = float(seconds)
+    _LOGGER.debug(f"Đã đặt thời gian tối đa cho truy vấn: {QUERY_BUDGET_SECONDS}s")
+
+class GeminiUnavailable(Exception):
+    """Cầu dao đang mở, không gọi Gemini."""
+
+# Cầu dao dùng chung cho mọi lời gọi Gemini và số truy vấn đã quá hạn
+_gemini_breaker = CircuitBreaker()
+_budget_exceeded = 0
+
+# Bộ đệm phản hồi Gemini trên đĩa; None thì mọi lời gọi đều tới API
+_response_cache = None
+
+def open_response_cache(path=RESPONSE_CACHE_PATH):
+    """Mở bộ đệm phản hồi Gemini (chạy trong executor). Lỗi thì chạy không có bộ đệm."""
+    global _response_cache
+    try:
+        _response_cache = ResponseCache(path)
+        _LOGGER.debug(f"Đã mở bộ đệm phản hồi Gemini: {path}")
+    except Exception as e:
+        _response_cache = None
+        _LOGGER.warning(f"Không mở được bộ đệm phản hồi Gemini {path}: {str(e)}")
+    return _response_cache is not None
+
+def response_cache_stats():
+    """Số lần trúng/trượt bộ đệm Gemini, hoặc None nếu chưa mở bộ đệm."""
+    return _response_cache.stats() if _response_cache is not None else None
+
+def gemini_status():
+    """Trạng thái cầu dao Gemini, thời gian tối đa và bộ đệm, cho sensor chẩn đoán."""
+    status = _gemini_breaker.as_dict()
+    status['query_budget'] = QUERY_BUDGET_SECONDS
+    status['budget_exceeded'] = _budget_exceeded
+    status['cache'] = response_cache_stats()
+    return status
+
+def _cache_get(kind, *parts):
+    if _response_cache is None:
+        return None
+    try:
+        return _response_cache.get(kind, *parts)
+    except Exception as e:
+        _LOGGER.warning(f"Lỗi đọc bộ đệm Gemini ({kind}): {str(e)}")
+        return None
+
+def _cache_put(kind, value, *parts):
+    if _response_cache is None:
+        return
+    try:
+        _response_cache.put(kind, value, *parts)
+    except Exception as e:
+        _LOGGER.warning(f"Lỗi ghi bộ đệm Gemini ({kind}): {str(e)}")
+
+async def _post_gemini(hass: HomeAssistant, payload):
+    """Gửi yêu cầu tới Gemini qua session aiohttp dùng chung của Home Assistant.
+
+    Trả về (status, body): body là JSON đã giải mã khi status 200, ngược lại là
+    chuỗi phản hồi. Lỗi mạng và hết thời gian được ném ra cho nơi gọi xử lý;
+    task bị hủy thì yêu cầu HTTP cũng bị hủy theo. Cầu dao đang mở thì ném
+    GeminiUnavailable mà không gửi gì.
+    """
+    if not _gemini_breaker.allow():
+        raise GeminiUnavailable(f"Tạm ngưng gọi Gemini sau lỗi: {_gemini_breaker.last_error}")
+    session = async_get_clientsession(hass)
+    headers = {
+        "Content-Type": "application/json",
+        "x-goog-api-key": GEMINI_API_KEY
+    }
+    started = time.monotonic()
+    try:
+        async with session.post(GEMINI_API_URL, headers=headers, json=payload, timeout=GEMINI_TIMEOUT) as response:
+            if response.status == 200:
+                body = await response.json(content_type=None)
+                _gemini_breaker.record_success()
+                return response.status, body
+            text = await response.text()
+            retry_after = None
+            if response.status == 429:
+                retry_after = _retry_after_seconds(response.headers.get('Retry-After'))
+            _gemini_breaker.record_failure(f"HTTP {response.status}", retry_after)
+            if _gemini_breaker.state != CLOSED:
+                _LOGGER.warning(f"Tạm ngưng gọi Gemini sau lỗi HTTP {response.status}")
+            return response.status, text
+    except asyncio.CancelledError:
+        if time.monotonic() - started >= GEMINI_SLOW_SECONDS:
+            _gemini_breaker.record_failure("Phản hồi quá chậm")
+        else:
+            _gemini_breaker.release()
+        raise
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        _gemini_breaker.record_failure(str(e) or type(e).__name__)
+        raise
+
+def _retry_after_seconds(value):
+    """Số giây trong header Retry-After; 0 (dùng khoảng nghỉ mặc định) nếu không đọc được."""
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return 0
+
+# Bộ bảng hiện hành. Chỉ được thay bằng một phép gán khi bộ mới đã dựng xong,
+# nên truy vấn đang chạy trong lúc reload_ics luôn thấy dữ liệu đầy đủ.
+_version_counter = itertools.count(1)
+_data = LunarData(0, LunarDayTable.build({}), EventIndex.build({}, None))
+
+# Trạng thái của mỗi file ICS đã nạp: (size, mtime_ns) để phát hiện thay đổi,
+# sha256 nội dung và token của bản chụp bảng ngày
+_LoadedICS = namedtuple('_LoadedICS', ['stat', 'sha256', 'snapshot_token'])
+_loaded_ics = {}
+
+def data_version():
+    """Số phiên bản của bộ bảng, tăng sau mỗi lần nạp thành công."""
+    return _data.version
+
+def _publish(day_table, event_index):
+    global _data
+    _data = LunarData(next(_version_counter), day_table, event_index)
+    _LOGGER.debug(f"Đã áp dụng bộ bảng âm lịch phiên bản {_data.version}")
+
+# Bản chụp nhị phân của các bảng tra cứu, lưu cạnh file ICS. Bảng ngày và chỉ
+# mục sự kiện nằm ở hai file để khi ICS chỉ đổi sự kiện thì chỉ ghi lại file nhỏ
+SNAPSHOT_SUFFIX = '.cache'
+EVENTS_SNAPSHOT_SUFFIX = '.events.cache'
+SNAPSHOT_VERSION = 7
+
+# Một VEVENT thô (từ BEGIN đến END) trong file ICS
+_VEVENT_BLOCK_RE = re.compile(rb'^BEGIN:VEVENT\r?$.*?^END:VEVENT\r?$', re.M | re.S | re.I)
+
+def _read_ics(file_path):
+    """Đọc file ICS một lần, trả về ((size, mtime_ns, sha256), nội dung)."""
+    with open(file_path, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        data = f.read()
+    return (stat.st_size, stat.st_mtime_ns, hashlib.sha256(data).hexdigest()), data
+
+def _current_fingerprint(file_path, stored):
+    """Fingerprint hiện tại nếu nội dung file ICS vẫn như stored, ngược lại None.
+
+    Chỉ băm lại file khi size giữ nguyên nhưng mtime khác (file được ghi đè).
+    """
+    stat = os.stat(file_path)
+    if (stat.st_size, stat.st_mtime_ns) == tuple(stored[:2]):
+        return tuple(stored)
+    if stat.st_size != stored[0]:
+        return None
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    if digest.hexdigest() != stored[2]:
+        return None
+    return stat.st_size, stat.st_mtime_ns, stored[2]
+
+def _load_snapshot(file_path):
+    """Đọc bản chụp nếu còn khớp với file ICS; trả về (tables, token, fingerprint) hoặc None.
+
+    File chỉ mục sự kiện ghi kèm fingerprint của file ICS và token của bản
+    chụp bảng ngày đi cùng. Bảng ngày nạp từng năm từ file khi cần.
+    """
+    events_path = file_path + EVENTS_SNAPSHOT_SUFFIX
+    snapshot_path = file_path + SNAPSHOT_SUFFIX
+    if not os.path.isfile(events_path) or not os.path.isfile(snapshot_path):
+        return None
+    try:
+        with open(events_path, 'rb') as events_file:
+            header = pickle.load(events_file)
+            fingerprint = None
+            if header[0] == SNAPSHOT_VERSION:
+                fingerprint = _current_fingerprint(file_path, header[1])
+            if fingerprint is None:
+                _LOGGER.debug("Bản chụp ICS đã cũ, sẽ tạo lại")
+                return None
+            token = header[2]
+            event_index = pickle.load(events_file)
+        day_table = LunarDayTable.from_snapshot(snapshot_path, (SNAPSHOT_VERSION, token))
+        if day_table is None:
+            _LOGGER.debug("Bản chụp bảng ngày không khớp chỉ mục sự kiện, sẽ tạo lại")
+            return None
+        return (day_table, event_index), token, fingerprint
+    except Exception as e:
+        _LOGGER.warning(f"Không đọc được bản chụp ICS {snapshot_path}: {str(e)}")
+        return None
+
+def _load_block_index(file_path, sha256):
+    """Chỉ mục VEVENT trong bản chụp sự kiện nếu bản chụp ứng với nội dung sha256."""
+    try:
+        with open(file_path + EVENTS_SNAPSHOT_SUFFIX, 'rb') as f:
+            header = pickle.load(f)
+            if header[0] != SNAPSHOT_VERSION or header[1][2] != sha256:
+                return None
+            pickle.load(f)
+            return pickle.load(f)
+    except Exception as e:
+        _LOGGER.debug(f"Không đọc được chỉ mục VEVENT của bản chụp: {str(e)}")
+        return None
+
+def _write_atomic(path, write):
+    """Gọi write(f) trên một file tạm riêng cạnh path rồi đổi tên để tránh file ghi dở."""
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.', suffix='.tmp'
+    )
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, path)
+        _LOGGER.debug(f"Đã ghi bản chụp ICS: {path}")
+        return True
+    except Exception as e:
+        _LOGGER.warning(f"Không ghi được bản chụp ICS {path}: {str(e)}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return False
+
+def _save_snapshot(file_path, fingerprint, tables, block_index, token=None):
+    """Ghi bản chụp, trả về token của bản chụp bảng ngày hoặc None nếu lỗi.
+
+    token khác None nghĩa là bảng ngày không đổi so với bản chụp đó, chỉ ghi
+    lại chỉ mục sự kiện. block_index được ghi sau chỉ mục sự kiện nên lúc
+    khởi động không phải đọc tới.
+    """
+    if token is None:
+        token = fingerprint
+
+        def write_days(f):
+            pickle.dump((SNAPSHOT_VERSION, token), f, protocol=pickle.HIGHEST_PROTOCOL)
+            tables[0].dump(f)
+        if not _write_atomic(file_path + SNAPSHOT_SUFFIX, write_days):
+            return None
+
+    def write_events(f):
+        pickle.dump((SNAPSHOT_VERSION, fingerprint, token), f, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump(tables[1], f, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump(block_index, f, protocol=pickle.HIGHEST_PROTOCOL)
+    if not _write_atomic(file_path + EVENTS_SNAPSHOT_SUFFIX, write_events):
+        return None
+    return token
+
+def _pin_current_years(day_table):
+    """Ghim năm hiện tại và hai năm liền kề, các năm khác chỉ nạp khi được hỏi."""
+    year = datetime.now().year
+    day_table.pin(range(year - 1, year + 2))
+
+def pin_current_years():
+    """Ghim lại các năm quanh năm hiện tại (gọi từ executor lúc sang ngày mới)."""
+    _pin_current_years(_data.day_table)
+
+# Số lần nạp năm thiếu qua executor cho một lời gọi trước khi chạy hẳn trong executor
+MAX_SEGMENT_LOADS = 4
+
+async def _run_on_loop(hass: HomeAssistant, day_table, func, *args):
+    """Chạy func(*args) trên vòng lặp sự kiện; năm chưa nạp thì đọc qua executor rồi chạy lại."""
+    for _ in range(MAX_SEGMENT_LOADS):
+        try:
+            return func(*args)
+        except SegmentNotLoaded as e:
+            _LOGGER.debug(f"Nạp năm {e.year} của bảng âm lịch qua executor")
+            await hass.async_add_executor_job(day_table.preload, [e.year])
+    return await hass.async_add_executor_job(func, *args)
+
+def _store_and_publish(file_path, fingerprint, tables, block_index, token=None):
+    """Ghi bản chụp rồi áp dụng bộ bảng; bảng ngày mới ghi được mở lại ở chế độ nạp lười.
+
+    token là token bản chụp của bảng ngày khi chỉ chỉ mục sự kiện thay đổi.
+    """
+    saved_token = _save_snapshot(file_path, fingerprint, tables, block_index, token)
+    if saved_token is not None and token is None:
+        snapshot = _load_snapshot(file_path)
+        if snapshot is not None and snapshot[2] == fingerprint:
+            tables = snapshot[0]
+    _pin_current_years(tables[0])
+    _publish(*tables)
+    _loaded_ics[file_path] = _LoadedICS(fingerprint[:2], fingerprint[2], saved_token)
+
+class _UnsupportedICS(Exception):
+    """File ICS dùng tính năng mà bộ đọc dòng không hỗ trợ, cần dùng icalendar."""
+
+_ICS_DATE_RE = re.compile(r'^(\d{4})(\d{2})(\d{2})(?:T\d{6}Z?)?$')
+_LUNAR_SUMMARY_RE = re.compile(r'^\d{1,2}/\d{1,2}(?:\s*\(N\))?$')
+
+def _unfold_ics_lines(f):
+    """Ghép các dòng bị gấp theo RFC 5545 (dòng tiếp theo bắt đầu bằng space/tab)."""
+    current = None
+    for raw in f:
+        line = raw.rstrip('\r\n')
+        if line[:1] in (' ', '\t') and current is not None:
+            current += line[1:]
+            continue
+        if current is not None:
+            yield current
+        current = line
+    if current is not None:
+        yield current
+
+def _unescape_ics_text(value):
+    return re.sub(r'\\([\\;,nN])', lambda m: '\n' if m.group(1) in 'nN' else m.group(1), value)
+
+def _split_ics_property(line):
+    """Tách 'NAME;PARAM=...:VALUE' thành (NAME, {PARAM: ...}, VALUE)."""
+    colon = -1
+    in_quotes = False
+    for i, ch in enumerate(line):
+        if ch == '"':
+            in_quotes = not in_quotes
+        elif ch == ':' and not in_quotes:
+            colon = i
+            break
+    if colon < 0:
+        raise _UnsupportedICS(f"Dòng ICS không hợp lệ: {line[:40]}")
+    head, value = line[:colon], line[colon + 1:]
+    parts = head.split(';')
+    params = {}
+    for part in parts[1:]:
+        key, _, val = part.partition('=')
+        params[key.upper()] = val.strip('"')
+    return parts[0].upper(), params, value
+
+def _parse_ics_date(params, value):
+    if params.get('VALUE', 'DATE').upper() not in ('DATE', 'DATE-TIME'):
+        raise _UnsupportedICS(f"DTSTART kiểu {params['VALUE']} không được hỗ trợ")
+    match = _ICS_DATE_RE.match(value.strip())
+    if not match:
+        raise _UnsupportedICS(f"DTSTART không hỗ trợ: {value}")
+    year, month, day = map(int, match.groups())
+    return datetime(year, month, day).date()
+
+def _iter_ics_entries_streaming(f):
+    """Đọc từng dòng, chỉ lấy DTSTART và SUMMARY của mỗi VEVENT."""
+    depth = 0
+    start_date = summary = None
+    for line in _unfold_ics_lines(f):
+        if not line:
+            continue
+        name, params, value = _split_ics_property(line)
+        if name == 'BEGIN':
+            if value.upper() == 'VEVENT':
+                depth += 1
+                start_date = summary = None
+            elif depth:
+                depth += 1
+            continue
+        if name == 'END':
+            if depth == 1 and value.upper() == 'VEVENT':
+                if start_date is None or summary is None:
+                    _LOGGER.error(f"VEVENT thiếu DTSTART hoặc SUMMARY: DTSTART={start_date}, SUMMARY={summary}")
+                else:
+                    yield start_date, summary
+            if depth:
+                depth -= 1
+            continue
+        if depth != 1:
+            continue
+        if name == 'DTSTART':
+            start_date = _parse_ics_date(params, value)
+        elif name == 'SUMMARY':
+            if 'ENCODING' in params:
+                raise _UnsupportedICS(f"SUMMARY dùng ENCODING={params['ENCODING']}")
+            summary = _unescape_ics_text(value)
+
+def _iter_ics_entries_icalendar(file_path):
+    """Đường dự phòng: phân tích toàn bộ file bằng icalendar."""
+    with open(file_path, 'r', encoding='utf-8') as f:
+        cal = Calendar.from_ical(f.read())
+    _LOGGER.debug("Đã phân tích file ICS bằng icalendar")
+    for event in cal.walk('VEVENT'):
+        start_date = event.get('DTSTART').dt
+        if isinstance(start_date, datetime):
+            start_date = start_date.date()
+        yield start_date, str(event.get('SUMMARY'))
+
+def _parse_lunar_summary(summary):
+    """(ngày, tháng, nhuận) từ SUMMARY dạng dd/mm[ (N)], hoặc None nếu không hợp lệ."""
+    is_leap = '(N)' in summary
+    lunar_date = summary.replace('(N)', '').strip()
+    try:
+        day, month = map(int, lunar_date.split('/'))
+    except ValueError:
+        _LOGGER.error(f"Invalid lunar date format: {lunar_date}")
+        return None
+    if not (1 <= day <= 31 and 1 <= month <= 12):
+        _LOGGER.error(f"Invalid lunar date format: {lunar_date}")
+        return None
+    return day, month, is_leap
+
+def _fill_tables(entries, lunar_days, events):
+    for start_date, summary in entries:
+        if _LUNAR_SUMMARY_RE.match(summary):
+            lunar = _parse_lunar_summary(summary)
+            if lunar is None:
+                continue
+            ordinal = start_date.toordinal()
+            if ordinal in lunar_days:
+                existing = lunar_days[ordinal]
+                _LOGGER.error(f"Duplicate lunar date for {start_date}: existing={existing[0]:02d}/{existing[1]:02d}, new={lunar[0]:02d}/{lunar[1]:02d}")
+                continue
+            lunar_days[ordinal] = lunar
+        else:
+            if start_date not in events:
+                events[start_date] = []
+            events[start_date].append(summary)
+
+def _block_digest(block):
+    """Mã băm 64 bit ổn định của một VEVENT thô."""
+    return int.from_bytes(hashlib.blake2b(block, digest_size=8).digest(), 'little')
+
+def _block_entries(block):
+    """Danh sách (ngày, SUMMARY) của một VEVENT thô."""
+    return list(_iter_ics_entries_streaming(io.StringIO(block.decode('utf-8'))))
+
+def _parse_ics_data(data):
+    """Trả về (lunar_days, events, block_index) từ nội dung file ICS.
+
+    block_index = (digests, ordinals): mã băm và ordinal DTSTART của từng
+    VEVENT theo thứ tự trong file (0 nếu VEVENT không có dữ liệu), lưu trong
+    bản chụp để lần nạp lại sau chỉ phân tích các VEVENT đã đổi.
+    """
+    lunar_days, events = {}, {}
+    digests, ordinals = array('Q'), array('l')
+    for match in _VEVENT_BLOCK_RE.finditer(data):
+        block = match.group()
+        entries = _block_entries(block)
+        digests.append(_block_digest(block))
+        ordinals.append(entries[0][0].toordinal() if entries else 0)
+        _fill_tables(entries, lunar_days, events)
+    return lunar_days, events, (digests, ordinals)
+
+def _parse_ics_tables(file_path, data):
+    """Trả về ((day_table, event_index), block_index) hoặc None nếu file rỗng.
+
+    block_index là None khi phải đọc bằng icalendar.
+    """
+    if not data[:1024].strip():
+        return None
+    try:
+        lunar_days, events, block_index = _parse_ics_data(data)
+        _LOGGER.debug("Đã đọc file ICS bằng bộ đọc dòng")
+    except _UnsupportedICS as e:
+        _LOGGER.info(f"Chuyển sang icalendar để đọc file ICS: {str(e)}")
+        lunar_days, events, block_index = {}, {}, None
+        _fill_tables(_iter_ics_entries_icalendar(file_path), lunar_days, events)
+    return _build_tables(lunar_days, events), block_index
+
+def _read_ics_tables(file_path):
+    """Đọc và phân tích file ICS; trả về (fingerprint, kết quả _parse_ics_tables)."""
+    fingerprint, data = _read_ics(file_path)
+    return fingerprint, _parse_ics_tables(file_path, data)
+
+def _build_tables(lunar_days, events):
+    day_table = LunarDayTable.build(lunar_days)
+    event_index = EventIndex.build(
+        events, lambda d: format_lunar_date(lunar_from_solar(d, day_table))
+    )
+    return day_table, event_index
 
 def load_ics_file(file_path=None):
-    global _lunar_dates, _solar_dates, _events
-    _lunar_dates = {}
-    _solar_dates = {}
-    _events = {}
     if file_path is None:
         file_path = AMLICH_ICS_PATH
     _LOGGER.debug(f"Đang tải file ICS từ: {file_path}")
@@ -35,51 +515,24 @@ def load_ics_file(file_path=None):
         if not os.path.isfile(file_path):
             _LOGGER.error(f"File ICS không tồn tại hoặc không phải file: {file_path}")
             return False
-        with open(file_path, 'r', encoding='utf-8') as f:
-            _LOGGER.debug("Đang đọc nội dung file ICS")
-            ics_content = f.read()
-            if not ics_content.strip():
-                _LOGGER.error("File ICS rỗng")
-                return False
-            cal = Calendar.from_ical(ics_content)
-            _LOGGER.debug("Đã phân tích file ICS thành công")
-            for event in cal.walk('VEVENT'):
-                start_date = event.get('DTSTART').dt
-                summary = event.get('SUMMARY')
-                # _LOGGER.debug(f"Processing event: DTSTART={start_date}, SUMMARY={summary}")  # Tắt log rác này
-                if isinstance(start_date, datetime):
-                    start_date = start_date.date()
-                if re.match(r'^\d{1,2}/\d{1,2}(?:\s*\(N\))?$', summary):
-                    lunar_date = summary.replace('(N)', '').strip()
-                    try:
-                        day, month = map(int, lunar_date.split('/'))
-                        if not (1 <= day <= 31 and 1 <= month <= 12):
-                            _LOGGER.error(f"Invalid lunar date format: {lunar_date}")
-                            continue
-                        lunar_date = f"{day:02d}/{month:02d}"
-                        if start_date in _lunar_dates:
-                            _LOGGER.error(f"Duplicate lunar date for {start_date}: existing={_lunar_dates[start_date]}, new={lunar_date}")
-                            continue
-                        _lunar_dates[start_date] = lunar_date
-                        if lunar_date not in _solar_dates:
-                            _solar_dates[lunar_date] = []
-                        _solar_dates[lunar_date].append(start_date)
-                        # _LOGGER.debug(f"Mapped lunar date {lunar_date} → solar date {start_date.strftime('%Y-%m-%d')}")  # Tắt log rác này
-                    except ValueError:
-                        _LOGGER.error(f"Invalid lunar date format: {lunar_date}")
-                        continue
-                else:
-                    if start_date not in _events:
-                        _events[start_date] = []
-                    _events[start_date].append(summary)
-                    # _LOGGER.debug(f"Added event for {start_date}: {summary}")  # Tắt log rác này
-            _LOGGER.info(f"Đã tải {len(_lunar_dates)} ngày âm lịch, "
-                         f"{len(_solar_dates)} ánh xạ âm lịch-dương lịch, "
-                         f"{sum(len(e) for e in _events.values())} sự kiện")
-            date_obj = datetime.strptime('2025-05-15', '%Y-%m-%d').date()
-            if date_obj in _lunar_dates:
-                _LOGGER.debug(f"_lunar_dates[2025-05-15]: {_lunar_dates[date_obj]}")
+        snapshot = _load_snapshot(file_path)
+        if snapshot is not None:
+            tables, token, fingerprint = snapshot
+            _pin_current_years(tables[0])
+            _publish(*tables)
+            _loaded_ics[file_path] = _LoadedICS(fingerprint[:2], fingerprint[2], token)
+            _LOGGER.info(f"Đã tải {len(tables[0])} ngày âm lịch từ bản chụp {file_path + SNAPSHOT_SUFFIX}")
             return True
+        _LOGGER.debug("Đang đọc nội dung file ICS")
+        fingerprint, parsed = _read_ics_tables(file_path)
+        if parsed is None:
+            _LOGGER.error("File ICS rỗng")
+            return False
+        tables, block_index = parsed
+        _LOGGER.info(f"Đã tải {len(tables[0])} ngày âm lịch, "
+                     f"{len(tables[1])} sự kiện")
+        _store_and_publish(file_path, fingerprint, tables, block_index)
+        return True
     except UnicodeDecodeError as e:
         _LOGGER.error(f"Lỗi mã hóa khi đọc file ICS: {str(e)}")
         return False
@@ -90,37 +543,312 @@ def load_ics_file(file_path=None):
         _LOGGER.error(f"Lỗi không xác định khi tải file ICS: {str(e)}")
         return False
 
-def get_lunar_year(solar_date, lunar_dates):
+def ics_changed(file_path=None):
+    """True nếu kích thước hoặc mtime của file ICS khác lần nạp gần nhất."""
+    if file_path is None:
+        file_path = AMLICH_ICS_PATH
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return False
+    loaded = _loaded_ics.get(file_path)
+    return loaded is None or loaded.stat != (stat.st_size, stat.st_mtime_ns)
+
+def _event_counts(events):
+    return Counter((d.toordinal(), text) for d, texts in events.items() for text in texts)
+
+def _diff_blocks(data, block_index):
+    """So các VEVENT trong data với block_index của lần nạp trước.
+
+    Trả về (block_index mới, các ordinal bị ảnh hưởng, danh sách (ngày, SUMMARY)
+    của mọi VEVENT mới nằm trên các ordinal đó theo thứ tự trong file). Chỉ
+    VEVENT mới và VEVENT cùng ngày với một VEVENT đã đổi được phân tích.
+    """
+    old_ordinals = dict(zip(*block_index))
+    digests, ordinals = array('Q'), array('l')
+    parsed = {}
+    for match in _VEVENT_BLOCK_RE.finditer(data):
+        block = match.group()
+        digest = _block_digest(block)
+        ordinal = old_ordinals.get(digest)
+        if ordinal is None:
+            if digest not in parsed:
+                parsed[digest] = _block_entries(block)
+            entries = parsed[digest]
+            ordinal = entries[0][0].toordinal() if entries else 0
+        digests.append(digest)
+        ordinals.append(ordinal)
+    old_counts, new_counts = Counter(block_index[0]), Counter(digests)
+    new_ordinals = dict(zip(digests, ordinals))
+    affected = {old_ordinals[digest] for digest in old_counts - new_counts}
+    affected.update(new_ordinals[digest] for digest in new_counts - old_counts)
+    affected.discard(0)
+    entries = []
+    if affected:
+        for match, ordinal in zip(_VEVENT_BLOCK_RE.finditer(data), ordinals):
+            if ordinal in affected:
+                entries.extend(_block_entries(match.group()))
+    return (digests, ordinals), affected, entries
+
+def reload_ics_incremental(file_path=None):
+    """Nạp lại file ICS, chỉ phân tích các VEVENT thay đổi so với lần nạp trước.
+
+    Mã băm từng VEVENT của lần nạp trước được đọc từ bản chụp; chỉ các ngày
+    có VEVENT mất đi hoặc mới thêm được tính lại. Sự kiện được vá vào chỉ
+    mục, ngày âm lịch đổi thì chỉ dựng lại đoạn của năm bị ảnh hưởng. Nếu chỉ
+    sự kiện đổi thì chỉ ghi lại bản chụp chỉ mục sự kiện. Đổi ngày Tết (làm
+    đổi năm âm của nhiều ngày) thì nạp lại toàn bộ. Trả về True nếu thành công.
+    """
+    if file_path is None:
+        file_path = AMLICH_ICS_PATH
+    loaded = _loaded_ics.get(file_path)
+    if _data.version == 0 or loaded is None:
+        return load_ics_file(file_path)
+    try:
+        fingerprint, data = _read_ics(file_path)
+        if fingerprint[2] == loaded.sha256:
+            _LOGGER.debug("File ICS chỉ đổi mtime, nội dung giữ nguyên")
+            _loaded_ics[file_path] = loaded._replace(stat=fingerprint[:2])
+            return True
+        block_index = _load_block_index(file_path, loaded.sha256)
+        if block_index is None:
+            return load_ics_file(file_path)
+        block_index, affected, entries = _diff_blocks(data, block_index)
+        del data
+        if not block_index[0]:
+            return load_ics_file(file_path)
+        new_lunar, new_events = {}, {}
+        _fill_tables(entries, new_lunar, new_events)
+        current = _data
+        removed_lunar, added_lunar = {}, {}
+        old_counts = Counter()
+        for ordinal in affected:
+            solar_date = datetime.fromordinal(ordinal).date()
+            lunar = current.day_table.lookup(solar_date)
+            old = (lunar[0], lunar[1], lunar[3]) if lunar else None
+            new = new_lunar.get(ordinal)
+            if old != new:
+                if old is not None:
+                    removed_lunar[ordinal] = old
+                if new is not None:
+                    added_lunar[ordinal] = new
+            for text in current.event_index.on(solar_date):
+                old_counts[(ordinal, text)] += 1
+        if any(
+            value == (1, 1, False)
+            for value in itertools.chain(removed_lunar.values(), added_lunar.values())
+        ):
+            _LOGGER.info("Ngày Tết trong ICS đã thay đổi, dựng lại toàn bộ bảng")
+            return load_ics_file(file_path)
+        new_counts = _event_counts(new_events)
+        removed, added = old_counts - new_counts, new_counts - old_counts
+        _LOGGER.info(
+            f"Cập nhật ICS: {len(removed_lunar) + len(added_lunar)} ngày âm lịch, "
+            f"gỡ {sum(removed.values())}, thêm {sum(added.values())} sự kiện"
+        )
+        day_table = current.day_table
+        token = loaded.snapshot_token
+        if removed_lunar or added_lunar:
+            day_table = day_table.patch(removed_lunar, added_lunar)
+            token = None
+            # Sự kiện giữ nguyên trên các ngày vừa đổi ngày âm cũng cần tính lại ngày âm
+            for ordinal in set(removed_lunar) | set(added_lunar):
+                for text, count in Counter(
+                    current.event_index.on(datetime.fromordinal(ordinal).date())
+                ).items():
+                    kept = count - removed[(ordinal, text)]
+                    if kept > 0:
+                        removed[(ordinal, text)] += kept
+                        added[(ordinal, text)] += kept
+        event_index = current.event_index
+        if removed or added:
+            event_index = event_index.patch(
+                removed,
+                list(added.elements()),
+                lambda d: format_lunar_date(lunar_from_solar(d, day_table)),
+            )
+        _store_and_publish(file_path, fingerprint, (day_table, event_index), block_index, token)
+        return True
+    except _UnsupportedICS as e:
+        _LOGGER.info(f"Không cập nhật từng phần được ({str(e)}), nạp lại toàn bộ file ICS")
+        return load_ics_file(file_path)
+    except Exception as e:
+        _LOGGER.error(f"Lỗi khi cập nhật file ICS: {str(e)}")
+        return False
+
+def get_lunar_year(solar_date, day_table=None):
     _LOGGER.debug(f"Determining lunar year for solar date: {solar_date}")
-    year = solar_date.year
-    for offset in [0, -1]:
-        check_year = year + offset
-        lunar_new_year_key = '01/01'
-        new_year_dates = []
-        for date, lunar in lunar_dates.items():
-            if lunar == lunar_new_year_key and date.year == check_year:
-                new_year_dates.append(date)
-        for new_year_date in sorted(new_year_dates):
-            _LOGGER.debug(f"Found lunar new year: {new_year_date}")
-            if solar_date < new_year_date:
-                lunar_year = check_year - 1
-            else:
-                lunar_year = check_year
-            _LOGGER.debug(f"Lunar year for {solar_date}: {lunar_year}")
-            return lunar_year
-    _LOGGER.debug(f"No lunar new year found, defaulting to {year}")
-    return year
+    if day_table is None:
+        day_table = _data.day_table
+    lunar_year = day_table.lunar_year(solar_date.toordinal())
+    if lunar_year is not None:
+        _LOGGER.debug(f"Lunar year for {solar_date}: {lunar_year}")
+        return lunar_year
+    lunar = lunar_from_solar(solar_date)
+    if lunar:
+        _LOGGER.debug(f"Lunar year for {solar_date} (engine): {lunar[2]}")
+        return lunar[2]
+    _LOGGER.debug(f"No lunar new year found, defaulting to {solar_date.year}")
+    return solar_date.year
+
+def lunar_from_solar(solar_date, day_table=None):
+    """(ngày, tháng, năm, nhuận) âm lịch: ưu tiên dữ liệu ICS, ngoài phạm vi thì tính bằng amlich_engine."""
+    if day_table is None:
+        day_table = _data.day_table
+    lunar = day_table.lookup(solar_date)
+    if lunar:
+        return lunar
+    try:
+        return amlich_engine.solar_to_lunar(solar_date)
+    except ValueError:
+        return None
+
+def format_lunar_date(lunar):
+    """Chuỗi DD/MM/YYYY cho kết quả của lunar_from_solar."""
+    if not lunar:
+        return 'Không có dữ liệu âm lịch'
+    return f"{lunar[0]:02d}/{lunar[1]:02d}/{lunar[2]}"
+
+def _solar_dates_for(day, month, lunar_year, day_table):
+    """Các ngày dương ứng với ngày âm dd/mm quanh năm âm lịch lunar_year."""
+    # Ngày âm dd/mm của năm âm lunar_year rơi vào năm dương lunar_year hoặc năm sau
+    years = range(lunar_year - 1, lunar_year + 2)
+    if day_table.has_year(lunar_year):
+        solar_dates = day_table.solar_dates(day, month, years)
+        if solar_dates:
+            return solar_dates
+    solar_dates = []
+    for year in (lunar_year - 1, lunar_year, lunar_year + 1):
+        for leap in (False, True):
+            try:
+                solar_date = amlich_engine.lunar_to_solar(day, month, year, leap)
+            except ValueError:
+                continue
+            if solar_date:
+                solar_dates.append(solar_date)
+    return sorted(solar_dates)
+
+def _engine_columns(ordinals):
+    """Tính cột âm lịch cho các ordinal bằng amlich_engine, mỗi tháng âm một lần."""
+    first, last = min(ordinals), max(ordinals)
+    starts, months, years, leaps = amlich_engine.lunar_months(first, last)
+    result = ([], [], [], [])
+    for ordinal in ordinals:
+        pos = bisect_right(starts, ordinal) - 1
+        result[0].append(ordinal - starts[pos] + 1)
+        result[1].append(months[pos])
+        result[2].append(years[pos])
+        result[3].append(1 if leaps[pos] else 0)
+    return result
+
+def convert_ordinals(ordinals):
+    """Đổi hàng loạt ordinal dương lịch sang các cột âm lịch.
+
+    Trả về dict {'ordinal', 'day', 'month', 'year', 'leap'}; mỗi cột là
+    numpy.ndarray nếu có NumPy, ngược lại là array.array. Ngày trong phạm vi
+    ICS lấy từ bảng ngày, ngày ngoài phạm vi tính bằng amlich_engine.
+    """
+    table = _data.day_table
+    if np is not None:
+        ords = np.asarray(ordinals, dtype=np.int64)
+        day = np.zeros(ords.shape, dtype=np.int16)
+        month = np.zeros(ords.shape, dtype=np.int16)
+        year = np.zeros(ords.shape, dtype=np.int32)
+        leap = np.zeros(ords.shape, dtype=np.int8)
+        if ords.size:
+            first_year = datetime.fromordinal(int(ords.min())).year
+            last_year = datetime.fromordinal(int(ords.max())).year
+            for solar_year in range(first_year, last_year + 1):
+                segment = table.segment(solar_year)
+                if segment is None:
+                    continue
+                idx = ords - segment.base
+                covered = (idx >= 0) & (idx < len(segment.days))
+                if not covered.any():
+                    continue
+                hit = idx[covered]
+                day[covered] = np.frombuffer(segment.days, dtype=np.uint8)[hit]
+                month[covered] = np.frombuffer(segment.months, dtype=np.uint8)[hit]
+                year[covered] = np.frombuffer(segment.years, dtype=np.uint16)[hit]
+                leap[covered] = np.frombuffer(segment.leaps, dtype=np.uint8)[hit]
+        missing = day == 0
+        if missing.any():
+            miss = ords[missing]
+            starts, months, years, leaps = amlich_engine.lunar_months(int(miss.min()), int(miss.max()))
+            starts = np.asarray(starts, dtype=np.int64)
+            pos = np.searchsorted(starts, miss, side='right') - 1
+            day[missing] = miss - starts[pos] + 1
+            month[missing] = np.asarray(months, dtype=np.int16)[pos]
+            year[missing] = np.asarray(years, dtype=np.int32)[pos]
+            leap[missing] = np.asarray(leaps, dtype=np.int8)[pos]
+        return {'ordinal': ords, 'day': day, 'month': month, 'year': year, 'leap': leap}
+    ords = array('l', ordinals)
+    columns = (array('h'), array('h'), array('l'), array('b'))
+    missing = []
+    segment = None
+    for ordinal in ords:
+        if segment is None or not 0 <= ordinal - segment.base < len(segment.days):
+            segment = table.segment(datetime.fromordinal(ordinal).year)
+        idx = ordinal - segment.base if segment else -1
+        if segment and 0 <= idx < len(segment.days) and segment.days[idx]:
+            columns[0].append(segment.days[idx])
+            columns[1].append(segment.months[idx])
+            columns[2].append(segment.years[idx])
+            columns[3].append(segment.leaps[idx])
+        else:
+            missing.append(len(columns[0]))
+            for column in columns:
+                column.append(0)
+    if missing:
+        computed = _engine_columns([ords[i] for i in missing])
+        for n, i in enumerate(missing):
+            for column, values in zip(columns, computed):
+                column[i] = values[n]
+    return {'ordinal': ords, 'day': columns[0], 'month': columns[1], 'year': columns[2], 'leap': columns[3]}
+
+def convert_range(start_date, end_date):
+    """Đổi mọi ngày trong khoảng [start_date, end_date] sang âm lịch trong một lượt."""
+    first, last = start_date.toordinal(), end_date.toordinal()
+    if last < first:
+        raise ValueError(f"Khoảng ngày không hợp lệ: {start_date} > {end_date}")
+    if np is not None:
+        return convert_ordinals(np.arange(first, last + 1, dtype=np.int64))
+    # Cả khoảng nằm trong bảng ICS: nối các lát cắt của từng năm
+    table = _data.day_table
+    result = {'day': array('B'), 'month': array('B'), 'year': array('H'), 'leap': array('B')}
+    expected = first
+    for solar_year in range(start_date.year, end_date.year + 1):
+        segment = table.segment(solar_year)
+        if segment is None or segment.base > expected:
+            return convert_ordinals(range(first, last + 1))
+        lo = expected - segment.base
+        hi = min(last - segment.base + 1, len(segment.days))
+        if lo >= hi or 0 in segment.days[lo:hi]:
+            return convert_ordinals(range(first, last + 1))
+        result['day'].extend(segment.days[lo:hi])
+        result['month'].extend(segment.months[lo:hi])
+        result['year'].extend(segment.years[lo:hi])
+        result['leap'].extend(segment.leaps[lo:hi])
+        expected = segment.base + hi
+    if expected != last + 1:
+        return convert_ordinals(range(first, last + 1))
+    result['ordinal'] = array('l', range(first, last + 1))
+    return result
+
+_NUMBER_MAP = {
+    '1': 'một', '2': 'hai', '3': 'ba', '4': 'bốn', '4': 'tư', '5': 'năm',
+    '6': 'sáu', '7': 'bảy', '8': 'tám', '9': 'chín', '10': 'mười',
+    'cn': 'chủ nhật', 'chủ nhật': 'chủ nhật'
+}
+_NUMBER_PATTERNS = [
+    (re.compile(rf'(?<!\d[/-])(?<!\d)\: {key}\b(?![/-]\d)', re.IGNORECASE), value)
+    for key, value in _NUMBER_MAP.items()
+]
 
 def normalize_numbers_and_days(input_text):
     _LOGGER.debug(f"Normalizing numbers and days: {input_text}")
-    number_map = {
-        '1': 'một', '2': 'hai', '3': 'ba', '4': 'bốn', '4': 'tư', '5': 'năm',
-        '6': 'sáu', '7': 'bảy', '8': 'tám', '9': 'chín', '10': 'mười',
-        'cn': 'chủ nhật', 'chủ nhật': 'chủ nhật'
-    }
-    for key, value in number_map.items():
-        pattern = rf'(?<!\d[/-])(?<!\d)\: {key}\b(?![/-]\d)'
-        input_text = re.sub(pattern, value, input_text, flags=re.IGNORECASE)
+    for pattern, value in _NUMBER_PATTERNS:
+        input_text = pattern.sub(value, input_text)
     _LOGGER.debug(f"Normalized to: {input_text}")
     return input_text
 
@@ -155,73 +883,35 @@ def normalize_weekday(input_text):
             return normalized
     return input_text
 
-async def fix_spelling(hass: HomeAssistant, input_text):
-    if not GEMINI_API_KEY:
-        _LOGGER.error("Không có Gemini API key được cấu hình")
-        return input_text
-    headers = {
-        "Content-Type": "application/json",
-        "x-goog-api-key": GEMINI_API_KEY
-    }
-    prompt = f"""Sửa lỗi chính tả trong câu tiếng Việt sau, giữ nguyên ý nghĩa gốc và trả về chỉ câu đã sửa:
-- Xử lý các lỗi như lặp chữ, sai dấu, sai từ.
-- Không sửa các từ số (một, hai, ba,...) hoặc ngày (chủ nhật, cn).
-- Không sửa định dạng ngày như '1/2', '01/02'.
-- Chuẩn hóa các thứ: 'thứ 2' → 'thứ Hai', 'thu nam' → 'thứ Năm', v.v.
-- Chuẩn hóa 'sự kien' → 'sự kiện'.
-- Ví dụ:
-  - 'tuaann nay' → 'tuần này'
-  - 'thứ 2' → 'thứ Hai'
-  - 'am lich hom nay' → 'âm lịch hôm nay'
-  - 'sự kien' → 'sự kiện'
-  - 'sự kien tháng 1' → 'sự kiện tháng 1'
-  - 'sự kiện 1/2' → 'sự kiện 1/2'
-- Không thêm giải thích, chỉ trả về câu đã sửa.
+UNPARSED_MESSAGE = "Không thể phân tích input. Vui lòng thử lại!"
 
-Input: '{input_text}'"""
-    
-    data = {
-        "contents": [{
-            "parts": [{"text": prompt}]
-        }],
-        "generationConfig": {
-            "response_mime_type": "text/plain"
-        }
-    }
-    
-    def make_request():
-        try:
-            response = requests.post(GEMINI_API_URL, headers=headers, json=data)
-            _LOGGER.debug(f"Sửa lỗi chính tả - Status code: {response.status_code}")
-            if response.status_code == 200:
-                fixed_text = response.json()['candidates'][0]['content']['parts'][0]['text'].strip()
-                _LOGGER.debug(f"Input gốc: '{input_text}' → Input sửa: '{fixed_text}'")
-                return fixed_text
-            else:
-                _LOGGER.error(f"Lỗi sửa lỗi chính tả: {response.status_code} - {response.text}")
-                return input_text
-        except Exception as e:
-            _LOGGER.error(f"Lỗi khi sửa lỗi chính tả: {str(e)}")
-            return input_text
+# Chỗ giữ chỗ trong mẫu câu hài hước; câu trả lời chính xác được điền vào đây
+HUMOR_PLACEHOLDER = '{ket_qua}'
 
-    return await hass.async_add_executor_job(make_request)
+async def analyze_with_gemini(hass: HomeAssistant, input_text, use_humor=False):
+    """Một lần gọi Gemini cho câu hỏi mà bộ phân tích cục bộ không hiểu.
 
-async def parse_with_gemini(hass: HomeAssistant, input_text):
+    Trả về dict gồm 'corrected' (câu đã sửa chính tả), một trong
+    'date'/'range'/'error', và 'humor_template' khi use_humor bật. Ngày âm lịch
+    và sự kiện vẫn do mã cục bộ tính rồi điền vào mẫu câu.
+    """
     if not GEMINI_API_KEY:
         _LOGGER.error("Không có Gemini API key được cấu hình")
         return {'error': 'Không có Gemini API key'}
-    headers = {
-        "Content-Type": "application/json",
-        "x-goog-api-key": GEMINI_API_KEY
-    }
     current_date = datetime.now().date()
     current_year = current_date.year
-    prompt = f"""Hôm nay là {current_date.strftime('%Y-%m-%d')}. Hãy phân tích input sau và trả về JSON theo định dạng:
-- Nếu là ngày cụ thể: {{"date": "YYYY-MM-DD"}}
-- Nếu là khoảng thời gian: {{"range": {{"start": "YYYY-MM-DD", "end": "YYYY-MM-DD"}}}}
-- Nếu không xác định được ngày, trả về: {{"error": "Không thể xác định ngày"}}.
-- Không trả về date hoặc range là null. Không thêm các trường is_event, is_lunar, is_solar.
-- Luôn trả về JSON hợp lệ.
+    humor_rule = f"""
+- "humor_template": một câu tiếng Việt ngắn, hài hước, dí dỏm, theo trend mới nhất, chứa đúng một lần chuỗi {HUMOR_PLACEHOLDER} ở chỗ sẽ điền câu trả lời. Không tự viết ngày tháng hay sự kiện vào mẫu.""" if use_humor else ""
+    prompt = f"""Hôm nay là {current_date.strftime('%Y-%m-%d')}. Hãy phân tích câu hỏi tiếng Việt sau và trả về một JSON với các trường:
+- "corrected": câu hỏi đã sửa lỗi chính tả (lặp chữ, sai dấu, sai từ), giữ nguyên ý nghĩa gốc.
+  Không sửa các từ số (một, hai, ba,...), ngày (chủ nhật, cn) hay định dạng ngày như '1/2', '01/02'.
+  Chuẩn hóa các thứ: 'thứ 2' → 'thứ Hai', 'thu nam' → 'thứ Năm'; 'sự kien' → 'sự kiện'.
+- Nếu là ngày cụ thể: "date": "YYYY-MM-DD"
+- Nếu là khoảng thời gian: "range": {{"start": "YYYY-MM-DD", "end": "YYYY-MM-DD"}}
+- Nếu không xác định được ngày: "error": "Không thể xác định ngày"{humor_rule}
+Chỉ xét phần chỉ thời gian, bỏ qua các cụm 'sự kiện', 'âm lịch', 'dương lịch'.
+Không trả về date hoặc range là null. Không thêm các trường is_event, is_lunar, is_solar.
+Luôn trả về JSON hợp lệ.
 
 Hướng dẫn:
 1. Các tháng bằng chữ tiếng Việt: 'sáu' là tháng 6, 'bảy' là tháng 7, v.v.
@@ -234,14 +924,14 @@ Hướng dẫn:
 4. Định dạng ngày như '1/2' hiểu là ngày 1 tháng 2 năm {current_year}.
 
 Ví dụ:
-- Input: 'ngày này tuần sau' → {{"date": "2025-05-22"}}
-- Input: 'tuần này' → {{"range": {{"start": "2025-05-12", "end": "2025-05-18"}}}}
-- Input: 'tháng sáu' → {{"range": {{"start": "2025-06-01", "end": "2025-06-30"}}}}
-- Input: '1/2' → {{"date": "2025-02-01"}}
+- Input: 'tuaann nay' → {{"corrected": "tuần này", "range": {{"start": "2025-05-12", "end": "2025-05-18"}}}}
+- Input: 'am lich hom nay' → {{"corrected": "âm lịch hôm nay", "date": "2025-05-15"}}
+- Input: 'sự kien tháng sáu' → {{"corrected": "sự kiện tháng sáu", "range": {{"start": "2025-06-01", "end": "2025-06-30"}}}}
+- Input: 'ngày này tuần sau' → {{"corrected": "ngày này tuần sau", "date": "2025-05-22"}}
 Input: '{input_text}'"""
-    
-    _LOGGER.debug(f"Gọi Gemini AI với input: {input_text}")
-    
+
+    _LOGGER.debug(f"Gọi Gemini AI (gộp) với input: {input_text}, use_humor={use_humor}")
+
     data = {
         "contents": [{
             "parts": [{"text": prompt}]
@@ -250,39 +940,489 @@ Input: '{input_text}'"""
             "response_mime_type": "application/json"
         }
     }
-    
-    def make_request():
-        try:
-            response = requests.post(GEMINI_API_URL, headers=headers, json=data)
-            _LOGGER.debug(f"Status code từ Gemini API: {response.status_code}")
-            if response.status_code == 200:
-                response_json = response.json()
-                if 'candidates' in response_json and response_json['candidates']:
-                    response_text = response_json['candidates'][0]['content']['parts'][0]['text']
-                    _LOGGER.debug(f"Response JSON từ Gemini AI: {response_text}")
-                    result = json.loads(response_text)
-                    if 'date' not in result and 'range' not in result and 'error' not in result:
-                        _LOGGER.debug("Response từ Gemini thiếu date, range hoặc error")
-                        return {'error': 'Response từ Gemini không hợp lệ'}
-                    return result
-                else:
-                    _LOGGER.debug("Không tìm thấy 'candidates' trong response từ Gemini")
-                    return {'error': 'Response từ Gemini AI không hợp lệ'}
+
+    # Kết quả phụ thuộc ngày hiện tại nên khóa gồm cả ngày tham chiếu
+    cache_key = (input_text, current_date.isoformat(), bool(use_humor))
+    cached = await hass.async_add_executor_job(_cache_get, 'analyze', *cache_key)
+    if cached is not None:
+        _LOGGER.debug(f"Bộ đệm phân tích cho '{input_text}': {cached}")
+        return cached
+    try:
+        status, body = await _post_gemini(hass, data)
+        _LOGGER.debug(f"Status code từ Gemini API: {status}")
+        if status == 200:
+            if 'candidates' in body and body['candidates']:
+                response_text = body['candidates'][0]['content']['parts'][0]['text']
+                _LOGGER.debug(f"Response JSON từ Gemini AI: {response_text}")
+                result = json.loads(response_text)
+                if 'date' not in result and 'range' not in result and 'error' not in result:
+                    _LOGGER.debug("Response từ Gemini thiếu date, range hoặc error")
+                    return {'error': 'Response từ Gemini không hợp lệ'}
+                await hass.async_add_executor_job(_cache_put, 'analyze', result, *cache_key)
+                return result
             else:
-                _LOGGER.debug(f"Lỗi Gemini API: {response.status_code} - {response.text}")
-                return {'error': f'Lỗi khi gọi Gemini API: {response.status_code}'}
-        except Exception as e:
-            _LOGGER.debug(f"Lỗi khi gọi Gemini API: {str(e)}")
-            return {'error': f'Lỗi kết nối Gemini API: {str(e)}'}
+                _LOGGER.debug("Không tìm thấy 'candidates' trong response từ Gemini")
+                return {'error': 'Response từ Gemini AI không hợp lệ'}
+        else:
+            _LOGGER.debug(f"Lỗi Gemini API: {status} - {body}")
+            return {'error': f'Lỗi khi gọi Gemini API: {status}'}
+    except GeminiUnavailable as e:
+        _LOGGER.debug(str(e))
+        return {'error': UNPARSED_MESSAGE}
+    except asyncio.TimeoutError:
+        _LOGGER.debug("Gemini API không phản hồi trong thời gian cho phép")
+        return {'error': 'Gemini API không phản hồi kịp'}
+    except Exception as e:
+        _LOGGER.debug(f"Lỗi khi gọi Gemini API: {str(e)}")
+        return {'error': f'Lỗi kết nối Gemini API: {str(e)}'}
 
-    return await hass.async_add_executor_job(make_request)
+def fill_humor_template(template, output):
+    """Điền câu trả lời vào mẫu hài hước; mẫu không hợp lệ thì giữ câu gốc."""
+    if not isinstance(template, str) or template.count(HUMOR_PLACEHOLDER) != 1:
+        return output
+    return template.replace(HUMOR_PLACEHOLDER, output)
 
-async def parse_input(hass: HomeAssistant, input_text, is_fixed=False):
-    _LOGGER.debug(f"Parsing input: {input_text}, is_fixed={is_fixed}")
-    original_input = input_text
+# Ngữ pháp truy vấn cục bộ. Cụm cố định tra bằng dict, các dạng còn lại được
+# phân loại trong một lần so khớp với regex biên dịch sẵn; mỗi nhánh có một
+# hàm xử lý riêng. Các nhánh rời nhau nên thứ tự không ảnh hưởng kết quả.
+_QueryContext = namedtuple('_QueryContext', ['today', 'is_event', 'is_lunar', 'is_solar', 'day_table'])
+
+_NUMBER_WORDS = {'một': 1, 'hai': 2, 'ba': 3, 'bốn': 4, 'tư': 4, 'năm': 5, 'sáu': 6, 'bảy': 7}
+
+_MONTH_NAMES = {
+    'một': 1, 'hai': 2, 'ba': 3, 'bốn': 4, 'tư': 4, 'năm': 5, 'sáu': 6,
+    'bảy': 7, 'tám': 8, 'chín': 9, 'mười': 10, 'mười một': 11, 'mười hai': 12
+}
+
+_WEEKDAYS = {
+    'thứ hai': 0,
+    'thứ ba': 1,
+    'thứ tư': 2,
+    'thứ năm': 3,
+    'thứ sáu': 4,
+    'thứ bảy': 5,
+    'chủ nhật': 6
+}
+
+_WEEK_MODIFIERS = {
+    'tuần này': 0,
+    'tuần trước': -7,
+    'tuần sau': 7,
+    'tuần tới': 7
+}
+
+# Cụm cố định → (loại, tham số)
+_FIXED_PHRASES = {
+    'hôm nay': ('day', 0),
+    'hôm này': ('day', 0),
+    'ngày hôm nay': ('day', 0),
+    'ngày này': ('day', 0),
+    'hôm qua': ('day', -1),
+    'hôm kia': ('day', -2),
+    'ngày mai': ('day', 1),
+    'hôm sau': ('day', 1),
+    'ngày kia': ('day', 2),
+    'ngày mốt': ('day', 2),
+    'ngày này tuần sau': ('day', 7),
+    'hôm nay tuần sau': ('day', 7),
+    'ngày này tháng sau': ('same_day_next_month', None),
+    'tuần này': ('week', 0),
+    'tuần trước': ('week', -1),
+    'tuần sau': ('week', 1),
+    'tuần tới': ('week', 1),
+    'tháng này': ('month', 0),
+    'tháng sau': ('month', 1),
+    'tháng tới': ('month', 1),
+    'tháng trước': ('month', -1),
+    'năm nay': ('year', 0),
+    'năm này': ('year', 0),
+    'năm sau': ('year', 1),
+    'năm tới': ('year', 1),
+    'năm trước': ('year', -1),
+    'năm ngoái': ('year', -1),
+    'tết': ('tet', None),
+    'tết nguyên đán': ('tet', None)
+}
+
+# Hướng dịch chuyển của 'này/sau/trước...' sau tuần, tháng, năm
+_RELATIVE_OFFSETS = {
+    None: 0, 'này': 0, 'nay': 0,
+    'sau': 1, 'tới': 1,
+    'trước': -1, 'ngoái': -1
+}
+
+# Tên tháng âm lịch và số ngày viết bằng chữ
+_LUNAR_MONTH_NAMES = dict(_MONTH_NAMES, **{'giêng': 1, 'chạp': 12})
+_DAY_WORDS = {
+    'một': 1, 'hai': 2, 'ba': 3, 'bốn': 4, 'tư': 4, 'năm': 5,
+    'sáu': 6, 'bảy': 7, 'tám': 8, 'chín': 9, 'mười': 10
+}
+
+_WHITESPACE = re.compile(r'\s+')
+_NUMBER_TOKEN = r'(?:một|hai|ba|bốn|tư|năm|sáu|bảy|\d+)'
+_QUERY_GRAMMAR = re.compile('|'.join([
+    rf'(?P<week_offset>(?P<week_num>{_NUMBER_TOKEN})\s+tuần\s+(?:sau|tới))',
+    rf'(?P<month_offset>(?P<month_count>{_NUMBER_TOKEN})\s+tháng\s+(?:sau|tới))',
+    r'(?P<weekday>(?P<weekday_name>thứ\s*(?:hai|ba|tư|năm|sáu|bảy)|chủ nhật)'
+    r'(?:\s*(?P<week_modifier>tuần\s*(?:này|trước|sau|tới)))?)',
+    r'(?P<slash_date>(?P<sd_day>\d{1,2})[/-](?P<sd_month>\d{1,2})[/-](?P<sd_year>\d{2,4}))',
+    r'(?P<dot_date>(?P<dd_day>\d{1,2})\.(?P<dd_month>\d{1,2})\.(?P<dd_year>\d{2,4}))',
+    r'(?P<day_month>(?P<dm_day>\d{1,2})[/-](?P<dm_month>\d{1,2}))',
+    r'(?P<text_date>(?:ngày\s+)?(?P<td_day>\d{1,2})\s+tháng\s+(?P<td_month>\d{1,2})'
+    r'(?:\s+năm\s+(?P<td_year>\d{2,4}))?)',
+    r'(?P<month_number>tháng\s+(?P<month_num>\d{1,2}))',
+    r'(?P<month_name>tháng\s+(?P<month_word>.+))',
+    rf'(?P<day_offset>(?P<day_count>{_NUMBER_TOKEN})\s+ngày\s+(?P<day_direction>nữa|tới|sau|trước))',
+    r'(?P<period_edge>(?P<edge>đầu|cuối)\s+(?P<period>tuần|tháng|năm)'
+    r'(?:\s+(?P<period_relative>này|nay|sau|tới|trước|ngoái))?)',
+    r'(?P<lunar_day>(?P<lunar_word>mùng|mồng|rằm)(?:\s+(?P<lunar_num>\d{1,2}|một|hai|ba|bốn|tư|năm|sáu|bảy|tám|chín|mười))?'
+    r'(?:\s+tháng\s+(?P<lunar_month>.+))?)',
+]))
+
+def _month_end(start):
+    return (start + timedelta(days=31)).replace(day=1) - timedelta(days=1)
+
+def _solar_result(solar_date, ctx):
+    return {
+        'date': solar_date.strftime('%Y-%m-%d'),
+        'is_event': ctx.is_event,
+        'is_lunar': ctx.is_lunar,
+        'is_solar': ctx.is_solar or (not ctx.is_lunar and not ctx.is_event)
+    }
+
+def _range_result(start, end, ctx, solar_only=False):
+    _LOGGER.debug(f"Range parsed - From: {start}, To: {end}")
+    return {
+        'range': {'start': start.strftime('%Y-%m-%d'), 'end': end.strftime('%Y-%m-%d')},
+        'is_event': ctx.is_event,
+        'is_lunar': False if solar_only else ctx.is_lunar,
+        'is_solar': True if solar_only else ctx.is_solar or (not ctx.is_lunar and not ctx.is_event)
+    }
+
+def _lunar_day_result(solar_date, ctx):
+    """Hiểu dd/mm của solar_date là ngày âm lịch và tìm ngày dương tương ứng."""
+    day, month = solar_date.day, solar_date.month
+    lunar_date = f"{day:02d}/{month:02d}"
+    lunar_year = get_lunar_year(solar_date, ctx.day_table)
+    lunar_date_with_year = f"{lunar_date}/{lunar_year}"
+    _LOGGER.debug(f"Assuming solar date {solar_date} as lunar date: {lunar_date_with_year}")
+    solar_dates = _solar_dates_for(day, month, lunar_year, ctx.day_table)
+    if not solar_dates:
+        _LOGGER.error(f"No solar dates found for lunar {lunar_date}")
+        return {'error': f'Không tìm thấy ngày âm lịch {lunar_date} trong dữ liệu ICS'}
+    _LOGGER.debug(f"Solar dates for lunar {lunar_date}: {[d.strftime('%Y-%m-%d') for d in solar_dates]}")
+    selected_solar_date = min(solar_dates, key=lambda d: abs((datetime(lunar_year, month, day).date() - d).days))
+    _LOGGER.debug(f"Selected solar date: {selected_solar_date} for lunar {lunar_date_with_year}")
+    return {
+        'date': selected_solar_date.strftime('%Y-%m-%d'),
+        'is_event': ctx.is_event,
+        'is_lunar': True,
+        'is_solar': False,
+        'lunar_date': lunar_date_with_year
+    }
+
+def _day_result(solar_date, ctx):
+    _LOGGER.debug(f"Parsed date: {solar_date}")
+    if ctx.is_lunar:
+        return _lunar_day_result(solar_date, ctx)
+    return _solar_result(solar_date, ctx)
+
+def _resolve_fixed(kind, value, ctx):
+    today = ctx.today
+    if kind == 'day':
+        return _day_result(today + timedelta(days=value), ctx)
+    if kind == 'same_day_next_month':
+        return _day_result((today + timedelta(days=31)).replace(day=today.day), ctx)
+    if kind == 'week':
+        start = today - timedelta(days=today.weekday()) + timedelta(days=7 * value)
+        return _range_result(start, start + timedelta(days=6), ctx)
+    if kind == 'year':
+        year = today.year + value
+        return _range_result(today.replace(year=year, month=1, day=1), today.replace(year=year, month=12, day=31), ctx)
+    if kind == 'tet':
+        lunar = lunar_from_solar(today, ctx.day_table)
+        if lunar and lunar[0] == 1 and lunar[1] == 1 and not lunar[3]:
+            return _lunar_result(today, ctx)
+        tet = _tet_date(lunar[2] + 1 if lunar else today.year + 1, ctx.day_table)
+        return _lunar_result(tet, ctx) if tet else None
+    start = today.replace(day=1)
+    if value > 0:
+        start = (start + timedelta(days=31)).replace(day=1)
+    elif value < 0:
+        start = (start - timedelta(days=1)).replace(day=1)
+    return _range_result(start, _month_end(start), ctx)
+
+def _lunar_result(solar_date, ctx):
+    """Kết quả kiểu âm lịch cho một ngày dương đã xác định."""
+    lunar = lunar_from_solar(solar_date, ctx.day_table)
+    if not lunar:
+        return {'error': f"Không có dữ liệu âm lịch cho ngày {solar_date.strftime('%d/%m/%Y')}"}
+    return {
+        'date': solar_date.strftime('%Y-%m-%d'),
+        'is_event': ctx.is_event,
+        'is_lunar': True,
+        'is_solar': False,
+        'lunar_date': format_lunar_date(lunar)
+    }
+
+def _lunar_month_start(solar_date, offset, day_table):
+    """Ngày dương của mùng 1 tháng âm chứa solar_date, dịch đi offset tháng."""
+    lunar = lunar_from_solar(solar_date, day_table)
+    if not lunar:
+        return None
+    start = solar_date - timedelta(days=lunar[0] - 1)
+    step = 30 if offset > 0 else -1
+    for _ in range(abs(offset)):
+        # start + 30 luôn rơi vào mùng 1 hoặc mùng 2 tháng sau; start - 1 là ngày cuối tháng trước
+        probe = start + timedelta(days=step)
+        lunar = lunar_from_solar(probe, day_table)
+        if not lunar:
+            return None
+        start = probe - timedelta(days=lunar[0] - 1)
+    return start
+
+def _tet_date(lunar_year, day_table):
+    """Ngày dương của mùng 1 Tết năm âm lịch lunar_year."""
+    idx = bisect_right(day_table.tet, datetime(lunar_year, 1, 1).toordinal() - 1)
+    if idx < len(day_table.tet):
+        tet = datetime.fromordinal(day_table.tet[idx]).date()
+        if tet.year == lunar_year:
+            return tet
+    try:
+        return amlich_engine.lunar_to_solar(1, 1, lunar_year)
+    except ValueError:
+        return None
+
+def _resolve_day_offset(match, ctx):
+    num = _parse_count(match.group('day_count'))
+    if num == 0:
+        return {'error': f"Số không hợp lệ: {match.group('day_count')}"}
+    if match.group('day_direction') == 'trước':
+        num = -num
+    solar_date = ctx.today + timedelta(days=num)
+    return _lunar_result(solar_date, ctx) if ctx.is_lunar else _solar_result(solar_date, ctx)
+
+def _resolve_period_edge(match, ctx):
+    """đầu/cuối tuần, tháng, năm; tháng và năm tính theo âm lịch khi hỏi âm lịch."""
+    today = ctx.today
+    is_end = match.group('edge') == 'cuối'
+    period = match.group('period')
+    offset = _RELATIVE_OFFSETS[match.group('period_relative')]
+    if period == 'tuần':
+        monday = today - timedelta(days=today.weekday()) + timedelta(days=7 * offset)
+        if is_end:
+            return _range_result(monday + timedelta(days=5), monday + timedelta(days=6), ctx)
+        return _lunar_result(monday, ctx) if ctx.is_lunar else _solar_result(monday, ctx)
+    if ctx.is_lunar:
+        if period == 'tháng':
+            start = _lunar_month_start(today, offset + (1 if is_end else 0), ctx.day_table)
+        else:
+            lunar = lunar_from_solar(today, ctx.day_table)
+            if not lunar:
+                return None
+            start = _tet_date(lunar[2] + offset + (1 if is_end else 0), ctx.day_table)
+        if start is None:
+            return None
+        return _lunar_result(start - timedelta(days=1) if is_end else start, ctx)
+    if period == 'tháng':
+        start = today.replace(day=1)
+        if offset > 0:
+            start = (start + timedelta(days=31)).replace(day=1)
+        elif offset < 0:
+            start = (start - timedelta(days=1)).replace(day=1)
+        return _solar_result(_month_end(start) if is_end else start, ctx)
+    year = today.year + offset
+    return _solar_result(today.replace(year=year, month=12 if is_end else 1, day=31 if is_end else 1), ctx)
+
+def _resolve_lunar_day(match, ctx):
+    """mùng N / rằm của tháng âm này, tháng sau, tháng trước hoặc tháng âm mm năm nay."""
+    num_str = match.group('lunar_num')
+    if match.group('lunar_word') == 'rằm':
+        if num_str is not None:
+            return None
+        day = 15
+    elif num_str is None:
+        return None
+    else:
+        day = int(num_str) if num_str.isdigit() else _DAY_WORDS.get(num_str)
+        if not day or day > 30:
+            return None
+    month_spec = (match.group('lunar_month') or 'này').strip()
+    if month_spec in _RELATIVE_OFFSETS:
+        start = _lunar_month_start(ctx.today, _RELATIVE_OFFSETS[month_spec], ctx.day_table)
+        if start is None:
+            return None
+        solar_date = start + timedelta(days=day - 1)
+        lunar = lunar_from_solar(solar_date, ctx.day_table)
+        if not lunar or lunar[0] != day:
+            return {'error': f'Tháng âm lịch này không có ngày {day}'}
+        return _lunar_result(solar_date, ctx)
+    month = int(month_spec) if month_spec.isdigit() else _LUNAR_MONTH_NAMES.get(month_spec)
+    if not month or month > 12:
+        return None
+    today_lunar = lunar_from_solar(ctx.today, ctx.day_table)
+    lunar_year = today_lunar[2] if today_lunar else ctx.today.year
+    for solar_date in _solar_dates_for(day, month, lunar_year, ctx.day_table):
+        lunar = lunar_from_solar(solar_date, ctx.day_table)
+        if lunar and lunar[2] == lunar_year and not lunar[3]:
+            return _lunar_result(solar_date, ctx)
+    return {'error': f'Không tìm thấy ngày âm lịch {day:02d}/{month:02d}/{lunar_year}'}
+
+def _parse_count(num_str):
+    num = _NUMBER_WORDS.get(num_str, int(num_str) if num_str.isdigit() else 0)
+    if num == 0:
+        _LOGGER.error(f"Invalid number: {num_str}")
+    return num
+
+def _resolve_week_offset(match, ctx):
+    num = _parse_count(match.group('week_num'))
+    if num == 0:
+        return {'error': f"Số không hợp lệ: {match.group('week_num')}"}
+    start = ctx.today - timedelta(days=ctx.today.weekday()) + timedelta(days=7 * num)
+    return _range_result(start, start + timedelta(days=6), ctx, solar_only=True)
+
+def _resolve_month_offset(match, ctx):
+    num = _parse_count(match.group('month_count'))
+    if num == 0:
+        return {'error': f"Số không hợp lệ: {match.group('month_count')}"}
+    start = (ctx.today.replace(day=1) + timedelta(days=31 * num)).replace(day=1)
+    return _range_result(start, _month_end(start), ctx, solar_only=True)
+
+def _resolve_weekday(match, ctx):
+    weekday_str = match.group('weekday_name').strip()
+    # Ngữ pháp chấp nhận cả 'tuầnnày' viết liền
+    week_modifier_str = _WHITESPACE.sub(' ', (match.group('week_modifier') or 'tuần này').replace('tuần', 'tuần ')).strip()
+    _LOGGER.debug(f"Weekday parsed: {weekday_str}, week modifier: {week_modifier_str}")
+    if weekday_str not in _WEEKDAYS:
+        return {'error': f'Thứ không hợp lệ: {weekday_str}'}
+    days_diff = _WEEKDAYS[weekday_str] - ctx.today.weekday()
+    return _day_result(ctx.today + timedelta(days=days_diff + _WEEK_MODIFIERS[week_modifier_str]), ctx)
+
+def _resolve_date(day, month, year, ctx):
+    """Ngày dương dd/mm/yyyy; None nếu ngày không hợp lệ để chuyển sang AI."""
+    day, month = int(day), int(month)
+    year = int(year) if year else ctx.today.year
+    if len(str(year)) == 2:
+        year = 2000 + year
+    _LOGGER.debug(f"Date pattern matched - Day: {day}, Month: {month}, Year: {year}")
+    try:
+        solar_date = datetime(year, month, day).date()
+    except ValueError:
+        _LOGGER.debug(f"Invalid date: {day}/{month}/{year}")
+        return None
+    return _day_result(solar_date, ctx)
+
+def _resolve_lunar_day_month(day, month, ctx):
+    """dd/mm khi hỏi âm lịch: ngày âm gần tháng mm của năm hiện tại."""
+    year = ctx.today.year
+    lunar_date = f"{day:02d}/{month:02d}"
+    lunar_date_with_year = f"{lunar_date}/{year}"
+    _LOGGER.debug(f"Lunar input parsed: day={day}, month={month}, year={year}, normalized={lunar_date_with_year}")
+    all_solar_dates = _solar_dates_for(day, month, year, ctx.day_table)
+    if not all_solar_dates:
+        _LOGGER.error(f"No lunar date {lunar_date} found in lunar day table")
+        return {'error': f'Không tìm thấy ngày âm lịch {lunar_date} trong dữ liệu ICS'}
+    start_date = datetime(year, max(1, month - 3), 1).date()
+    # Hết tháng mm + 2, có thể sang năm sau
+    end_date = datetime(year + (month + 2) // 12, (month + 2) % 12 + 1, 1).date() - timedelta(days=1)
+    _LOGGER.debug(f"Search range: {start_date} to {end_date}")
+    solar_dates = [d for d in all_solar_dates if start_date <= d <= end_date]
+    _LOGGER.debug(f"Solar dates for lunar {lunar_date}: {[d.strftime('%Y-%m-%d') for d in solar_dates]}")
+    if not solar_dates:
+        _LOGGER.error(f"No solar dates found for lunar {lunar_date} in range")
+        return {'error': f'Không tìm thấy ngày âm lịch {lunar_date} trong khoảng thời gian hợp lý'}
+    selected_solar_date = min(solar_dates, key=lambda d: abs((datetime(year, month, 1).date() - d).days))
+    _LOGGER.debug(f"Selected solar date: {selected_solar_date} for lunar {lunar_date_with_year}")
+    return {
+        'date': selected_solar_date.strftime('%Y-%m-%d'),
+        'is_event': ctx.is_event,
+        'is_lunar': True,
+        'is_solar': False,
+        'lunar_date': lunar_date_with_year
+    }
+
+def _resolve_day_month(match, ctx):
+    if ctx.is_lunar:
+        return _resolve_lunar_day_month(int(match.group('dm_day')), int(match.group('dm_month')), ctx)
+    return _resolve_date(match.group('dm_day'), match.group('dm_month'), None, ctx)
+
+def _resolve_month_number(match, ctx):
+    month = int(match.group('month_num'))
+    if not 1 <= month <= 12:
+        return None
+    start = ctx.today.replace(month=month, day=1)
+    return _range_result(start, _month_end(start), ctx)
+
+def _resolve_month_name(match, ctx):
+    month = _MONTH_NAMES.get(match.group('month_word').strip())
+    if month is None:
+        return None
+    start = ctx.today.replace(month=month, day=1)
+    return _range_result(start, _month_end(start), ctx)
+
+_GRAMMAR_RESOLVERS = {
+    'week_offset': _resolve_week_offset,
+    'month_offset': _resolve_month_offset,
+    'weekday': _resolve_weekday,
+    'slash_date': lambda m, ctx: _resolve_date(m.group('sd_day'), m.group('sd_month'), m.group('sd_year'), ctx),
+    'dot_date': lambda m, ctx: _resolve_date(m.group('dd_day'), m.group('dd_month'), m.group('dd_year'), ctx),
+    'day_month': _resolve_day_month,
+    'text_date': lambda m, ctx: _resolve_date(m.group('td_day'), m.group('td_month'), m.group('td_year'), ctx),
+    'month_number': _resolve_month_number,
+    'month_name': _resolve_month_name,
+    'day_offset': _resolve_day_offset,
+    'period_edge': _resolve_period_edge,
+    'lunar_day': _resolve_lunar_day,
+}
+
+# Từ vựng của bộ sửa chính tả cục bộ, lấy từ chính các bảng của ngữ pháp.
+# Cụm cố định đứng trước để 'sau' được ưu tiên hơn 'sáu' khi gõ không dấu.
+_GRAMMAR_WORDS = (
+    'sự kiện', 'âm lịch', 'dương lịch', 'ngày', 'tuần', 'tháng', 'năm', 'nữa',
+    'đầu', 'cuối', 'mùng', 'mồng', 'rằm', 'thứ', 'chủ nhật'
+)
+_CORRECTOR = FuzzyCorrector(
+    word
+    for phrase in itertools.chain(
+        _FIXED_PHRASES, _GRAMMAR_WORDS, _WEEK_MODIFIERS, _WEEKDAYS, _MONTH_NAMES,
+        _LUNAR_MONTH_NAMES, _DAY_WORDS, (key for key in _RELATIVE_OFFSETS if key)
+    )
+    for word in phrase.split()
+)
+
+def _parse_local(date_part, ctx):
+    """Phân tích cục bộ; trả về dict kết quả/lỗi, hoặc None nếu cần tới AI."""
+    fixed = _FIXED_PHRASES.get(date_part)
+    if fixed is not None:
+        _LOGGER.debug(f"Fixed phrase matched: {date_part} → {fixed}")
+        return _resolve_fixed(fixed[0], fixed[1], ctx)
+    match = _QUERY_GRAMMAR.fullmatch(date_part)
+    if match is None:
+        return None
+    _LOGGER.debug(f"Grammar matched {match.lastgroup} for: {date_part}")
+    return _GRAMMAR_RESOLVERS[match.lastgroup](match, ctx)
+
+def _parse_corrected(input_text, day_table):
+    """Thử các cách sửa chính tả cục bộ, trả về kết quả của câu sửa đầu tiên mà
+    ngữ pháp hiểu được (ưu tiên kết quả không lỗi), hoặc None."""
+    first_error = None
+    for candidate in _CORRECTOR.candidates(input_text):
+        date_part, ctx = _query_context(candidate, day_table)
+        result = _parse_local(date_part, ctx)
+        if result is None:
+            continue
+        if 'error' not in result:
+            _LOGGER.debug(f"Sửa chính tả cục bộ: '{input_text}' → '{candidate}'")
+            return result
+        if first_error is None:
+            first_error = result
+    return first_error
+
+def _query_context(input_text, day_table):
+    """Chuẩn hóa câu hỏi; trả về (phần chỉ thời gian, ngữ cảnh truy vấn)."""
     input_text = input_text.lower().strip()
     # Chuẩn hóa input để xử lý ký tự ẩn, khoảng trắng thừa
-    input_text = re.sub(r'\s+', ' ', input_text).strip()
+    input_text = _WHITESPACE.sub(' ', input_text).strip()
     is_event = 'sự kiện' in input_text.lower()
     input_text = normalize_numbers_and_days(input_text)
     input_text = normalize_weekday(input_text)
@@ -302,410 +1442,56 @@ async def parse_input(hass: HomeAssistant, input_text, is_fixed=False):
     if is_solar:
         date_part = date_part.replace('dương lịch', '').strip()
         _LOGGER.debug(f"Removed 'dương lịch', date_part: {date_part}")
+    return date_part, _QueryContext(today, is_event, is_lunar, is_solar, day_table)
 
-    week_pattern = r'^(một|hai|ba|bốn|tư|năm|sáu|bảy|\d+)\s+tuần\s+(sau|tới)$'
-    match = re.match(week_pattern, date_part)
-    if match:
-        num_str = match.group(1)
-        num_dict = {'một': 1, 'hai': 2, 'ba': 3, 'bốn': 4, 'tư': 4, 'năm': 5, 'sáu': 6, 'bảy': 7}
-        num = num_dict.get(num_str, int(num_str) if num_str.isdigit() else 0)
-        if num == 0:
-            _LOGGER.error(f"Invalid number: {num_str}")
-            return {'error': f'Số không hợp lệ: {num_str}'}
-        _LOGGER.debug(f"Week pattern matched - Number: {num}")
-        start = today - timedelta(days=today.weekday()) + timedelta(days=7 * num)
-        end = start + timedelta(days=6)
-        _LOGGER.debug(f"Week range parsed - From: {start}, To: {end}")
-        return {
-            'range': {'start': start.strftime('%Y-%m-%d'), 'end': end.strftime('%Y-%m-%d')},
-            'is_event': is_event,
-            'is_lunar': False,
-            'is_solar': True
-        }
-
-    month_pattern = r'^(một|hai|ba|bốn|tư|năm|sáu|bảy|\d+)\s+tháng\s+(sau|tới)$'
-    match = re.match(month_pattern, date_part)
-    if match:
-        num_str = match.group(1)
-        num_dict = {'một': 1, 'hai': 2, 'ba': 3, 'bốn': 4, 'tư': 4, 'năm': 5, 'sáu': 6, 'bảy': 7}
-        num = num_dict.get(num_str, int(num_str) if num_str.isdigit() else 0)
-        if num == 0:
-            _LOGGER.error(f"Invalid number: {num_str}")
-            return {'error': f'Số không hợp lệ: {num_str}'}
-        _LOGGER.debug(f"Month pattern matched - Number: {num}")
-        start = (today.replace(day=1) + timedelta(days=31 * num)).replace(day=1)
-        end = (start + timedelta(days=31)).replace(day=1) - timedelta(days=1)
-        _LOGGER.debug(f"Month range parsed - From: {start}, To: {end}")
-        return {
-            'range': {'start': start.strftime('%Y-%m-%d'), 'end': end.strftime('%Y-%m-%d')},
-            'is_event': is_event,
-            'is_lunar': False,
-            'is_solar': True
-        }
-
-    _LOGGER.debug(f"Checking exact matches for date_part: {date_part}")
-    exact_matches = {
-        'hôm nay': today,
-        'hôm này': today,
-        'ngày hôm nay': today,
-        'ngày này': today,
-        'hôm qua': today - timedelta(days=1),
-        'hôm kia': today - timedelta(days=2),
-        'ngày mai': today + timedelta(days=1),
-        'hôm sau': today + timedelta(days=1),
-        'ngày kia': today + timedelta(days=2),
-        'ngày mốt': today + timedelta(days=2),
-        'ngày này tuần sau': today + timedelta(days=7),
-        'hôm nay tuần sau': today + timedelta(days=7)
-    }
-    if date_part in exact_matches:
-        solar_date = exact_matches[date_part]
-        _LOGGER.debug(f"Exact match found - Solar date: {solar_date}")
-        if is_lunar:
-            day, month = solar_date.day, solar_date.month
-            lunar_date = f"{day:02d}/{month:02d}"
-            lunar_year = get_lunar_year(solar_date, _lunar_dates)
-            lunar_date_with_year = f"{lunar_date}/{lunar_year}"
-            _LOGGER.debug(f"Assuming solar date {solar_date} as lunar date: {lunar_date_with_year}")
-            if lunar_date in _solar_dates:
-                solar_dates = sorted(_solar_dates[lunar_date])
-                _LOGGER.debug(f"Solar dates for lunar {lunar_date}: {[d.strftime('%Y-%m-%d') for d in solar_dates]}")
-                selected_solar_date = min(solar_dates, key=lambda d: abs((datetime(lunar_year, month, day).date() - d).days))
-                _LOGGER.debug(f"Selected solar date: {selected_solar_date} for lunar {lunar_date_with_year}")
-                return {
-                    'date': selected_solar_date.strftime('%Y-%m-%d'),
-                    'is_event': is_event,
-                    'is_lunar': True,
-                    'is_solar': False,
-                    'lunar_date': lunar_date_with_year
-                }
-            else:
-                _LOGGER.error(f"No solar dates found for lunar {lunar_date}")
-                return {'error': f'Không tìm thấy ngày âm lịch {lunar_date} trong dữ liệu ICS'}
-        else:
-            return {
-                'date': solar_date.strftime('%Y-%m-%d'),
-                'is_event': is_event,
-                'is_lunar': is_lunar,
-                'is_solar': is_solar or (not is_lunar and not is_event)
-            }
-
-    _LOGGER.debug(f"Checking weekday matches for date_part: {date_part}")
-    weekday_matches = {
-        'thứ hai': 0,
-        'thứ ba': 1,
-        'thứ tư': 2,
-        'thứ năm': 3,
-        'thứ sáu': 4,
-        'thứ bảy': 5,
-        'chủ nhật': 6
-    }
-    week_modifiers = {
-        'tuần này': 0,
-        'tuần trước': -7,
-        'tuần sau': 7,
-        'tuần tới': 7
-    }
-    weekday_pattern = r'^(thứ\s*(?:hai|ba|tư|năm|sáu|bảy)|chủ nhật)(?:\s*(tuần\s*(?:này|trước|sau|tới)))?$'
-    match = re.match(weekday_pattern, date_part)
-    if match:
-        weekday_str = match.group(1).strip()
-        week_modifier_str = match.group(2) if match.group(2) else 'tuần này'
-        _LOGGER.debug(f"Weekday parsed: {weekday_str}, week modifier: {week_modifier_str}")
-        if weekday_str not in weekday_matches:
-            return {'error': f'Thứ không hợp lệ: {weekday_str}'}
-        weekday = weekday_matches[weekday_str]
-        week_offset = week_modifiers[week_modifier_str]
-        current_weekday = today.weekday()
-        days_diff = weekday - current_weekday
-        solar_date = today + timedelta(days=days_diff + week_offset)
-        _LOGGER.debug(f"Calculated solar date: {solar_date}")
-        if is_lunar:
-            day, month = solar_date.day, solar_date.month
-            lunar_date = f"{day:02d}/{month:02d}"
-            lunar_year = get_lunar_year(solar_date, _lunar_dates)
-            lunar_date_with_year = f"{lunar_date}/{lunar_year}"
-            _LOGGER.debug(f"Assuming solar date {solar_date} as lunar date: {lunar_date_with_year}")
-            if lunar_date in _solar_dates:
-                solar_dates = sorted(_solar_dates[lunar_date])
-                _LOGGER.debug(f"Solar dates for lunar {lunar_date}: {[d.strftime('%Y-%m-%d') for d in solar_dates]}")
-                selected_solar_date = min(solar_dates, key=lambda d: abs((datetime(lunar_year, month, day).date() - d).days))
-                _LOGGER.debug(f"Selected solar date: {selected_solar_date} for lunar {lunar_date_with_year}")
-                return {
-                    'date': selected_solar_date.strftime('%Y-%m-%d'),
-                    'is_event': is_event,
-                    'is_lunar': True,
-                    'is_solar': False,
-                    'lunar_date': lunar_date_with_year
-                }
-            else:
-                _LOGGER.error(f"No solar dates found for lunar {lunar_date}")
-                return {'error': f'Không tìm thấy ngày âm lịch {lunar_date} trong dữ liệu ICS'}
-        else:
-            return {
-                'date': solar_date.strftime('%Y-%m-%d'),
-                'is_event': is_event,
-                'is_lunar': is_lunar,
-                'is_solar': is_solar or (not is_lunar and not is_event)
-            }
-
-    if is_lunar:
-        _LOGGER.debug(f"Processing lunar input: {date_part}")
-        lunar_pattern = r'^(\d{1,2})[/-](\d{1,2})$'
-        match = re.match(lunar_pattern, date_part)
-        if match:
-            day, month = map(int, match.groups()[:2])
-            year = today.year
-            lunar_date = f"{day:02d}/{month:02d}"
-            lunar_date_with_year = f"{lunar_date}/{year}"
-            _LOGGER.debug(f"Lunar input parsed: day={day}, month={month}, year={year}, normalized={lunar_date_with_year}")
-            if lunar_date in _solar_dates:
-                start_date = datetime(year, max(1, month - 3), 1).date()
-                end_date = datetime(year, month + 3, 1).date() - timedelta(days=1)
-                _LOGGER.debug(f"Search range: {start_date} to {end_date}")
-                solar_dates = sorted([d for d in _solar_dates[lunar_date] if start_date <= d <= end_date])
-                _LOGGER.debug(f"Solar dates for lunar {lunar_date}: {[d.strftime('%Y-%m-%d') for d in solar_dates]}")
-                if solar_dates:
-                    selected_solar_date = min(solar_dates, key=lambda d: abs((datetime(year, month, 1).date() - d).days))
-                    _LOGGER.debug(f"Selected solar date: {selected_solar_date} for lunar {lunar_date_with_year}")
-                    return {
-                        'date': selected_solar_date.strftime('%Y-%m-%d'),
-                        'is_event': is_event,
-                        'is_lunar': True,
-                        'is_solar': False,
-                        'lunar_date': lunar_date_with_year
-                    }
-                else:
-                    _LOGGER.error(f"No solar dates found for lunar {lunar_date} in range")
-                    return {'error': f'Không tìm thấy ngày âm lịch {lunar_date} trong khoảng thời gian hợp lý'}
-            else:
-                _LOGGER.error(f"No lunar date {lunar_date} found in _solar_dates")
-                return {'error': f'Không tìm thấy ngày âm lịch {lunar_date} trong dữ liệu ICS'}
-
-    if date_part == 'ngày này tháng sau':
-        solar_date = (today + timedelta(days=31)).replace(day=today.day)
-        _LOGGER.debug(f"Parsed 'ngày này tháng sau' - Date: {solar_date}")
-        if is_lunar:
-            day, month = solar_date.day, solar_date.month
-            lunar_date = f"{day:02d}/{month:02d}"
-            lunar_year = get_lunar_year(solar_date, _lunar_dates)
-            lunar_date_with_year = f"{lunar_date}/{lunar_year}"
-            _LOGGER.debug(f"Assuming solar date {solar_date} as lunar date: {lunar_date_with_year}")
-            if lunar_date in _solar_dates:
-                solar_dates = sorted(_solar_dates[lunar_date])
-                _LOGGER.debug(f"Solar dates for lunar {lunar_date}: {[d.strftime('%Y-%m-%d') for d in solar_dates]}")
-                selected_solar_date = min(solar_dates, key=lambda d: abs((datetime(lunar_year, month, day).date() - d).days))
-                _LOGGER.debug(f"Selected solar date: {selected_solar_date} for lunar {lunar_date_with_year}")
-                return {
-                    'date': selected_solar_date.strftime('%Y-%m-%d'),
-                    'is_event': is_event,
-                    'is_lunar': True,
-                    'is_solar': False,
-                    'lunar_date': lunar_date_with_year
-                }
-            else:
-                _LOGGER.error(f"No solar dates found for lunar {lunar_date}")
-                return {'error': f'Không tìm thấy ngày âm lịch {lunar_date} trong dữ liệu ICS'}
-        else:
-            return {
-                'date': solar_date.strftime('%Y-%m-%d'),
-                'is_event': is_event,
-                'is_lunar': is_lunar,
-                'is_solar': is_solar or (not is_lunar and not is_event)
-            }
-
-    _LOGGER.debug(f"Checking date patterns for: {date_part}")
-    date_patterns = [
-        r'^(\d{1,2})[/-](\d{1,2})[/-](\d{2,4})$',
-        r'^(\d{1,2})\.(\d{1,2})\.(\d{2,4})$',
-        r'^(\d{1,2})[/-](\d{1,2})$',
-    ]
-    for pattern in date_patterns:
-        match = re.match(pattern, date_part)
-        if match:
-            day, month = map(int, match.groups()[:2])
-            year = int(match.groups()[2]) if len(match.groups()) > 2 else today.year
-            if len(str(year)) == 2:
-                year = 2000 + year
-            _LOGGER.debug(f"Date pattern matched - Day: {day}, Month: {month}, Year: {year}")
-            try:
-                solar_date = datetime(year, month, day).date()
-                _LOGGER.debug(f"Parsed date: {solar_date}")
-                if is_lunar:
-                    day, month = solar_date.day, solar_date.month
-                    lunar_date = f"{day:02d}/{month:02d}"
-                    lunar_year = get_lunar_year(solar_date, _lunar_dates)
-                    lunar_date_with_year = f"{lunar_date}/{lunar_year}"
-                    _LOGGER.debug(f"Assuming solar date {solar_date} as lunar date: {lunar_date_with_year}")
-                    if lunar_date in _solar_dates:
-                        solar_dates = sorted(_solar_dates[lunar_date])
-                        _LOGGER.debug(f"Solar dates for lunar {lunar_date}: {[d.strftime('%Y-%m-%d') for d in solar_dates]}")
-                        selected_solar_date = min(solar_dates, key=lambda d: abs((datetime(lunar_year, month, day).date() - d).days))
-                        _LOGGER.debug(f"Selected solar date: {selected_solar_date} for lunar {lunar_date_with_year}")
-                        return {
-                            'date': selected_solar_date.strftime('%Y-%m-%d'),
-                            'is_event': is_event,
-                            'is_lunar': True,
-                            'is_solar': False,
-                            'lunar_date': lunar_date_with_year
-                        }
-                    else:
-                        _LOGGER.error(f"No solar dates found for lunar {lunar_date}")
-                        return {'error': f'Không tìm thấy ngày âm lịch {lunar_date} trong dữ liệu ICS'}
-                else:
-                    return {
-                        'date': solar_date.strftime('%Y-%m-%d'),
-                        'is_event': is_event,
-                        'is_lunar': is_lunar,
-                        'is_solar': is_solar or (not is_lunar and not is_event)
-                    }
-            except ValueError:
-                _LOGGER.debug(f"Invalid date: {day}/{month}/{year}")
-                pass
-
-    _LOGGER.debug(f"Checking text pattern for: {date_part}")
-    text_pattern = r'^(?:ngày\s+)?(\d{1,2})\s+tháng\s+(\d{1,2})(?:\s+năm\s+(\d{2,4}))?$'
-    match = re.match(text_pattern, date_part)
-    if match:
-        day, month = map(int, match.groups()[:2])
-        year = int(match.groups()[2]) if match.groups()[2] else today.year
-        if len(str(year)) == 2:
-            year = 2000 + year
-        _LOGGER.debug(f"Text pattern matched - Day: {day}, Month: {month}, Year: {year}")
-        try:
-            solar_date = datetime(year, month, day).date()
-            _LOGGER.debug(f"Parsed date: {solar_date}")
-            if is_lunar:
-                day, month = solar_date.day, solar_date.month
-                lunar_date = f"{day:02d}/{month:02d}"
-                lunar_year = get_lunar_year(solar_date, _lunar_dates)
-                lunar_date_with_year = f"{lunar_date}/{lunar_year}"
-                _LOGGER.debug(f"Assuming solar date {solar_date} as lunar date: {lunar_date_with_year}")
-                if lunar_date in _solar_dates:
-                    solar_dates = sorted(_solar_dates[lunar_date])
-                    _LOGGER.debug(f"Solar dates for lunar {lunar_date}: {[d.strftime('%Y-%m-%d') for d in solar_dates]}")
-                    selected_solar_date = min(solar_dates, key=lambda d: abs((datetime(lunar_year, month, day).date() - d).days))
-                    _LOGGER.debug(f"Selected solar date: {selected_solar_date} for lunar {lunar_date_with_year}")
-                    return {
-                        'date': selected_solar_date.strftime('%Y-%m-%d'),
-                        'is_event': is_event,
-                        'is_lunar': True,
-                        'is_solar': False,
-                        'lunar_date': lunar_date_with_year
-                    }
-                else:
-                    _LOGGER.error(f"No solar dates found for lunar {lunar_date}")
-                    return {'error': f'Không tìm thấy ngày âm lịch {lunar_date} trong dữ liệu ICS'}
-            else:
-                return {
-                    'date': solar_date.strftime('%Y-%m-%d'),
-                    'is_event': is_event,
-                    'is_lunar': is_lunar,
-                    'is_solar': is_solar or (not is_lunar and not is_event)
-                }
-        except ValueError:
-            _LOGGER.debug(f"Invalid date: {day}/{month}/{year}")
-            pass
-
-    _LOGGER.debug(f"Checking month names for: {date_part}")
-    month_names = {
-        'một': 1, 'hai': 2, 'ba': 3, 'bốn': 4, 'tư': 4, 'năm': 5, 'sáu': 6,
-        'bảy': 7, 'tám': 8, 'chín': 9, 'mười': 10, 'mười một': 11, 'mười hai': 12
-    }
-    month_pattern = r'^tháng\s+(.+)$'
-    match = re.match(month_pattern, date_part)
-    if match:
-        month_name = match.group(1).strip()
-        for name, num in month_names.items():
-            if name == month_name:
-                month = num
-                start = today.replace(month=month, day=1)
-                end = (start + timedelta(days=31)).replace(day=1) - timedelta(days=1)
-                _LOGGER.debug(f"Month parsed - Month: {month}, Range: {start} to {end}")
-                return {
-                    'range': {'start': start.strftime('%Y-%m-%d'), 'end': end.strftime('%Y-%m-%d')},
-                    'is_event': is_event,
-                    'is_lunar': is_lunar,
-                    'is_solar': is_solar or (not is_lunar and not is_event)
-                }
-
-    _LOGGER.debug(f"Checking month number pattern for: {date_part}")
-    month_num_pattern = r'^tháng\s+(\d{1,2})$'
-    match = re.match(month_num_pattern, date_part)
-    if match:
-        month = int(match.group(1))
-        if 1 <= month <= 12:
-            start = today.replace(month=month, day=1)
-            end = (start + timedelta(days=31)).replace(day=1) - timedelta(days=1)
-            _LOGGER.debug(f"Month number parsed - Month: {month}, Range: {start} to {end}")
-            return {
-                'range': {'start': start.strftime('%Y-%m-%d'), 'end': end.strftime('%Y-%m-%d')},
-                'is_event': is_event,
-                'is_lunar': is_lunar,
-                'is_solar': is_solar or (not is_lunar and not is_event)
-            }
+def _gemini_result(analysis, ctx):
+    """Kết hợp ngày/khoảng Gemini trả về với các cờ của câu hỏi."""
+    result = {key: analysis[key] for key in ('date', 'range', 'error') if key in analysis}
+    if 'date' in result and ctx.is_lunar:
+        solar_date = datetime.strptime(result['date'], '%Y-%m-%d').date()
+        return _lunar_day_result(solar_date, ctx)
+    result.update({
+        'is_event': ctx.is_event,
+        'is_lunar': ctx.is_lunar,
+        'is_solar': ctx.is_solar or (not ctx.is_lunar and not ctx.is_event)
+    })
+    return result
 
-    _LOGGER.debug(f"Checking range matches for: {date_part}")
-    exact_range_matches = {
-        'tuần này': (today - timedelta(days=today.weekday()), 6),
-        'tuần trước': (today - timedelta(days=today.weekday() + 7), 6),
-        'tuần sau': (today - timedelta(days=today.weekday()) + timedelta(days=7), 6),
-        'tuần tới': (today - timedelta(days=today.weekday()) + timedelta(days=7), 6),
-        'tháng này': (today.replace(day=1), None),
-        'tháng sau': ((today.replace(day=1) + timedelta(days=31)).replace(day=1), None),
-        'tháng tới': ((today.replace(day=1) + timedelta(days=31)).replace(day=1), None)
-    }
-    for key, (start, days) in exact_range_matches.items():
-        if date_part == key:
-            if days:
-                end = start + timedelta(days=days)
-            else:
-                end = (start + timedelta(days=31)).replace(day=1) - timedelta(days=1)
-            _LOGGER.debug(f"Range match parsed - From: {start}, To: {end}")
-            return {
-                'range': {'start': start.strftime('%Y-%m-%d'), 'end': end.strftime('%Y-%m-%d')},
-                'is_event': is_event,
-                'is_lunar': is_lunar,
-                'is_solar': is_solar or (not is_lunar and not is_event)
-            }
+async def parse_input(hass: HomeAssistant, input_text, is_fixed=False, data=None, use_humor=False, offline=False):
+    """Phân tích câu hỏi thành ngày hoặc khoảng ngày.
 
+    Câu không khớp ngữ pháp cục bộ được gửi tới Gemini đúng một lần; câu đã
+    sửa chính tả được thử lại với ngữ pháp cục bộ trước khi dùng ngày do
+    Gemini đưa ra. Khi use_humor bật, kết quả có thêm 'humor_template'.
+    offline=True thì không gọi Gemini.
+    """
+    _LOGGER.debug(f"Parsing input: {input_text}, is_fixed={is_fixed}")
+    if data is None:
+        data = _data
+    date_part, ctx = _query_context(input_text, data.day_table)
+    result = await _run_on_loop(hass, data.day_table, _parse_local, date_part, ctx)
+    if result is not None:
+        return result
     if not is_fixed:
-        _LOGGER.debug(f"Local parse failed, trying to fix spelling for: {original_input}")
-        fixed_input = await fix_spelling(hass, original_input)
-        if fixed_input.lower() != original_input.lower():
-            _LOGGER.debug(f"Retrying parse with fixed input: {fixed_input}")
-            return await parse_input(hass, fixed_input, is_fixed=True)
-
-    _LOGGER.debug(f"Local parse failed after fix, falling back to Gemini for: {date_part}")
-    gemini_result = await parse_with_gemini(hass, date_part)
-    gemini_result.update({
-        'is_event': is_event,
-        'is_lunar': is_lunar,
-        'is_solar': is_solar or (not is_lunar and not is_event)
-    })
-    if 'date' in gemini_result and is_lunar:
-        solar_date = datetime.strptime(gemini_result['date'], '%Y-%m-%d').date()
-        day, month = solar_date.day, solar_date.month
-        lunar_date = f"{day:02d}/{month:02d}"
-        lunar_year = get_lunar_year(solar_date, _lunar_dates)
-        lunar_date_with_year = f"{lunar_date}/{lunar_year}"
-        _LOGGER.debug(f"Assuming solar date {solar_date} as lunar date: {lunar_date_with_year}")
-        if lunar_date in _solar_dates:
-            solar_dates = sorted(_solar_dates[lunar_date])
-            _LOGGER.debug(f"Solar dates for lunar {lunar_date}: {[d.strftime('%Y-%m-%d') for d in solar_dates]}")
-            selected_solar_date = min(solar_dates, key=lambda d: abs((datetime(lunar_year, month, day).date() - d).days))
-            _LOGGER.debug(f"Selected solar date: {selected_solar_date} for lunar {lunar_date_with_year}")
-            return {
-                'date': selected_solar_date.strftime('%Y-%m-%d'),
-                'is_event': is_event,
-                'is_lunar': True,
-                'is_solar': False,
-                'lunar_date': lunar_date_with_year
-            }
-        else:
-            _LOGGER.error(f"No solar dates found for lunar {lunar_date}")
-            return {'error': f'Không tìm thấy ngày âm lịch {lunar_date} trong dữ liệu ICS'}
-    return gemini_result
+        result = await _run_on_loop(hass, data.day_table, _parse_corrected, input_text, data.day_table)
+        if result is not None:
+            return result
+    if offline:
+        return {'error': UNPARSED_MESSAGE}
+
+    _LOGGER.debug(f"Local parse failed, asking Gemini once for: {input_text}")
+    analysis = await analyze_with_gemini(hass, input_text, use_humor)
+    corrected = analysis.get('corrected')
+    if not is_fixed and isinstance(corrected, str) and corrected.strip() \
+            and corrected.lower() != input_text.lower():
+        _LOGGER.debug(f"Retrying local parse with corrected input: {corrected}")
+        date_part, ctx = _query_context(corrected, data.day_table)
+        result = await _run_on_loop(hass, data.day_table, _parse_local, date_part, ctx)
+    if result is None:
+        result = await _run_on_loop(hass, data.day_table, _gemini_result, analysis, ctx)
+    if use_humor and analysis.get('humor_template'):
+        result['humor_template'] = analysis['humor_template']
+    return result
 
 async def generate_humorous_output(hass: HomeAssistant, original_output, use_humor=True):
     if not use_humor:
@@ -713,10 +1499,6 @@ async def generate_humorous_output(hass: HomeAssistant, original_output, use_hum
     if not GEMINI_API_KEY:
         _LOGGER.error("Không có Gemini API key được cấu hình")
         return original_output
-    headers = {
-        "Content-Type": "application/json",
-        "x-goog-api-key": GEMINI_API_KEY
-    }
     prompt = f"""Hãy viết lại đoạn văn sau với giọng điệu hài hước, dí dỏm,theo trend mới nhất, nhưng phải ngắn gọn và giữ nguyên thông tin chính xác:
 '{original_output}'"""
     
@@ -729,35 +1511,128 @@ async def generate_humorous_output(hass: HomeAssistant, original_output, use_hum
         }
     }
     
-    def make_request():
-        try:
-            response = requests.post(GEMINI_API_URL, headers=headers, json=data)
-            if response.status_code == 200:
-                humorous_text = response.json()['candidates'][0]['content']['parts'][0]['text']
-                _LOGGER.debug(f"Humorous output generated: {humorous_text}")
-                return humorous_text
-            else:
-                _LOGGER.error(f"Lỗi Gemini API (hài hước): {response.status_code} - {response.text}")
-                return original_output
-        except Exception as e:
-            _LOGGER.error(f"Lỗi tạo output hài hước: {str(e)}")
+    cached = await hass.async_add_executor_job(_cache_get, 'humor', original_output)
+    if cached is not None:
+        _LOGGER.debug(f"Humorous output from cache: {cached}")
+        return cached
+    try:
+        status, body = await _post_gemini(hass, data)
+        if status == 200:
+            humorous_text = body['candidates'][0]['content']['parts'][0]['text']
+            _LOGGER.debug(f"Humorous output generated: {humorous_text}")
+            await hass.async_add_executor_job(_cache_put, 'humor', humorous_text, original_output)
+            return humorous_text
+        else:
+            _LOGGER.error(f"Lỗi Gemini API (hài hước): {status} - {body}")
             return original_output
+    except GeminiUnavailable as e:
+        _LOGGER.debug(str(e))
+        return original_output
+    except Exception as e:
+        _LOGGER.error(f"Lỗi tạo output hài hước: {str(e) or type(e).__name__}")
+        return original_output
+
+# Kết quả query_date gần đây. Khóa gồm ngày hiện tại và phiên bản dữ liệu nên
+# sang ngày mới hoặc nạp lại ICS thì các kết quả cũ tự hết hiệu lực.
+QUERY_CACHE_SIZE = 64
+_query_cache = OrderedDict()
+_query_cache_stamp = None
+# Các truy vấn đang chạy, để yêu cầu giống hệt dùng chung một lần tính
+_inflight_queries = {}
 
-    return await hass.async_add_executor_job(make_request)
+def invalidate_query_cache():
+    """Xóa toàn bộ kết quả query_date đã nhớ."""
+    global _query_cache_stamp
+    _query_cache.clear()
+    _query_cache_stamp = None
+
+async def _run_query(hass: HomeAssistant, key, query, use_humor, data):
+    global _budget_exceeded
+    degraded = False
+    try:
+        try:
+            result = await asyncio.wait_for(
+                _query_date_uncached(hass, query, use_humor, data), QUERY_BUDGET_SECONDS
+            )
+        except asyncio.TimeoutError:
+            _budget_exceeded += 1
+            degraded = True
+            _LOGGER.warning(
+                f"Truy vấn '{query}' quá {QUERY_BUDGET_SECONDS}s, trả lời bằng phân tích cục bộ"
+            )
+            result = await _query_date_uncached(hass, query, False, data, offline=True)
+    finally:
+        entry = _inflight_queries.get(key)
+        if entry is not None and entry[0] is asyncio.current_task():
+            del _inflight_queries[key]
+    # Chỉ nhớ kết quả thành công và đầy đủ; lỗi mạng, lỗi phân tích hay câu trả
+    # lời thiếu phần hài hước vì quá hạn được thử lại lần sau
+    if not degraded and _query_cache_stamp == key[:2] and ('date' in result or 'range' in result):
+        _query_cache[key] = result
+        while len(_query_cache) > QUERY_CACHE_SIZE:
+            _query_cache.popitem(last=False)
+    return result
 
 async def query_date(hass: HomeAssistant, query, use_humor=None):
+    """Tra cứu một câu hỏi; kết quả giống nhau trong ngày được dùng lại.
+
+    Các lời gọi đồng thời với cùng (câu hỏi, use_humor) chờ chung một task.
+    Quá QUERY_BUDGET_SECONDS thì trả lời bằng phân tích cục bộ, không hài hước.
+    """
+    global _query_cache_stamp
     # Nếu use_humor=None thì tự lấy trạng thái switch.use_humor
     if use_humor is None:
         humor_entity = hass.states.get("switch.use_humor")
         use_humor = humor_entity and humor_entity.state == "on"
+    use_humor = bool(use_humor)
+    data = _data
+    stamp = (datetime.now().date(), data.version)
+    if stamp != _query_cache_stamp:
+        _query_cache.clear()
+        _query_cache_stamp = stamp
+    key = stamp + (_WHITESPACE.sub(' ', query.lower()).strip(), use_humor)
+    cached = _query_cache.get(key)
+    if cached is not None:
+        _query_cache.move_to_end(key)
+        _LOGGER.debug(f"Kết quả đã nhớ cho: {query}, use_humor={use_humor}")
+        # Bản sao sâu: danh sách 'events' bên trong không được dùng chung với bộ nhớ
+        return copy.deepcopy(cached)
+    entry = _inflight_queries.get(key)
+    if entry is None:
+        # [task, số người đang chờ]
+        entry = [hass.async_create_task(_run_query(hass, key, query, use_humor, data)), 0]
+        _inflight_queries[key] = entry
+    else:
+        _LOGGER.debug(f"Dùng chung truy vấn đang chạy cho: {query}")
+    entry[1] += 1
+    try:
+        # shield: người gọi bị hủy không làm hủy lần tính mà người khác đang chờ
+        return copy.deepcopy(await asyncio.shield(entry[0]))
+    except asyncio.CancelledError:
+        # Người chờ cuối cùng bị hủy thì hủy luôn lần tính và yêu cầu HTTP của nó
+        if entry[1] == 1 and not entry[0].done():
+            entry[0].cancel()
+        raise
+    finally:
+        entry[1] -= 1
+
+async def _query_date_uncached(hass: HomeAssistant, query, use_humor, data, offline=False):
     _LOGGER.debug(f"Querying date for: {query}, use_humor={use_humor}")
     try:
-        parsed = await parse_input(hass, query)
+        parsed = await parse_input(hass, query, data=data, use_humor=use_humor, offline=offline)
         _LOGGER.debug(f"Parsed result: {parsed}")
+        humor_template = parsed.pop('humor_template', None) if parsed else None
+
+        async def render(original_output):
+            # Đã có mẫu hài hước từ lần gọi Gemini gộp thì không gọi thêm lần nữa
+            if humor_template:
+                return fill_humor_template(humor_template, original_output)
+            return await generate_humorous_output(hass, original_output, use_humor)
+
         if not parsed or 'error' in parsed:
-            original_output = parsed.get('error', "Không thể phân tích input. Vui lòng thử lại!")
+            original_output = parsed.get('error', UNPARSED_MESSAGE)
             _LOGGER.debug(f"Parse error: {original_output}")
-            return {"output": await generate_humorous_output(hass, original_output, use_humor)}
+            return {"output": await render(original_output)}
 
         result = {}
         is_event = parsed.get('is_event', False)
@@ -773,7 +1648,7 @@ async def query_date(hass: HomeAssistant, query, use_humor=None):
                 if is_lunar:
                     _LOGGER.debug(f"Processing lunar date: {lunar_date} for solar {date}")
                     if is_event:
-                        event_list = _events.get(date, [])
+                        event_list = data.event_index.on(date)
                         _LOGGER.debug(f"Events for {date}: {event_list}")
                         if event_list:
                             events_str = ', '.join(event_list)
@@ -786,25 +1661,19 @@ async def query_date(hass: HomeAssistant, query, use_humor=None):
                     result = {
                         'date': date.strftime('%Y-%m-%d'),
                         'lunar_date': lunar_date,
-                        'events': _events.get(date, []),
+                        'events': data.event_index.on(date),
                         'is_lunar': True,
                         'is_solar': False,
                         'is_event': is_event,
-                        'output': await generate_humorous_output(hass, original_output, use_humor)
+                        'output': await render(original_output)
                     }
                 else:
-                    actual_lunar_date = _lunar_dates.get(date, 'Không có dữ liệu âm lịch')
-                    if actual_lunar_date != 'Không có dữ liệu âm lịch':
-                        try:
-                            day, month = map(int, actual_lunar_date.split('/'))
-                            lunar_year = get_lunar_year(date, _lunar_dates)
-                            actual_lunar_date = f"{day:02d}/{month:02d}/{lunar_year}"
-                        except ValueError:
-                            _LOGGER.error(f"Invalid lunar date format: {actual_lunar_date}")
-                            actual_lunar_date = 'Dữ liệu âm lịch không hợp lệ'
+                    actual_lunar_date = format_lunar_date(
+                        await _run_on_loop(hass, data.day_table, lunar_from_solar, date, data.day_table)
+                    )
                     _LOGGER.debug(f"Processing solar date: {date}, lunar: {actual_lunar_date}")
                     if is_event:
-                        event_list = _events.get(date, [])
+                        event_list = data.event_index.on(date)
                         _LOGGER.debug(f"Events for {date}: {event_list}")
                         if event_list:
                             events_str = ', '.join(event_list)
@@ -817,35 +1686,24 @@ async def query_date(hass: HomeAssistant, query, use_humor=None):
                     result = {
                         'date': date.strftime('%Y-%m-%d'),
                         'lunar_date': actual_lunar_date,
-                        'events': _events.get(date, []),
+                        'events': data.event_index.on(date),
                         'is_lunar': False,
                         'is_solar': is_solar or (not is_lunar and not is_event),
                         'is_event': is_event,
-                        'output': await generate_humorous_output(hass, original_output, use_humor)
+                        'output': await render(original_output)
                     }
             except (ValueError, TypeError) as e:
                 _LOGGER.debug(f"Error processing date: {e}")
                 original_output = "Ngày không hợp lệ. Vui lòng kiểm tra lại!"
-                return {"output": await generate_humorous_output(hass, original_output, use_humor)}
+                return {"output": await render(original_output)}
         elif 'range' in parsed:
             start = datetime.strptime(parsed['range']['start'], '%Y-%m-%d').date()
             end = datetime.strptime(parsed['range']['end'], '%Y-%m-%d').date()
             _LOGGER.debug(f"Processing range: {start} to {end}")
             event_list = []
-            for d in (start + timedelta(n) for n in range((end - start).days + 1)):
-                if d in _events:
-                    for evt in _events[d]:
-                        actual_lunar_date = _lunar_dates.get(d, 'Không có dữ liệu âm lịch')
-                        if actual_lunar_date != 'Không có dữ liệu âm lịch':
-                            try:
-                                day, month = map(int, actual_lunar_date.split('/'))
-                                lunar_year = get_lunar_year(d, _lunar_dates)
-                                actual_lunar_date = f"{day:02d}/{month:02d}/{lunar_year}"
-                            except ValueError:
-                                _LOGGER.error(f"Invalid lunar date format: {actual_lunar_date}")
-                                actual_lunar_date = 'Dữ liệu âm lịch không hợp lệ'
-                        event_list.append(f"Ngày {d.strftime('%d/%m/%Y')} ({actual_lunar_date} âm lịch) là {evt}")
-                        _LOGGER.debug(f"Event found for {d}: {evt}")
+            for d, evt, actual_lunar_date in data.event_index.between(start, end):
+                event_list.append(f"Ngày {d.strftime('%d/%m/%Y')} ({actual_lunar_date} âm lịch) là {evt}")
+                _LOGGER.debug(f"Event found for {d}: {evt}")
             if is_event:
                 if event_list:
                     original_output = f"Trong khoảng từ {start.strftime('%d/%m/%Y')} đến {end.strftime('%d/%m/%Y')} có {len(event_list)} sự kiện:\n" + '\n'.join(event_list)
@@ -860,7 +1718,7 @@ async def query_date(hass: HomeAssistant, query, use_humor=None):
                 'is_lunar': is_lunar,
                 'is_solar': is_solar or (not is_lunar and not is_event),
                 'is_event': is_event,
-                'output': await generate_humorous_output(hass, original_output, use_humor)
+                'output': await render(original_output)
             }
         _LOGGER.debug(f"Final result: {result}")
         return result
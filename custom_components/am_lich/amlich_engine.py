@@ -0,0 +1,215 @@
+"""
+Bộ tính âm lịch Việt Nam theo thiên văn (thuật toán của Hồ Ngọc Đức).
+Tính ngày Sóc và Trung khí theo kinh tuyến múi giờ UTC+7, dùng chung cho
+amlich_core, cảm biến sự kiện và lịch, không cần file ICS hay lunarcalendar.
+"""
+import math
+from datetime import date
+from functools import lru_cache
+
+TIMEZONE = 7
+MIN_YEAR = 1800
+MAX_YEAR = 2200
+
+# Chênh lệch giữa số ngày Julius (JDN) và date.toordinal()
+JDN_OFFSET = 1721425
+_SYNODIC_MONTH = 29.530588853
+_K_EPOCH = 2415021.076998695
+
+
+def jd_from_date(solar_date):
+    return solar_date.toordinal() + JDN_OFFSET
+
+
+def jd_to_date(jd):
+    return date.fromordinal(jd - JDN_OFFSET)
+
+
+def _new_moon(k):
+    """Thời điểm (JD) của lần Sóc thứ k tính từ 1/1/1900."""
+    t = k / 1236.85
+    t2 = t * t
+    t3 = t2 * t
+    dr = math.pi / 180
+    jd1 = 2415020.75933 + 29.53058868 * k + 0.0001178 * t2 - 0.000000155 * t3
+    jd1 += 0.00033 * math.sin((166.56 + 132.87 * t - 0.009173 * t2) * dr)
+    m = 359.2242 + 29.10535608 * k - 0.0000333 * t2 - 0.00000347 * t3
+    mpr = 306.0253 + 385.81691806 * k + 0.0107306 * t2 + 0.00001236 * t3
+    f = 21.2964 + 390.67050646 * k - 0.0016528 * t2 - 0.00000239 * t3
+    c1 = (0.1734 - 0.000393 * t) * math.sin(m * dr) + 0.0021 * math.sin(2 * dr * m)
+    c1 = c1 - 0.4068 * math.sin(mpr * dr) + 0.0161 * math.sin(dr * 2 * mpr)
+    c1 = c1 - 0.0004 * math.sin(dr * 3 * mpr)
+    c1 = c1 + 0.0104 * math.sin(dr * 2 * f) - 0.0051 * math.sin(dr * (m + mpr))
+    c1 = c1 - 0.0074 * math.sin(dr * (m - mpr)) + 0.0004 * math.sin(dr * (2 * f + m))
+    c1 = c1 - 0.0004 * math.sin(dr * (2 * f - m)) - 0.0006 * math.sin(dr * (2 * f + mpr))
+    c1 = c1 + 0.0010 * math.sin(dr * (2 * f - mpr)) + 0.0005 * math.sin(dr * (2 * mpr + m))
+    if t < -11:
+        deltat = 0.001 + 0.000839 * t + 0.0002261 * t2 - 0.00000845 * t3 - 0.000000081 * t * t3
+    else:
+        deltat = -0.000278 + 0.000265 * t + 0.000262 * t2
+    return jd1 + c1 - deltat
+
+
+def _sun_longitude(jdn):
+    """Kinh độ mặt trời (radian, 0..2π) tại thời điểm jdn."""
+    t = (jdn - 2451545.0) / 36525
+    t2 = t * t
+    dr = math.pi / 180
+    m = 357.52910 + 35999.05030 * t - 0.0001559 * t2 - 0.00000048 * t * t2
+    l0 = 280.46645 + 36000.76983 * t + 0.0003032 * t2
+    dl = (1.914600 - 0.004817 * t - 0.000014 * t2) * math.sin(dr * m)
+    dl += (0.019993 - 0.000101 * t) * math.sin(dr * 2 * m) + 0.000290 * math.sin(dr * 3 * m)
+    lon = (l0 + dl) * dr
+    return lon - math.pi * 2 * math.floor(lon / (math.pi * 2))
+
+
+def _sun_longitude_sector(day_number):
+    """Cung Trung khí (0..11) của mặt trời lúc nửa đêm giờ địa phương."""
+    return int(_sun_longitude(day_number - 0.5 - TIMEZONE / 24) / math.pi * 6)
+
+
+@lru_cache(maxsize=4096)
+def new_moon_day(k):
+    """JDN của ngày Sóc thứ k theo giờ UTC+7."""
+    return math.floor(_new_moon(k) + 0.5 + TIMEZONE / 24)
+
+
+@lru_cache(maxsize=512)
+def _lunar_month_11(year):
+    """JDN ngày bắt đầu tháng 11 âm lịch (tháng chứa Đông chí) của năm year."""
+    off = jd_from_date(date(year, 12, 31)) - 2415021
+    k = math.floor(off / _SYNODIC_MONTH)
+    nm = new_moon_day(k)
+    if _sun_longitude_sector(nm) >= 9:
+        nm = new_moon_day(k - 1)
+    return nm
+
+
+@lru_cache(maxsize=512)
+def _leap_month_offset(a11):
+    """Vị trí tháng nhuận (tính từ tháng 11) trong năm có 13 tháng."""
+    k = math.floor((a11 - _K_EPOCH) / _SYNODIC_MONTH + 0.5)
+    i = 1
+    arc = _sun_longitude_sector(new_moon_day(k + i))
+    while True:
+        last = arc
+        i += 1
+        arc = _sun_longitude_sector(new_moon_day(k + i))
+        if arc == last or i >= 14:
+            break
+    return i - 1
+
+
+def _check_year(year):
+    # Năm âm lịch có thể lệch một năm so với năm dương ở hai đầu phạm vi
+    if not MIN_YEAR - 1 <= year <= MAX_YEAR:
+        raise ValueError(f"Năm {year} ngoài phạm vi hỗ trợ {MIN_YEAR}-{MAX_YEAR}")
+
+
+def solar_to_lunar(solar_date):
+    """Đổi ngày dương lịch sang (ngày, tháng, năm, nhuận) âm lịch."""
+    if not MIN_YEAR <= solar_date.year <= MAX_YEAR:
+        raise ValueError(f"Năm {solar_date.year} ngoài phạm vi hỗ trợ {MIN_YEAR}-{MAX_YEAR}")
+    day_number = jd_from_date(solar_date)
+    k = math.floor((day_number - _K_EPOCH) / _SYNODIC_MONTH)
+    month_start = new_moon_day(k + 1)
+    while month_start > day_number:
+        month_start = new_moon_day(k)
+        k -= 1
+    yy = solar_date.year
+    a11 = _lunar_month_11(yy)
+    b11 = a11
+    if a11 >= month_start:
+        lunar_year = yy
+        a11 = _lunar_month_11(yy - 1)
+    else:
+        lunar_year = yy + 1
+        b11 = _lunar_month_11(yy + 1)
+    lunar_day = day_number - month_start + 1
+    diff = math.floor((month_start - a11) / 29)
+    lunar_leap = False
+    lunar_month = diff + 11
+    if b11 - a11 > 365:
+        leap_month_diff = _leap_month_offset(a11)
+        if diff >= leap_month_diff:
+            lunar_month = diff + 10
+            if diff == leap_month_diff:
+                lunar_leap = True
+    if lunar_month > 12:
+        lunar_month -= 12
+    if lunar_month >= 11 and diff < 4:
+        lunar_year -= 1
+    return lunar_day, lunar_month, lunar_year, lunar_leap
+
+
+def _lunar_month_start(month, year, leap=False):
+    """JDN ngày mùng 1 của tháng âm lịch, hoặc None nếu năm không có tháng nhuận đó."""
+    _check_year(year)
+    if month < 11:
+        a11 = _lunar_month_11(year - 1)
+        b11 = _lunar_month_11(year)
+    else:
+        a11 = _lunar_month_11(year)
+        b11 = _lunar_month_11(year + 1)
+    k = math.floor(0.5 + (a11 - _K_EPOCH) / _SYNODIC_MONTH)
+    off = month - 11
+    if off < 0:
+        off += 12
+    if b11 - a11 > 365:
+        leap_off = _leap_month_offset(a11)
+        leap_month = leap_off - 2
+        if leap_month < 0:
+            leap_month += 12
+        if leap and month != leap_month:
+            return None
+        if leap or off >= leap_off:
+            off += 1
+    elif leap:
+        return None
+    return new_moon_day(k + off)
+
+
+def lunar_month_length(month, year, leap=False):
+    """Số ngày (29 hoặc 30) của tháng âm lịch, hoặc None nếu tháng không tồn tại."""
+    start = _lunar_month_start(month, year, leap)
+    if start is None:
+        return None
+    k = math.floor((start - _K_EPOCH) / _SYNODIC_MONTH + 0.5)
+    return new_moon_day(k + 1) - new_moon_day(k)
+
+
+def lunar_to_solar(day, month, year, leap=False):
+    """Đổi ngày âm lịch sang datetime.date, hoặc None nếu ngày không tồn tại."""
+    if not 1 <= month <= 12 or not 1 <= day <= 30:
+        return None
+    start = _lunar_month_start(month, year, leap)
+    if start is None:
+        return None
+    if day > lunar_month_length(month, year, leap):
+        return None
+    return jd_to_date(start + day - 1)
+
+
+def lunar_months(first_ordinal, last_ordinal):
+    """Các tháng âm lịch phủ khoảng ordinal [first, last].
+
+    Trả về bốn danh sách song song: ordinal ngày mùng 1, tháng, năm, nhuận.
+    Mỗi tháng chỉ đổi lịch một lần nên chi phí tăng theo số tháng, không theo số ngày.
+    """
+    first_jd = first_ordinal + JDN_OFFSET
+    last_jd = last_ordinal + JDN_OFFSET
+    k = math.floor((first_jd - _K_EPOCH) / _SYNODIC_MONTH) - 1
+    while new_moon_day(k + 1) <= first_jd:
+        k += 1
+    while new_moon_day(k) > first_jd:
+        k -= 1
+    starts, months, years, leaps = [], [], [], []
+    while new_moon_day(k) <= last_jd:
+        start = new_moon_day(k)
+        _, month, year, leap = solar_to_lunar(jd_to_date(start))
+        starts.append(start - JDN_OFFSET)
+        months.append(month)
+        years.append(year)
+        leaps.append(leap)
+        k += 1
+    return starts, months, years, leaps
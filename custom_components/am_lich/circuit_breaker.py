@@ -0,0 +1,77 @@
+"""
+Cầu dao cho lời gọi Gemini: sau vài lần lỗi liên tiếp (hoặc ngay khi bị 429)
+thì ngừng gọi trong một khoảng nghỉ, hết khoảng nghỉ cho đúng một lời gọi thử;
+thử thành công thì đóng lại, thất bại thì nghỉ tiếp.
+"""
+import time
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+FAILURE_THRESHOLD = 3
+COOLDOWN_SECONDS = 120
+
+
+class CircuitBreaker:
+    """Trạng thái cầu dao; chỉ dùng trong vòng lặp sự kiện nên không cần khóa."""
+
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, cooldown=COOLDOWN_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_until = None
+        self.probing = False
+        self.last_error = None
+        self.rejected = 0
+        self.trips = 0
+
+    @property
+    def state(self):
+        if self.opened_until is None:
+            return CLOSED
+        if time.monotonic() < self.opened_until:
+            return OPEN
+        return HALF_OPEN
+
+    def allow(self):
+        """Có được gọi Gemini lúc này không; hết khoảng nghỉ thì cho một lời gọi thử."""
+        state = self.state
+        if state == CLOSED:
+            return True
+        if state == HALF_OPEN and not self.probing:
+            self.probing = True
+            return True
+        self.rejected += 1
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_until = None
+        self.probing = False
+
+    def record_failure(self, error, retry_after=None):
+        """Ghi nhận một lần lỗi; retry_after (giây) thì mở cầu dao ngay."""
+        self.last_error = error
+        self.failures += 1
+        if retry_after is not None or self.probing or self.failures >= self.failure_threshold:
+            self.opened_until = time.monotonic() + max(retry_after or 0, self.cooldown)
+            self.trips += 1
+        self.probing = False
+
+    def release(self):
+        """Lời gọi thử bị hủy giữa chừng: không tính là thành công hay thất bại."""
+        self.probing = False
+
+    def as_dict(self):
+        remaining = None
+        if self.opened_until is not None:
+            remaining = max(0, round(self.opened_until - time.monotonic()))
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'retry_in': remaining,
+            'last_error': self.last_error,
+            'rejected': self.rejected,
+            'trips': self.trips,
+        }
@@ -1,9 +1,9 @@
 import voluptuous as vol
 import logging
 from homeassistant import config_entries
-from .const import DOMAIN, DB_PATH
+from .const import DOMAIN
 from homeassistant.helpers import selector
-import sqlite3
+from .event_repository import async_get_repository
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -109,7 +109,7 @@ class AmLichVNOptionsFlow(config_entries.OptionsFlow):
 
     async def async_step_manage_events(self, user_input=None):
         # Bước quản lý sự kiện: chọn, thêm hoặc sửa sự kiện
-        events = self._load_events()
+        events = await self._async_load_events()
         options = []
         # Hiển thị tiếng Việt cho tất cả label dropdown
         for row in events:
@@ -152,14 +152,8 @@ class AmLichVNOptionsFlow(config_entries.OptionsFlow):
             if user_input.get("confirm"):
                 # Thực hiện xóa sự kiện
                 if self._selected_event_id:
-                    conn = sqlite3.connect(DB_PATH)
-                    cursor = conn.cursor()
-                    cursor.execute(
-                        "DELETE FROM events WHERE id=?",
-                        (self._selected_event_id,)
-                    )
-                    conn.commit()
-                    conn.close()
+                    repository = await async_get_repository(self.hass)
+                    await repository.async_delete(self._selected_event_id)
                     self._reload_integration()
                 return self.async_create_entry(title="", data={})
             else:
@@ -172,7 +166,7 @@ class AmLichVNOptionsFlow(config_entries.OptionsFlow):
         )
 
     def _reload_integration(self):
-        # Gọi service reload_entry sau khi thêm/sửa/xóa sự kiện
+        # Gọi service reload_entry sau khi thêm/xóa sự kiện (danh sách entity thay đổi)
         hass = self.hass if hasattr(self, "hass") else None
         if hass:
             hass.async_create_task(
@@ -192,7 +186,7 @@ class AmLichVNOptionsFlow(config_entries.OptionsFlow):
         schema = self._build_event_schema(loaisukien, user_input)
         if user_input is not None:
             try:
-                self._insert_event(self._filter_event_data(user_input))
+                await self._async_insert_event(self._filter_event_data(user_input))
                 self._reload_integration()
                 return self.async_create_entry(title="", data={})
             except Exception as ex:
@@ -207,7 +201,7 @@ class AmLichVNOptionsFlow(config_entries.OptionsFlow):
     async def async_step_edit_event(self, user_input=None):
         # Bước sửa sự kiện đã chọn
         errors = {}
-        self._events = self._load_events()
+        self._events = await self._async_load_events()
         event = None
         for row in self._events:
             if row[0] == self._selected_event_id:
@@ -227,8 +221,8 @@ class AmLichVNOptionsFlow(config_entries.OptionsFlow):
             if user_input.get("delete", False):
                 return await self.async_step_confirm_delete()
             try:
-                self._update_event(self._selected_event_id, self._filter_event_data(user_input, initial))
-                self._reload_integration()
+                # Lịch và sensor của sự kiện tự cập nhật qua thông báo của kho sự kiện
+                await self._async_update_event(self._selected_event_id, self._filter_event_data(user_input, initial))
                 return self.async_create_entry(title="", data={})
             except Exception as ex:
                 errors["base"] = "edit_failed"
@@ -358,90 +352,39 @@ class AmLichVNOptionsFlow(config_entries.OptionsFlow):
                 "laplai": row[10],
             }
 
-    def _load_events(self):
-        # Đảm bảo file DB và bảng events tồn tại trước khi truy vấn
-        from .sensor import ensure_events_db_exists
-        ensure_events_db_exists()
+    async def _async_load_events(self):
+        # Đọc từ bản sao trong bộ nhớ của kho sự kiện (kho tự tạo bảng events nếu chưa có)
         try:
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
-            cursor.execute(
-                """
-                SELECT id, tendukien, loaisukien, ngayam, thangam, namam,
-                ngayduong, thangduong, namduong, mota, laplai
-                FROM events
-                """
-            )
-            rows = cursor.fetchall()
-            conn.close()
-            return rows
+            repository = await async_get_repository(self.hass)
+            return repository.rows
         except Exception as ex:
             _LOGGER.error(f"Khong the doc events.db: {ex}")
             return []
 
-    def _update_event(self, event_id, data):
+    async def _async_update_event(self, event_id, data):
         # Cập nhật sự kiện trong DB
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
         update_fields = [
             "tendukien", "loaisukien",
             "ngayam", "thangam", "namam",
             "ngayduong", "thangduong", "namduong",
             "mota", "laplai"
         ]
-        values = []
+        values = {}
         for field in update_fields:
             v = data.get(field, None)
             if v == "" or v is None:
-                values.append(None)
+                values[field] = None
             elif field in ["ngayam", "thangam", "namam", "ngayduong", "thangduong", "namduong"]:
                 try:
-                    values.append(float(v))
+                    values[field] = float(v)
                 except Exception:
-                    values.append(None)
+                    values[field] = None
             else:
-                values.append(v)
-        values.append(event_id)
-        cursor.execute(
-            """
-            UPDATE events SET
-                tendukien=?, loaisukien=?, ngayam=?, thangam=?, namam=?,
-                ngayduong=?, thangduong=?, namduong=?, mota=?,
-                laplai=?
-            WHERE id=?
-            """,
-            tuple(values),
-        )
-        conn.commit()
-        conn.close()
+                values[field] = v
+        repository = await async_get_repository(self.hass)
+        await repository.async_update(event_id, values)
 
-    def _insert_event(self, data):
-        # Đảm bảo file DB và bảng events tồn tại trước khi thêm
-        from .sensor import ensure_events_db_exists
-        ensure_events_db_exists()
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute(
-            """
-            INSERT INTO events (
-                tendukien, loaisukien,
-                ngayam, thangam, namam,
-                ngayduong, thangduong, namduong,
-                mota, laplai
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """,
-            (
-                data.get("tendukien"),
-                data.get("loaisukien"),
-                data.get("ngayam"),
-                data.get("thangam"),
-                data.get("namam"),
-                data.get("ngayduong"),
-                data.get("thangduong"),
-                data.get("namduong"),
-                data.get("mota"),
-                data.get("laplai"),
-            ),
-        )
-        conn.commit()
-        conn.close()
+    async def _async_insert_event(self, data):
+        # Thêm sự kiện qua kho sự kiện dùng chung (ghi DB trên luồng riêng của kho)
+        repository = await async_get_repository(self.hass)
+        await repository.async_insert(data)
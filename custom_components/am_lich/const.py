@@ -1,3 +1,4 @@
 DOMAIN = "amlich"
 DB_PATH = "/config/custom_components/amlich/events.db"
 AMLICH_ICS_PATH = "/config/custom_components/amlich/amlich.ics"
+RESPONSE_CACHE_PATH = "/config/custom_components/amlich/gemini_cache.db"
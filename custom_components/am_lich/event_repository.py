@@ -0,0 +1,278 @@
+"""
+Kho sự kiện người dùng (bảng events trong events.db) dùng chung cho lịch,
+các sensor sự kiện và options flow. Giữ một kết nối SQLite ở chế độ WAL và
+một bản sao mọi dòng trong bộ nhớ: đọc không chạm đĩa, ghi thì cập nhật bản
+sao rồi báo cho các listener.
+
+Mọi thao tác với events.db chạy trên một luồng riêng duy nhất, không bao giờ
+trên vòng lặp sự kiện (kết nối sqlite3 tự báo lỗi nếu bị dùng ở luồng khác).
+Các lệnh ghi gửi tới gần nhau được gộp thành một transaction nên chỉ tốn một
+lần fsync. Ở chế độ debug, phần việc còn chạy trên vòng lặp (cập nhật chỉ mục
+lần xuất hiện, báo listener) được đo và cảnh báo khi quá ngưỡng.
+"""
+import asyncio
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+from homeassistant.const import EVENT_HOMEASSISTANT_STOP
+from homeassistant.helpers.dispatcher import async_dispatcher_send
+from .const import DOMAIN, DB_PATH
+from .recurrence import OccurrenceIndex, OCCURRENCE_HORIZON_YEARS
+
+_LOGGER = logging.getLogger(__name__)
+
+# Tín hiệu dispatcher khi bảng events thay đổi: (action, event_id)
+SIGNAL_EVENTS_CHANGED = f"{DOMAIN}_events_changed"
+
+DATA_REPOSITORY = 'events'
+_DATA_LOCK = 'events_lock'
+
+# Thời gian (giây) gom các lệnh ghi vào cùng một transaction
+WRITE_BATCH_DELAY = 0.05
+# Ở chế độ debug, thao tác DB lâu hơn chừng này giây được ghi log
+SLOW_IO_SECONDS = 0.5
+
+# Thứ tự cột của một dòng: (id, tendukien, loaisukien, ngayam, thangam, namam,
+# ngayduong, thangduong, namduong, mota, laplai)
+COLUMNS = (
+    'tendukien', 'loaisukien',
+    'ngayam', 'thangam', 'namam',
+    'ngayduong', 'thangduong', 'namduong',
+    'mota', 'laplai',
+)
+_SELECT = f"SELECT id, {', '.join(COLUMNS)} FROM events"
+_INSERT = (
+    f"INSERT INTO events ({', '.join(COLUMNS)}) "
+    f"VALUES ({', '.join('?' * len(COLUMNS))})"
+)
+_UPDATE = f"UPDATE events SET {', '.join(f'{column}=?' for column in COLUMNS)} WHERE id=?"
+
+
+class EventRepository:
+    """Bảng events trong bộ nhớ, đọc/ghi đĩa qua một luồng làm việc riêng."""
+
+    def __init__(self, path=DB_PATH, horizon_years=OCCURRENCE_HORIZON_YEARS):
+        self.path = path
+        self.version = 0
+        # Lần xuất hiện đã tính sẵn của các sự kiện, cập nhật theo từng lệnh ghi
+        self.occurrences = OccurrenceIndex(horizon_years)
+        self._listeners = []
+        self._conn = None
+        self._by_id = {}
+        self._rows = ()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='amlich_events')
+        self._loop = None
+        self._pending = []
+        self._flush_task = None
+
+    @property
+    def rows(self):
+        """Mọi dòng theo thứ tự id; tuple bất biến nên đọc không cần khóa."""
+        return self._rows
+
+    def get(self, event_id):
+        return self._by_id.get(event_id)
+
+    def add_listener(self, listener):
+        """Đăng ký listener(action, event_id), gọi trên vòng lặp sự kiện; trả về hàm hủy."""
+        self._listeners.append(listener)
+        return lambda: self._listeners.remove(listener)
+
+    async def _async_run(self, func, *args):
+        return await self._loop.run_in_executor(self._executor, func, *args)
+
+    def _check_loop_time(self, operation, started):
+        """Chế độ debug: cảnh báo khi phần việc chạy trên vòng lặp sự kiện giữ vòng lặp quá lâu.
+
+        Ngưỡng là slow_callback_duration của vòng lặp, cùng ngưỡng asyncio dùng ở chế độ debug.
+        """
+        if not _LOGGER.isEnabledFor(logging.DEBUG) or self._loop is None:
+            return
+        elapsed = time.monotonic() - started
+        if elapsed >= self._loop.slow_callback_duration:
+            _LOGGER.warning(f"'{operation}' giữ vòng lặp sự kiện {elapsed:.3f}s")
+
+    def _timed(self, operation, started):
+        if _LOGGER.isEnabledFor(logging.DEBUG):
+            elapsed = time.monotonic() - started
+            if elapsed >= SLOW_IO_SECONDS:
+                _LOGGER.debug(f"Thao tác events.db '{operation}' mất {elapsed:.2f}s")
+
+    async def async_open(self):
+        self._loop = asyncio.get_running_loop()
+        await self._async_run(self._open)
+
+    def _open(self):
+        started = time.monotonic()
+        # Kết nối chỉ dùng trên luồng làm việc; sqlite3 tự báo lỗi nếu bị dùng ở luồng khác
+        self._conn = sqlite3.connect(self.path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                tendukien TEXT,
+                loaisukien TEXT,
+                ngayam REAL,
+                thangam REAL,
+                namam REAL,
+                ngayduong REAL,
+                thangduong REAL,
+                namduong REAL,
+                mota TEXT,
+                laplai TEXT
+            )
+            """
+        )
+        self._conn.commit()
+        self._by_id = {row[0]: row for row in self._conn.execute(_SELECT)}
+        self._rows = tuple(sorted(self._by_id.values()))
+        self.occurrences.build(self._rows, date.today())
+        self._timed('open', started)
+        _LOGGER.debug(f"Đã nạp {len(self._rows)} sự kiện từ {self.path}")
+
+    async def async_insert(self, data):
+        """Thêm sự kiện (dict theo COLUMNS), trả về id mới."""
+        return await self._async_write('insert', None, data)
+
+    async def async_update(self, event_id, data):
+        """Ghi đè các cột của sự kiện event_id."""
+        await self._async_write('update', event_id, data)
+
+    async def async_delete(self, event_id):
+        await self._async_write('delete', event_id, None)
+
+    async def _async_write(self, action, event_id, data):
+        future = self._loop.create_future()
+        self._pending.append((action, event_id, data, future))
+        if self._flush_task is None:
+            self._flush_task = self._loop.create_task(self._async_flush())
+        return await future
+
+    async def _async_flush(self):
+        try:
+            while self._pending:
+                # Chờ một chút để các lệnh ghi tới gần nhau vào cùng transaction
+                await asyncio.sleep(WRITE_BATCH_DELAY)
+                batch, self._pending = self._pending, []
+                try:
+                    outcomes = await self._async_run(
+                        self._write_batch, [op[:3] for op in batch]
+                    )
+                except Exception as e:
+                    outcomes = [(None, e)] * len(batch)
+                started = time.monotonic()
+                for (action, event_id, _data, future), (result, error) in zip(batch, outcomes):
+                    if error is not None:
+                        if not future.done():
+                            future.set_exception(error)
+                        continue
+                    if not future.done():
+                        future.set_result(result)
+                    if action == 'insert':
+                        event_id = result
+                    self.occurrences.refresh(event_id, self.get(event_id))
+                    self._notify(action, event_id)
+                self._check_loop_time(f'áp dụng {len(batch)} lệnh ghi', started)
+        finally:
+            self._flush_task = None
+
+    def _write_batch(self, batch):
+        """Ghi cả lô trong một transaction; lệnh lỗi chỉ hoàn tác phần của nó."""
+        started = time.monotonic()
+        outcomes = []
+        touched = set()
+        # Transaction bao ngoài để RELEASE của từng savepoint không tự commit
+        self._conn.execute("BEGIN")
+        for action, event_id, data in batch:
+            self._conn.execute("SAVEPOINT op")
+            try:
+                if action == 'insert':
+                    cursor = self._conn.execute(
+                        _INSERT, tuple(data.get(column) for column in COLUMNS)
+                    )
+                    event_id = cursor.lastrowid
+                elif action == 'update':
+                    self._conn.execute(
+                        _UPDATE, tuple(data.get(column) for column in COLUMNS) + (event_id,)
+                    )
+                else:
+                    self._conn.execute("DELETE FROM events WHERE id=?", (event_id,))
+                self._conn.execute("RELEASE op")
+            except sqlite3.Error as e:
+                self._conn.execute("ROLLBACK TO op")
+                self._conn.execute("RELEASE op")
+                outcomes.append((None, e))
+                continue
+            touched.add(event_id)
+            outcomes.append((event_id if action == 'insert' else None, None))
+        try:
+            self._conn.commit()
+        except sqlite3.Error:
+            self._conn.rollback()
+            raise
+        self._reload_rows(touched)
+        self._timed(f'ghi {len(batch)} lệnh', started)
+        return outcomes
+
+    def _reload_rows(self, event_ids):
+        # Đọc lại đúng các dòng vừa ghi để bản sao khớp với kiểu dữ liệu SQLite lưu
+        by_id = dict(self._by_id)
+        for event_id in event_ids:
+            row = self._conn.execute(f"{_SELECT} WHERE id=?", (event_id,)).fetchone()
+            if row is None:
+                by_id.pop(event_id, None)
+            else:
+                by_id[event_id] = row
+        self._by_id = by_id
+        self._rows = tuple(sorted(by_id.values()))
+        self.version += 1
+
+    def extend_occurrences(self, today):
+        """Gọi lúc sang ngày mới để chỉ mục lần xuất hiện luôn phủ đủ horizon."""
+        started = time.monotonic()
+        self.occurrences.extend(self._rows, today)
+        self._check_loop_time('extend_occurrences', started)
+
+    def _notify(self, action, event_id):
+        for listener in list(self._listeners):
+            try:
+                listener(action, event_id)
+            except Exception as e:
+                _LOGGER.error(f"Lỗi khi báo thay đổi sự kiện {event_id}: {str(e)}")
+
+    async def async_close(self):
+        if self._flush_task is not None:
+            await asyncio.shield(self._flush_task)
+        if self._conn is not None:
+            await self._async_run(self._conn.close)
+        self._executor.shutdown(wait=False)
+
+
+async def async_get_repository(hass):
+    """Kho sự kiện dùng chung trong hass.data, mở lần đầu khi cần."""
+    domain_data = hass.data.setdefault(DOMAIN, {})
+    lock = domain_data.setdefault(_DATA_LOCK, asyncio.Lock())
+    async with lock:
+        repository = domain_data.get(DATA_REPOSITORY)
+        if repository is None:
+            repository = EventRepository(
+                horizon_years=domain_data.get('occurrence_horizon', OCCURRENCE_HORIZON_YEARS)
+            )
+            await repository.async_open()
+            repository.add_listener(
+                lambda action, event_id: async_dispatcher_send(
+                    hass, SIGNAL_EVENTS_CHANGED, action, event_id
+                )
+            )
+
+            async def close_repository(event):
+                await repository.async_close()
+
+            hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, close_repository)
+            domain_data[DATA_REPOSITORY] = repository
+    return repository
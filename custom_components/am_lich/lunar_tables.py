@@ -0,0 +1,338 @@
+"""
+Bảng tra cứu âm lịch dạng mảng, đánh chỉ số theo date.toordinal().
+Dữ liệu ngày được chia theo từng năm dương lịch; mỗi năm là một đoạn gồm
+các cột ngày/tháng/năm âm lịch và cờ tháng nhuận. Khi đọc từ bản chụp,
+các đoạn chỉ được nạp khi cần và giữ trong một LRU có giới hạn; các năm
+được ghim (năm hiện tại ± 1) nằm ngoài LRU nên không bao giờ bị đẩy ra.
+Đoạn năm không bao giờ được đọc từ file trên vòng lặp sự kiện: khi thiếu,
+bảng báo SegmentNotLoaded để nơi gọi nạp năm đó qua executor. Sự kiện ICS
+được giữ trong chỉ mục sắp xếp theo ordinal để tra theo khoảng ngày.
+"""
+import asyncio
+import pickle
+import threading
+from array import array
+from collections import Counter, OrderedDict, namedtuple
+from bisect import bisect_left, bisect_right
+from datetime import date
+
+# Bộ bảng tra cứu bất biến; nạp lại ICS tạo bộ mới rồi thay cả bộ một lần
+LunarData = namedtuple('LunarData', ['version', 'day_table', 'event_index'])
+
+# Một năm dương lịch của bảng ngày: ordinal ngày đầu và các cột
+YearSegment = namedtuple('YearSegment', ['base', 'days', 'months', 'years', 'leaps'])
+
+# Khoảng cách tối đa giữa hai Tết liên tiếp (năm âm lịch có tháng nhuận)
+MAX_LUNAR_YEAR_DAYS = 385
+
+# Số năm tối đa giữ trong LRU khi bảng được nạp lười từ bản chụp (không tính năm đã ghim)
+MAX_RESIDENT_YEARS = 8
+
+
+class SegmentNotLoaded(LookupError):
+    """Đoạn năm chưa nằm trong bộ nhớ, mà lời gọi đang chạy trên vòng lặp sự kiện."""
+
+    def __init__(self, year):
+        super().__init__(f"Năm {year} chưa được nạp vào bộ nhớ")
+        self.year = year
+
+
+def _on_event_loop():
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+def _segment_entries(segment):
+    """Dict {ordinal: (ngày, tháng, nhuận)} của các ngày có dữ liệu trong một đoạn năm."""
+    return {
+        segment.base + i: (d, segment.months[i], bool(segment.leaps[i]))
+        for i, d in enumerate(segment.days) if d
+    }
+
+
+class LunarDayTable:
+    """Bảng ngày âm lịch chia theo năm, tra cứu O(1) theo ordinal."""
+
+    def __init__(self, tet, segments, day_count, source=None, max_resident=MAX_RESIDENT_YEARS):
+        # Chỉ mục Tết: ordinal ngày dương của mỗi mùng 1 tháng Giêng, tăng dần
+        self.tet = tet
+        self.day_count = day_count
+        # source = (đường dẫn, header, vị trí đầu dữ liệu, {năm: (offset, độ dài)}) khi nạp lười
+        self._source = source
+        self._max_resident = max_resident
+        self._lock = threading.Lock()
+        # Các năm ghim ngoài LRU; dict được thay nguyên khối nên đọc không cần khóa
+        self._pinned = {}
+        if source is not None:
+            self.available = sorted(source[3])
+        else:
+            self.available = sorted(segments)
+        self._segments = OrderedDict(sorted(segments.items()))
+
+    @classmethod
+    def build(cls, entries):
+        """Tạo bảng từ dict {ordinal: (ngày, tháng, nhuận)} đọc từ ICS."""
+        tet = array('l', sorted(
+            ordinal for ordinal, (day, month, leap) in entries.items()
+            if day == 1 and month == 1 and not leap
+        ))
+        table = cls(tet, {}, len(entries))
+        by_year = {}
+        for ordinal, value in entries.items():
+            by_year.setdefault(date.fromordinal(ordinal).year, {})[ordinal] = value
+        segments = {year: table._make_segment(year, days) for year, days in by_year.items()}
+        table._segments = OrderedDict(sorted(segments.items()))
+        table.available = sorted(segments)
+        return table
+
+    def _make_segment(self, year, entries):
+        """Dựng đoạn của năm year từ {ordinal: (ngày, tháng, nhuận)}; năm âm tra theo chỉ mục Tết."""
+        base = min(entries)
+        size = max(entries) - base + 1
+        days = array('B', bytes(size))
+        months = array('B', bytes(size))
+        years = array('H', [0]) * size
+        leaps = array('B', bytes(size))
+        for ordinal, (day, month, leap) in entries.items():
+            idx = ordinal - base
+            days[idx] = day
+            months[idx] = month
+            leaps[idx] = 1 if leap else 0
+            years[idx] = self.lunar_year(ordinal) or year
+        return YearSegment(base, days, months, years, leaps)
+
+    def patch(self, removed, added):
+        """Bảng mới sau khi gỡ các ngày removed và thêm các ngày added.
+
+        removed/added là {ordinal: (ngày, tháng, nhuận)}. Chỉ dựng lại đoạn của
+        các năm bị đổi, các năm khác dùng lại đoạn cũ. Chỉ mục Tết giữ nguyên nên
+        không dùng được khi thay đổi chạm tới ngày mùng 1 tháng Giêng.
+        """
+        changed = {}
+        for ordinal in set(removed) | set(added):
+            changed.setdefault(date.fromordinal(ordinal).year, []).append(ordinal)
+        segments = {}
+        day_count = self.day_count
+        for year in self.available:
+            if year not in changed:
+                segments[year] = self.segment(year, keep=False)
+        for year, ordinals in changed.items():
+            segment = self.segment(year, keep=False)
+            entries = _segment_entries(segment) if segment is not None else {}
+            for ordinal in ordinals:
+                if ordinal in removed and entries.get(ordinal) == removed[ordinal]:
+                    del entries[ordinal]
+                    day_count -= 1
+                # Ngày đã có dữ liệu thì giữ bản cũ, như khi đọc ICS gặp ngày trùng
+                if ordinal in added and ordinal not in entries:
+                    entries[ordinal] = added[ordinal]
+                    day_count += 1
+            if entries:
+                segments[year] = self._make_segment(year, entries)
+        return LunarDayTable(self.tet, segments, day_count)
+
+    def dump(self, f):
+        """Ghi bảng vào file nhị phân: thư mục các năm rồi từng đoạn năm."""
+        blobs = {}
+        for year in self.available:
+            segment = self.segment(year, keep=False)
+            blobs[year] = pickle.dumps(tuple(segment), protocol=pickle.HIGHEST_PROTOCOL)
+        offsets = {}
+        position = 0
+        for year in self.available:
+            offsets[year] = (position, len(blobs[year]))
+            position += len(blobs[year])
+        pickle.dump((self.tet, self.day_count, offsets), f, protocol=pickle.HIGHEST_PROTOCOL)
+        for year in self.available:
+            f.write(blobs[year])
+
+    @classmethod
+    def from_snapshot(cls, path, header):
+        """Đọc thư mục của bản chụp path, hoặc None nếu header đầu file khác header.
+
+        Bảng không giữ file mở: mỗi lần nạp một năm, file được mở lại theo
+        đường dẫn và kiểm tra header, để bản chụp bị thay trên đĩa không bị
+        đọc nhầm.
+        """
+        with open(path, 'rb') as f:
+            if pickle.load(f) != header:
+                return None
+            tet, day_count, offsets = pickle.load(f)
+            data_start = f.tell()
+        return cls(tet, {}, day_count, source=(path, header, data_start, offsets))
+
+    def __len__(self):
+        return self.day_count
+
+    def has_year(self, year):
+        """True nếu bảng có dữ liệu cho năm dương lịch year."""
+        idx = bisect_left(self.available, year)
+        return idx < len(self.available) and self.available[idx] == year
+
+    def resident_years(self):
+        """Các năm đang nằm trong bộ nhớ."""
+        return sorted(set(self._pinned) | set(self._segments))
+
+    def preload(self, years):
+        """Nạp các năm vào LRU (gọi từ luồng executor)."""
+        for year in years:
+            self.segment(year)
+
+    def pin(self, years):
+        """Giữ cố định các năm years trong bộ nhớ, thay cho các năm ghim trước đó (gọi từ executor)."""
+        pinned = {}
+        for year in years:
+            segment = self.segment(year, keep=False)
+            if segment is not None:
+                pinned[year] = segment
+        self._pinned = pinned
+
+    def segment(self, year, keep=True):
+        """Đoạn dữ liệu của năm dương lịch year, hoặc None nếu không có.
+
+        Trên vòng lặp sự kiện, năm chưa có trong bộ nhớ báo SegmentNotLoaded
+        thay vì đọc file.
+        """
+        segment = self._pinned.get(year)
+        if segment is not None:
+            return segment
+        segment = self._segments.get(year)
+        if segment is not None:
+            # Không cần khóa: luồng khác có thể vừa đẩy năm này ra khỏi LRU
+            try:
+                self._segments.move_to_end(year)
+            except KeyError:
+                pass
+            return segment
+        if self._source is None or not self.has_year(year):
+            return None
+        if _on_event_loop():
+            raise SegmentNotLoaded(year)
+        with self._lock:
+            segment = self._segments.get(year)
+            if segment is not None:
+                return segment
+            path, header, data_start, offsets = self._source
+            offset, length = offsets[year]
+            with open(path, 'rb') as f:
+                if pickle.load(f) != header:
+                    raise LookupError(f"Bản chụp {path} đã được thay, không đọc được năm {year}")
+                f.seek(data_start + offset)
+                segment = YearSegment(*pickle.loads(f.read(length)))
+            if keep:
+                self._segments[year] = segment
+                while len(self._segments) > self._max_resident:
+                    self._segments.popitem(last=False)
+            return segment
+
+    def lunar_year(self, ordinal):
+        """Năm âm lịch chứa ngày ordinal, tìm nhị phân trên chỉ mục Tết."""
+        tet = self.tet
+        if not tet:
+            return None
+        idx = bisect_right(tet, ordinal)
+        if idx == 0:
+            if tet[0] - ordinal > MAX_LUNAR_YEAR_DAYS:
+                return None
+            return date.fromordinal(tet[0]).year - 1
+        if idx == len(tet) and ordinal - tet[-1] >= MAX_LUNAR_YEAR_DAYS:
+            return None
+        return date.fromordinal(tet[idx - 1]).year
+
+    def lookup(self, solar_date):
+        """Trả về (ngày, tháng, năm, nhuận) âm lịch hoặc None nếu ngoài dữ liệu."""
+        segment = self.segment(solar_date.year)
+        if segment is None:
+            return None
+        idx = solar_date.toordinal() - segment.base
+        if idx < 0 or idx >= len(segment.days) or not segment.days[idx]:
+            return None
+        return (
+            segment.days[idx], segment.months[idx], segment.years[idx],
+            bool(segment.leaps[idx])
+        )
+
+    def solar_dates(self, day, month, years):
+        """Danh sách ngày dương lịch (đã sắp xếp) ứng với ngày âm dd/mm trong các năm years."""
+        result = []
+        for year in sorted(years):
+            segment = self.segment(year)
+            if segment is None:
+                continue
+            for idx, d in enumerate(segment.days):
+                if d == day and segment.months[idx] == month:
+                    result.append(date.fromordinal(segment.base + idx))
+        return result
+
+
+class EventIndex:
+    """Sự kiện ICS sắp theo ngày: ordinal, nội dung và ngày âm lịch tính sẵn."""
+
+    __slots__ = ('ordinals', 'texts', 'lunar_dates')
+
+    def __init__(self, ordinals, texts, lunar_dates):
+        self.ordinals = ordinals
+        self.texts = texts
+        self.lunar_dates = lunar_dates
+
+    @classmethod
+    def build(cls, events, lunar_of):
+        """Tạo chỉ mục từ dict {date: [sự kiện]}; lunar_of(date) trả về chuỗi ngày âm."""
+        ordinals = array('l')
+        texts = []
+        lunar_dates = []
+        for solar_date in sorted(events):
+            lunar = lunar_of(solar_date)
+            for text in events[solar_date]:
+                ordinals.append(solar_date.toordinal())
+                texts.append(text)
+                lunar_dates.append(lunar)
+        return cls(ordinals, texts, lunar_dates)
+
+    def __len__(self):
+        return len(self.ordinals)
+
+    def _span(self, first, last):
+        return (
+            bisect_left(self.ordinals, first),
+            bisect_right(self.ordinals, last),
+        )
+
+    def on(self, solar_date):
+        """Danh sách sự kiện của một ngày dương lịch."""
+        ordinal = solar_date.toordinal()
+        lo, hi = self._span(ordinal, ordinal)
+        return self.texts[lo:hi]
+
+    def between(self, start, end):
+        """Các (ngày, sự kiện, ngày âm) trong khoảng [start, end], theo thứ tự ngày."""
+        lo, hi = self._span(start.toordinal(), end.toordinal())
+        return [
+            (date.fromordinal(self.ordinals[i]), self.texts[i], self.lunar_dates[i])
+            for i in range(lo, hi)
+        ]
+
+    def patch(self, removed, added, lunar_of):
+        """Chỉ mục mới: bỏ các (ordinal, sự kiện) trong removed, thêm các mục added.
+
+        Sự kiện giữ nguyên dùng lại ngày âm đã tính; chỉ sự kiện mới gọi lunar_of.
+        """
+        removed = Counter(removed)
+        rows = []
+        for i, ordinal in enumerate(self.ordinals):
+            key = (ordinal, self.texts[i])
+            if removed[key] > 0:
+                removed[key] -= 1
+                continue
+            rows.append((ordinal, self.texts[i], self.lunar_dates[i]))
+        for ordinal, text in added:
+            rows.append((ordinal, text, lunar_of(date.fromordinal(ordinal))))
+        rows.sort(key=lambda row: row[0])
+        return EventIndex(
+            array('l', (row[0] for row in rows)),
+            [row[1] for row in rows],
+            [row[2] for row in rows],
+        )
@@ -0,0 +1,262 @@
+"""
+Tính trực tiếp các lần xuất hiện của sự kiện người dùng trong một khoảng ngày.
+
+Quy tắc dương lịch dùng phép tính ngày tháng; quy tắc âm lịch chỉ đổi lịch
+ngày mùng 1 của mỗi tháng âm trong khoảng (dùng chung cho mọi sự kiện và được
+nhớ theo năm giữa các lần gọi), rồi cộng số ngày. Chi phí tăng theo số lần
+xuất hiện chứ không theo số sự kiện nhân số ngày.
+
+OccurrenceIndex giữ sẵn kết quả cho một khoảng quanh hôm nay để lịch và các
+sensor chỉ cần tra cứu.
+
+Quy tắc khớp giữ nguyên như lịch cũ: tháng nhuận được tính như tháng thường
+cùng số; sự kiện dương lịch lặp hàng tháng có ghi tháng thì chỉ xuất hiện
+trong tháng đó.
+"""
+import logging
+from collections import defaultdict, namedtuple
+from bisect import bisect_left
+from datetime import date, timedelta
+from functools import lru_cache
+
+from .amlich_engine import lunar_months
+
+_LOGGER = logging.getLogger(__name__)
+
+# Số năm dương lịch giữ sẵn danh sách tháng âm; lịch hỏi các tháng liền kề
+# khi cuộn nên vài năm gần nhất là đủ
+LUNAR_YEAR_MEMO_SIZE = 8
+
+# Số năm tính trước các lần xuất hiện của sự kiện, đổi bằng tùy chọn occurrence_horizon
+OCCURRENCE_HORIZON_YEARS = 3
+
+# Một tháng âm lịch trong khoảng: ordinal mùng 1, ordinal mùng 1 tháng sau, tháng, năm
+LunarMonth = namedtuple('LunarMonth', ['start', 'next_start', 'month', 'year'])
+
+
+def _int(value):
+    return int(value) if value else None
+
+
+@lru_cache(maxsize=LUNAR_YEAR_MEMO_SIZE)
+def _year_lunar_months(year):
+    """Các tháng âm lịch có mùng 1 nằm trong (hoặc phủ ngày đầu) năm dương year."""
+    first_ordinal = date(year, 1, 1).toordinal()
+    last_ordinal = date(year, 12, 31).toordinal()
+    # Lấy dư một tháng để tháng cuối năm cũng biết mùng 1 tháng sau
+    starts, months, years, _leaps = lunar_months(first_ordinal, last_ordinal + 30)
+    return tuple(
+        LunarMonth(starts[i], starts[i + 1], months[i], years[i])
+        for i in range(len(starts) - 1)
+        if starts[i] <= last_ordinal
+    )
+
+
+def window_lunar_months(first, last):
+    """Các tháng âm lịch phủ [first, last] (date), ghép từ danh sách theo năm đã nhớ."""
+    first_ordinal, last_ordinal = first.toordinal(), last.toordinal()
+    by_start = {}
+    for year in range(first.year, last.year + 1):
+        for lunar_month in _year_lunar_months(year):
+            if lunar_month.next_start > first_ordinal and lunar_month.start <= last_ordinal:
+                # Tháng vắt qua năm mới có trong danh sách của cả hai năm
+                by_start[lunar_month.start] = lunar_month
+    return [by_start[start] for start in sorted(by_start)]
+
+
+class _LunarIndex:
+    """Tháng âm lịch của một khoảng, tra theo tháng và theo (tháng, năm)."""
+
+    def __init__(self, months):
+        self.months = months
+        self.by_month = defaultdict(list)
+        self.by_month_year = defaultdict(list)
+        for lunar_month in months:
+            self.by_month[lunar_month.month].append(lunar_month)
+            self.by_month_year[(lunar_month.month, lunar_month.year)].append(lunar_month)
+
+
+def _add_month(year, month):
+    return (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def solar_occurrences(row, first, last):
+    """Các ngày trong [first, last] của một sự kiện dương lịch."""
+    day, month, year = _int(row[6]), _int(row[7]), _int(row[8])
+    if not day:
+        return []
+    rule = row[10]
+    if rule == 'monthly':
+        candidates = []
+        y, m = first.year, first.month
+        while (y, m) <= (last.year, last.month):
+            if not month or m == month:
+                candidates.append((y, m, day))
+            y, m = _add_month(y, m)
+    elif rule == 'yearly':
+        if not month:
+            return []
+        candidates = [(y, month, day) for y in range(first.year, last.year + 1)]
+    else:
+        if not month or not year:
+            return []
+        candidates = [(year, month, day)]
+    result = []
+    for y, m, d in candidates:
+        try:
+            occurrence = date(y, m, d)
+        except ValueError:
+            # Ngày không tồn tại trong tháng đó (31/4, 29/2 năm thường)
+            continue
+        if first <= occurrence <= last:
+            result.append(occurrence)
+    return result
+
+
+def lunar_occurrences(row, first, last, index):
+    """Các ngày trong [first, last] của một sự kiện âm lịch."""
+    day, month, year = _int(row[3]), _int(row[4]), _int(row[5])
+    if not day:
+        return []
+    rule = row[10]
+    if rule == 'monthly':
+        months = index.months
+    elif rule == 'yearly':
+        if not month:
+            return []
+        months = index.by_month.get(month, ())
+    else:
+        if not month or not year:
+            return []
+        months = index.by_month_year.get((month, year), ())
+    first_ordinal, last_ordinal = first.toordinal(), last.toordinal()
+    result = []
+    for lunar_month in months:
+        ordinal = lunar_month.start + day - 1
+        # Tháng thiếu (29 ngày) không có ngày 30
+        if ordinal < lunar_month.next_start and first_ordinal <= ordinal <= last_ordinal:
+            result.append(date.fromordinal(ordinal))
+    return result
+
+
+def expand_occurrences(rows, first, last):
+    """Danh sách (row, ngày) của mọi sự kiện trong [first, last], theo thứ tự dòng rồi ngày."""
+    index = None
+    result = []
+    for row in rows:
+        try:
+            if row[2] == 'solar':
+                occurrences = solar_occurrences(row, first, last)
+            else:
+                if index is None:
+                    index = _LunarIndex(window_lunar_months(first, last))
+                occurrences = lunar_occurrences(row, first, last, index)
+        except Exception as ex:
+            _LOGGER.error(f"Lỗi tính ngày cho sự kiện calendar (range): {ex}")
+            continue
+        result.extend((row, occurrence) for occurrence in occurrences)
+    return result
+
+
+def _add_years(day, years):
+    try:
+        return day.replace(year=day.year + years)
+    except ValueError:
+        # 29/2 sang năm không nhuận
+        return day.replace(year=day.year + years, day=28)
+
+
+class OccurrenceIndex:
+    """Các lần xuất hiện đã tính sẵn của mọi sự kiện, từ một năm trước tới horizon_years năm sau.
+
+    Cấu trúc bên trong được thay nguyên khối khi đổi nên đọc không cần khóa.
+    """
+
+    def __init__(self, horizon_years=OCCURRENCE_HORIZON_YEARS):
+        self.horizon_years = horizon_years
+        self.first = None
+        self.last = None
+        self._by_event = {}
+        self._timeline = None
+
+    def _bounds(self, today):
+        return today - timedelta(days=366), _add_years(today, self.horizon_years)
+
+    @staticmethod
+    def _group(rows, first, last):
+        by_event = defaultdict(list)
+        for row, occurrence in expand_occurrences(rows, first, last):
+            by_event[row[0]].append(occurrence)
+        return by_event
+
+    def build(self, rows, today):
+        """Tính lại toàn bộ chỉ mục quanh ngày today."""
+        first, last = self._bounds(today)
+        by_event = self._group(rows, first, last)
+        self._by_event = {event_id: tuple(dates) for event_id, dates in by_event.items()}
+        self._timeline = None
+        self.first, self.last = first, last
+        _LOGGER.debug(
+            f"Đã lập chỉ mục {sum(map(len, self._by_event.values()))} lần xuất hiện "
+            f"từ {first} đến {last}"
+        )
+
+    def refresh(self, event_id, row):
+        """Tính lại riêng một sự kiện vừa thêm/sửa; row là None khi sự kiện đã bị xóa."""
+        if self.first is None:
+            return
+        by_event = dict(self._by_event)
+        by_event.pop(event_id, None)
+        if row is not None:
+            dates = self._group([row], self.first, self.last).get(event_id)
+            if dates:
+                by_event[event_id] = tuple(dates)
+        self._by_event = by_event
+        self._timeline = None
+
+    def extend(self, rows, today):
+        """Sang ngày mới: bỏ các ngày quá cũ và chỉ tính thêm phần cuối mới vào horizon."""
+        first, last = self._bounds(today)
+        if self.first is None or first < self.first or last < self.last:
+            self.build(rows, today)
+            return
+        added = self._group(rows, self.last + timedelta(days=1), last) if last > self.last else {}
+        by_event = {}
+        for row in rows:
+            event_id = row[0]
+            dates = tuple(
+                occurrence for occurrence in self._by_event.get(event_id, ())
+                if occurrence >= first
+            ) + tuple(added.get(event_id, ()))
+            if dates:
+                by_event[event_id] = dates
+        self._by_event = by_event
+        self._timeline = None
+        self.first, self.last = first, last
+
+    def covers(self, first, last):
+        return self.first is not None and self.first <= first and last <= self.last
+
+    def between(self, first, last):
+        """Danh sách (event_id, ngày) trong [first, last] theo thứ tự ngày, hoặc None nếu ngoài chỉ mục."""
+        if not self.covers(first, last):
+            return None
+        timeline = self._timeline
+        if timeline is None:
+            timeline = sorted(
+                (occurrence.toordinal(), event_id)
+                for event_id, dates in self._by_event.items()
+                for occurrence in dates
+            )
+            self._timeline = timeline
+        lo = bisect_left(timeline, (first.toordinal(),))
+        hi = bisect_left(timeline, (last.toordinal() + 1,))
+        return [(event_id, date.fromordinal(ordinal)) for ordinal, event_id in timeline[lo:hi]]
+
+    def next_on_or_after(self, event_id, day):
+        """Lần xuất hiện đầu tiên từ ngày day trở đi, hoặc None nếu không có trong chỉ mục."""
+        if not self.covers(day, day):
+            return None
+        dates = self._by_event.get(event_id, ())
+        position = bisect_left(dates, day)
+        return dates[position] if position < len(dates) else None
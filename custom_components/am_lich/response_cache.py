@@ -0,0 +1,145 @@
+"""
+Bộ đệm SQLite cho phản hồi Gemini (phân tích câu hỏi, câu hài hước).
+Khóa là (loại, nội dung gửi đi); mỗi loại có thời hạn riêng, số dòng bị giới
+hạn và dòng ít dùng nhất bị xóa trước. Dữ liệu nằm trên đĩa nên còn nguyên
+sau khi khởi động lại Home Assistant.
+
+Lần trúng chỉ đọc: thời điểm dùng gần nhất được giữ trong bộ nhớ và ghi xuống
+đĩa cùng lần ghi kế tiếp, cũng là lúc duy nhất cần tới nó để chọn dòng cần xóa.
+"""
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+_LOGGER = logging.getLogger(__name__)
+
+# Thời hạn (giây) của từng loại phản hồi
+DEFAULT_TTLS = {
+    'analyze': 86400,
+    'humor': 7 * 86400,
+}
+
+MAX_ENTRIES = 2000
+
+
+class ResponseCache:
+    """Bộ đệm phản hồi dùng chung, an toàn khi gọi từ nhiều luồng executor."""
+
+    def __init__(self, path, ttls=None, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.max_entries = max_entries
+        self.hits = Counter()
+        self.misses = Counter()
+        self._lock = threading.Lock()
+        # (kind, key) → thời điểm trúng gần nhất, chưa ghi xuống đĩa
+        self._touched = {}
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (kind, key)
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)"
+        )
+        self._conn.execute("DELETE FROM responses WHERE expires_at <= ?", (time.time(),))
+        self._conn.commit()
+        self._count = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def _key(parts):
+        return json.dumps(parts, ensure_ascii=False)
+
+    def get(self, kind, *parts):
+        """Giá trị đã lưu cho (kind, parts), hoặc None nếu chưa có hay đã hết hạn."""
+        key = self._key(parts)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM responses WHERE kind = ? AND key = ?",
+                (kind, key),
+            ).fetchone()
+            if row is None or row[1] <= now:
+                self.misses[kind] += 1
+                return None
+            self._touched[(kind, key)] = now
+            self.hits[kind] += 1
+        return json.loads(row[0])
+
+    def _flush_touched(self):
+        if self._touched:
+            self._conn.executemany(
+                "UPDATE responses SET last_used = ? WHERE kind = ? AND key = ?",
+                [(used, kind, key) for (kind, key), used in self._touched.items()],
+            )
+            self._touched = {}
+
+    def put(self, kind, value, *parts):
+        """Lưu value (kiểu JSON) cho (kind, parts) với thời hạn của loại kind."""
+        key = self._key(parts)
+        now = time.time()
+        row = (json.dumps(value, ensure_ascii=False), now + self.ttls[kind], now)
+        with self._lock:
+            self._flush_touched()
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO responses (value, expires_at, last_used, kind, key) "
+                "VALUES (?, ?, ?, ?, ?)",
+                row + (kind, key),
+            )
+            if cursor.rowcount:
+                self._count += 1
+            else:
+                self._conn.execute(
+                    "UPDATE responses SET value = ?, expires_at = ?, last_used = ? "
+                    "WHERE kind = ? AND key = ?",
+                    row + (kind, key),
+                )
+            if self._count > self.max_entries:
+                self._evict(now)
+            self._conn.commit()
+
+    def _evict(self, now):
+        self._conn.execute("DELETE FROM responses WHERE expires_at <= ?", (now,))
+        self._count = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        excess = self._count - self.max_entries
+        if excess > 0:
+            self._conn.execute(
+                "DELETE FROM responses WHERE rowid IN "
+                "(SELECT rowid FROM responses ORDER BY last_used LIMIT ?)",
+                (excess,),
+            )
+            self._count -= excess
+            _LOGGER.debug(f"Đã xóa {excess} phản hồi Gemini ít dùng khỏi bộ đệm")
+
+    def stats(self):
+        """Số lần trúng/trượt theo từng loại và số dòng hiện có."""
+        kinds = sorted(set(self.ttls) | set(self.hits) | set(self.misses))
+        return {
+            'entries': self._count,
+            'hits': {kind: self.hits[kind] for kind in kinds},
+            'misses': {kind: self.misses[kind] for kind in kinds},
+        }
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+            self._touched = {}
+            self._count = 0
+
+    def close(self):
+        with self._lock:
+            self._flush_touched()
+            self._conn.commit()
+            self._conn.close()
@@ -2,12 +2,13 @@ from homeassistant.components.sensor import SensorEntity
 from homeassistant.core import HomeAssistant, callback
 from homeassistant.helpers.entity_platform import AddEntitiesCallback
 from homeassistant.helpers.event import async_track_state_change_event
-from homeassistant.const import STATE_UNKNOWN
-from .amlich_core import query_date
+from homeassistant.helpers.dispatcher import async_dispatcher_connect
+from homeassistant.const import STATE_UNKNOWN, EntityCategory
+from .amlich_core import query_date, gemini_status
+from .amlich_engine import lunar_to_solar, solar_to_lunar
+import asyncio
 import logging
-import sqlite3
-from .const import DB_PATH
-import os
+from .event_repository import SIGNAL_EVENTS_CHANGED, async_get_repository
 import voluptuous as vol
 from homeassistant.helpers.entity import Entity
 
@@ -16,34 +17,9 @@ _LOGGER = logging.getLogger(__name__)
 DOMAIN = "amlich"
 INPUT_TEXT_ENTITY = "input_text.tracuu"
 
-
-def ensure_events_table():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS events (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            tendukien TEXT,
-            loaisukien TEXT,
-            ngayam REAL,
-            thangam REAL,
-            namam REAL,
-            ngayduong REAL,
-            thangduong REAL,
-            namduong REAL,
-            mota TEXT,
-            laplai TEXT
-        )
-        """
-    )
-    conn.commit()
-    conn.close()
-
-
-def ensure_events_db_exists():
-    if not os.path.exists(DB_PATH):
-        ensure_events_table()
+# Thời gian chờ mặc định (giây) trước khi tra một input mới, có thể đổi bằng
+# tùy chọn query_debounce trong cấu hình amlich
+QUERY_DEBOUNCE_SECONDS = 0.4
 
 
 def parse_float_or_none(val):
@@ -64,7 +40,8 @@ def format_int_if_possible(val):
 
 
 class AmLichEventSensor(SensorEntity):
-    def __init__(self, row):
+    def __init__(self, row, repository):
+        self._repository = repository
         self._id = row[0]
         self._tendukien = row[1]
         self._loaisukien = row[2]
@@ -123,6 +100,11 @@ class AmLichEventSensor(SensorEntity):
     def _get_nearest_solar(self):
         from datetime import date
         today = date.today()
+        # Tra chỉ mục lần xuất hiện; không có (sự kiện đã qua hoặc ngoài horizon)
+        # thì tính như cũ
+        event_date = self._repository.occurrences.next_on_or_after(self._id, today)
+        if event_date is not None:
+            return event_date
         try:
             if self._loaisukien == "solar":
                 if not self._ngayduong:
@@ -155,49 +137,34 @@ class AmLichEventSensor(SensorEntity):
                     day = int(self._ngayduong)
                     return date(year, month, day)
             else:
-                try:
-                    from lunarcalendar import Converter, Lunar, Solar
-                except ImportError:
-                    return None
                 if not self._ngayam:
                     return None
                 lunar_day = int(self._ngayam)
                 lunar_month = int(self._thangam) if self._thangam else None
                 lunar_year = int(self._namam) if self._namam else today.year
                 if self._laplai == "monthly":
-                    solar_today = Solar(today.year, today.month, today.day)
-                    lunar_today = Converter.Solar2Lunar(solar_today)
-                    am_thang = lunar_today.month
-                    am_nam = lunar_today.year
-                    if lunar_today.day > lunar_day:
+                    am_ngay, am_thang, am_nam, _ = solar_to_lunar(today)
+                    if am_ngay > lunar_day:
                         am_thang += 1
                         if am_thang > 12:
                             am_thang = 1
                             am_nam += 1
-                    lunar = Lunar(am_nam, am_thang, lunar_day, False)
-                    solar = Converter.Lunar2Solar(lunar)
-                    return date(solar.year, solar.month, solar.day)
+                    return lunar_to_solar(lunar_day, am_thang, am_nam)
                 elif self._laplai == "yearly":
                     if not lunar_month:
                         return None
                     for offset in [0, 1]:
                         ly = today.year + offset
-                        lunar = Lunar(ly, lunar_month, lunar_day, False)
-                        solar = Converter.Lunar2Solar(lunar)
-                        event_date = date(solar.year, solar.month, solar.day)
-                        if event_date >= today:
+                        event_date = lunar_to_solar(lunar_day, lunar_month, ly)
+                        if event_date and event_date >= today:
                             return event_date
-                    lunar = Lunar(
-                        today.year + 1, lunar_month, lunar_day, False
+                    return lunar_to_solar(
+                        lunar_day, lunar_month, today.year + 1
                     )
-                    solar = Converter.Lunar2Solar(lunar)
-                    return date(solar.year, solar.month, solar.day)
                 else:
                     if not lunar_month:
                         return None
-                    lunar = Lunar(lunar_year, lunar_month, lunar_day, False)
-                    solar = Converter.Lunar2Solar(lunar)
-                    return date(solar.year, solar.month, solar.day)
+                    return lunar_to_solar(lunar_day, lunar_month, lunar_year)
         except Exception as ex:
             _LOGGER.error(
                 "Loi tinh ngay duong gan nhat cho su kien %s: %s",
@@ -225,18 +192,22 @@ class AmLichEventSensor(SensorEntity):
             )
         return STATE_UNKNOWN
 
+    async def async_added_to_hass(self):
+        self.async_on_remove(
+            async_dispatcher_connect(
+                self.hass, SIGNAL_EVENTS_CHANGED, self._handle_events_changed
+            )
+        )
+
+    @callback
+    def _handle_events_changed(self, action, event_id):
+        if event_id == self._id:
+            self.async_schedule_update_ha_state(True)
+
     async def async_update(self):
         try:
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT id, tendukien, loaisukien, ngayam, thangam, namam, "
-                "ngayduong, thangduong, namduong, mota, laplai FROM events "
-                "WHERE id=?",
-                (self._id,)
-            )
-            row = cursor.fetchone()
-            conn.close()
+            # Đọc từ bản sao trong bộ nhớ của kho sự kiện, không mở DB
+            row = self._repository.get(self._id)
             if row:
                 self._tendukien = row[1]
                 self._loaisukien = row[2]
@@ -251,7 +222,7 @@ class AmLichEventSensor(SensorEntity):
                 self._attr_name = self._tendukien
                 self._attr_extra_state_attributes = self._build_attrs()
         except Exception as ex:
-            _LOGGER.error(f"Lỗi reload DB cho sensor {self._id}: {ex}")
+            _LOGGER.error(f"Lỗi cập nhật sensor sự kiện {self._id}: {ex}")
 
     @property
     def device_info(self):
@@ -284,6 +255,9 @@ class AmlichSensor(SensorEntity):
             "manufacturer": "amlich",
             "model": "Sự kiện Âm/Dương lịch"
         }
+        # Task truy vấn gần nhất và số thứ tự của nó; chỉ kết quả mới nhất được ghi
+        self._query_task = None
+        self._query_seq = 0
         _LOGGER.debug("Đã khởi tạo instance AmlichSensor")
 
     async def async_added_to_hass(self):
@@ -295,43 +269,26 @@ class AmlichSensor(SensorEntity):
                 new_state = event.data.get("new_state")
                 if new_state is None or new_state.state == STATE_UNKNOWN:
                     return
+                # Bật/tắt switch hài hước thì tra lại câu hỏi đang có trong input_text
+                if event.data.get("entity_id") != INPUT_TEXT_ENTITY:
+                    new_state = self._hass.states.get(INPUT_TEXT_ENTITY)
+                    if new_state is None or new_state.state == STATE_UNKNOWN:
+                        return
                 query = new_state.state.strip()
                 if query:
                     _LOGGER.debug(f"Xử lý truy vấn: {query}")
+                    self._schedule_query(query, self._debounce_seconds())
 
-                    async def handle_query():
-                        # Đọc trạng thái switch use_humor (chỉ dùng switch)
-                        use_humor = False
-                        humor_entity = self._hass.states.get("switch.use_humor")
-                        if humor_entity:
-                            use_humor = humor_entity.state == "on"
-                        result = await query_date(
-                            self._hass, query, use_humor=use_humor
-                        )
-                        self._attributes = {
-                            "output": result.get("output", "Không có dữ liệu"),
-                            "date": result.get("date"),
-                            "range": result.get("range"),
-                            "is_lunar": result.get("is_lunar", False),
-                            # Đảm bảo chứa năm (DD/MM/YYYY)
-                            "lunar_date": result.get("lunar_date"),
-                            "events": result.get("events", []),
-                            "use_humor": use_humor
-                        }
-                        self._state = result.get(
-                            "output", "Không có dữ liệu"
-                        )[:255]
-                        self.async_write_ha_state()
-                    self._hass.async_create_task(handle_query())
-
-            async_track_state_change_event(
-                self._hass,
-                [
-                    INPUT_TEXT_ENTITY,
-                    "switch.amlich_use_humor_switch",
-                    "switch.use_humor"
-                ],
-                input_text_changed
+            self.async_on_remove(
+                async_track_state_change_event(
+                    self._hass,
+                    [
+                        INPUT_TEXT_ENTITY,
+                        "switch.amlich_use_humor_switch",
+                        "switch.use_humor"
+                    ],
+                    input_text_changed
+                )
             )
             _LOGGER.debug(
                 f"Đã đăng ký lắng nghe {INPUT_TEXT_ENTITY}, "
@@ -339,34 +296,63 @@ class AmlichSensor(SensorEntity):
             )
 
             input_state = self._hass.states.get(INPUT_TEXT_ENTITY)
-            humor_entity = self._hass.states.get("switch.use_humor")
-            use_humor = humor_entity and humor_entity.state == "on"
             if (
                 input_state
                 and input_state.state
                 and input_state.state != STATE_UNKNOWN
             ):
-                result = await query_date(
-                    self._hass, input_state.state.strip(), use_humor=use_humor
-                )
-                self._attributes = {
-                    "output": result.get("output", "Không có dữ liệu"),
-                    "date": result.get("date"),
-                    "range": result.get("range"),
-                    "is_lunar": result.get("is_lunar", False),
-                    # Đảm bảo chứa năm (DD/MM/YYYY)
-                    "lunar_date": result.get("lunar_date"),
-                    "events": result.get("events", []),
-                    "use_humor": use_humor
-                }
-                self._state = result.get("output", "Không có dữ liệu")[:255]
-                self.async_write_ha_state()
+                self._schedule_query(input_state.state.strip(), 0)
                 _LOGGER.debug(
-                    "Đã cập nhật state ban đầu cho sensor.tra_cuu_su_kien"
+                    "Đã lên lịch truy vấn ban đầu cho sensor.tra_cuu_su_kien"
                 )
         except Exception as e:
             _LOGGER.error(f"Lỗi trong async_added_to_hass: {str(e)}")
 
+    async def async_will_remove_from_hass(self):
+        if self._query_task is not None:
+            self._query_task.cancel()
+
+    def _debounce_seconds(self):
+        return self._hass.data.get(DOMAIN, {}).get(
+            "query_debounce", QUERY_DEBOUNCE_SECONDS
+        )
+
+    def _schedule_query(self, query, delay):
+        """Hủy truy vấn cũ (kể cả yêu cầu Gemini đang chờ) và lên lịch truy vấn mới."""
+        if self._query_task is not None and not self._query_task.done():
+            _LOGGER.debug("Hủy truy vấn cũ vì đã có input mới")
+            self._query_task.cancel()
+        self._query_seq += 1
+        self._query_task = self._hass.async_create_task(
+            self._run_query(query, self._query_seq, delay)
+        )
+
+    async def _run_query(self, query, seq, delay):
+        if delay:
+            # Gom các thay đổi liên tiếp khi đang gõ: chỉ tra câu cuối cùng
+            await asyncio.sleep(delay)
+        # Đọc trạng thái switch use_humor (chỉ dùng switch)
+        use_humor = False
+        humor_entity = self._hass.states.get("switch.use_humor")
+        if humor_entity:
+            use_humor = humor_entity.state == "on"
+        result = await query_date(self._hass, query, use_humor=use_humor)
+        if seq != self._query_seq:
+            _LOGGER.debug(f"Bỏ kết quả cũ của truy vấn: {query}")
+            return
+        self._attributes = {
+            "output": result.get("output", "Không có dữ liệu"),
+            "date": result.get("date"),
+            "range": result.get("range"),
+            "is_lunar": result.get("is_lunar", False),
+            # Đảm bảo chứa năm (DD/MM/YYYY)
+            "lunar_date": result.get("lunar_date"),
+            "events": result.get("events", []),
+            "use_humor": use_humor
+        }
+        self._state = result.get("output", "Không có dữ liệu")[:255]
+        self.async_write_ha_state()
+
     @property
     def state(self):
         return self._state
@@ -376,6 +362,34 @@ class AmlichSensor(SensorEntity):
         return self._attributes
 
 
+class GeminiStatusSensor(SensorEntity):
+    """Sensor chẩn đoán: trạng thái cầu dao Gemini và bộ đệm phản hồi."""
+
+    def __init__(self):
+        self._attr_name = "Trạng Thái Gemini"
+        self._attr_unique_id = f"{DOMAIN}_gemini_status"
+        self._attr_icon = "mdi:robot-outline"
+        self._attr_entity_category = EntityCategory.DIAGNOSTIC
+        self._attr_device_info = {
+            "identifiers": {(DOMAIN, "amlich_events")},
+            "name": "Âm lịch VN",
+            "manufacturer": "amlich",
+            "model": "Sự kiện Âm/Dương lịch"
+        }
+        self._status = gemini_status()
+
+    async def async_update(self):
+        self._status = gemini_status()
+
+    @property
+    def state(self):
+        return self._status["state"]
+
+    @property
+    def extra_state_attributes(self):
+        return {key: value for key, value in self._status.items() if key != "state"}
+
+
 async def async_setup_platform(
     hass: HomeAssistant,
     config,
@@ -389,19 +403,11 @@ async def async_setup_platform(
         async_add_entities([sensor])
         _LOGGER.info("Đã thêm sensor.tra_cuu_su_kien vào Home Assistant")
         # Tích hợp các sensor sự kiện từ DB
-        ensure_events_db_exists()
         sensors = []
         try:
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT id, tendukien, loaisukien, ngayam, thangam, namam, "
-                "ngayduong, thangduong, namduong, mota, laplai FROM events"
-            )
-            rows = cursor.fetchall()
-            conn.close()
-            for row in rows:
-                sensors.append(AmLichEventSensor(row))
+            repository = await async_get_repository(hass)
+            for row in repository.rows:
+                sensors.append(AmLichEventSensor(row, repository))
         except Exception as ex:
             _LOGGER.error(f"Khong the doc events.db: {ex}")
         if sensors:
@@ -413,20 +419,14 @@ async def async_setup_platform(
 
 async def async_setup_entry(hass, config_entry, async_add_entities):
     _LOGGER.debug("[DEBUG] Bắt đầu async_setup_entry cho amlich")
-    ensure_events_table()  # Đảm bảo luôn có bảng events trước khi truy vấn
-    sensors = [AmlichSensor(hass)]
+    sensors = [AmlichSensor(hass), GeminiStatusSensor()]
     _LOGGER.debug("[DEBUG] Chuẩn bị gọi async_add_entities cho sensor tra cứu")
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT id, tendukien, loaisukien, ngayam, thangam, namam, "
-            "ngayduong, thangduong, namduong, mota, laplai FROM events"
-        )
-        rows = cursor.fetchall()
-        conn.close()
+        # Kho sự kiện tự tạo bảng events nếu chưa có
+        repository = await async_get_repository(hass)
+        rows = repository.rows
         for row in rows:
-            sensors.append(AmLichEventSensor(row))
+            sensors.append(AmLichEventSensor(row, repository))
         _LOGGER.debug(f"[DEBUG] Đã thêm {len(rows)} AmLichEventSensor vào danh sách entity")
     except Exception as ex:
         _LOGGER.error(f"[DEBUG] Khong the doc events.db: {ex}")
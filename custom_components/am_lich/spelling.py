@@ -0,0 +1,96 @@
+"""
+Sửa chính tả cục bộ cho câu hỏi tra cứu: bỏ dấu, gộp chữ lặp rồi so khớp
+gần đúng từng từ với bộ từ vựng mà bộ phân tích đã biết. Dùng trước khi
+phải gọi Gemini, chủ yếu cho câu gõ không dấu ("am lich hom nay") hoặc gõ
+lặp chữ ("tuaann nay").
+"""
+import itertools
+import re
+import unicodedata
+from functools import lru_cache
+
+# Số câu ứng viên tối đa sinh ra cho một câu hỏi
+MAX_CANDIDATES = 32
+
+_REPEATS = re.compile(r'(.)\1+')
+
+
+def strip_diacritics(text):
+    """Bỏ dấu tiếng Việt: 'âm lịch' → 'am lich', 'đầu' → 'dau'."""
+    text = text.replace('đ', 'd').replace('Đ', 'D')
+    decomposed = unicodedata.normalize('NFD', text)
+    return ''.join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def collapse_repeats(text):
+    """Gộp các ký tự lặp liên tiếp: 'tuaann' → 'tuan'."""
+    return _REPEATS.sub(r'\1', text)
+
+
+def edit_distance(a, b, limit):
+    """Khoảng cách sửa (có tính đổi chỗ hai ký tự kề nhau), dừng sớm khi vượt limit."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    prev2 = None
+    prev = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        cur = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + cost)
+            if prev2 is not None and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                cur[j] = min(cur[j], prev2[j - 2] + 1)
+        if min(cur) > limit:
+            return limit + 1
+        prev2, prev = prev, cur
+    return prev[-1]
+
+
+class FuzzyCorrector:
+    """Sinh các cách sửa của một câu theo bộ từ vựng cho trước."""
+
+    def __init__(self, words):
+        # Giữ thứ tự xuất hiện: từ đứng trước được ưu tiên khi bỏ dấu bị trùng
+        self.words = list(dict.fromkeys(words))
+        self.known = set(self.words)
+        self.by_key = {}
+        for word in self.words:
+            self.by_key.setdefault(strip_diacritics(word), []).append(word)
+        # Người dùng lặp lại vài cách gõ sai quen thuộc nên nhớ kết quả theo từ
+        self.word_candidates = lru_cache(maxsize=1024)(self._word_candidates)
+
+    def _word_candidates(self, token):
+        """Các từ trong từ vựng có thể là token, theo thứ tự ưu tiên."""
+        if not token.isalpha():
+            return [token]
+        key = collapse_repeats(strip_diacritics(token))
+        if key in self.by_key:
+            words = self.by_key[key]
+            # Từ gõ đúng đứng đầu, các từ cùng dạng không dấu ('nay'/'này') theo sau
+            if token in self.known:
+                return [token] + [word for word in words if word != token]
+            return words
+        if len(key) < 3:
+            return [token]
+        limit = 1 if len(key) <= 4 else 2
+        best = limit + 1
+        matches = []
+        for candidate_key, words in self.by_key.items():
+            distance = edit_distance(key, candidate_key, limit)
+            if distance < best:
+                best = distance
+                matches = list(words)
+            elif distance == best:
+                matches.extend(words)
+        return matches if best <= limit else [token]
+
+    def candidates(self, text, limit=MAX_CANDIDATES):
+        """Các câu đã sửa khác với text, câu có khả năng cao nhất đứng trước."""
+        tokens = text.lower().split()
+        choices = [self.word_candidates(token) for token in tokens]
+        seen = {' '.join(tokens)}
+        for combination in itertools.islice(itertools.product(*choices), limit):
+            candidate = ' '.join(combination)
+            if candidate not in seen:
+                seen.add(candidate)
+                yield candidate
@@ -0,0 +1,44 @@
+"""
+Cho phép chạy bộ kiểm tra khi chưa cài Home Assistant.
+
+amlich_core chỉ dùng hai tên của Home Assistant ở cấp module: HomeAssistant
+để chú thích kiểu và async_get_clientsession khi gọi Gemini. Nếu thiếu gói
+homeassistant, hai tên này được thay bằng module tối thiểu, và gói
+custom_components.am_lich được đăng ký mà không chạy __init__.py (cần
+voluptuous và Home Assistant).
+"""
+import importlib.util
+import os
+import sys
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE_DIR = os.path.join(ROOT, 'custom_components', 'am_lich')
+
+sys.path.insert(0, ROOT)
+
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+
+def _install_homeassistant_stub():
+    class HomeAssistant:
+        """Chỉ dùng để chú thích kiểu trong amlich_core."""
+
+    def async_get_clientsession(hass):
+        raise RuntimeError("Không có Home Assistant trong môi trường kiểm tra")
+
+    _module('homeassistant', __path__=[])
+    _module('homeassistant.core', HomeAssistant=HomeAssistant)
+    _module('homeassistant.helpers', __path__=[])
+    _module('homeassistant.helpers.aiohttp_client', async_get_clientsession=async_get_clientsession)
+    _module('custom_components', __path__=[os.path.dirname(PACKAGE_DIR)])
+    _module('custom_components.am_lich', __path__=[PACKAGE_DIR])
+
+
+if importlib.util.find_spec('homeassistant') is None:
+    _install_homeassistant_stub()
@@ -0,0 +1,98 @@
+"""
+Kiểm tra hồi quy parse_input trên bộ câu hỏi mẫu (tests/fixtures/query_corpus.json)
+với ngày hôm nay cố định, chỉ dùng ngữ pháp cục bộ và không có Gemini API key.
+
+Kết quả trong "cases" được tạo bằng bộ phân tích của bản gốc (trước khi viết
+lại ngữ pháp), nên bài kiểm tra so mã hiện tại với hành vi cũ chứ không với
+chính nó. Mọi khác biệt có chủ đích phải được ghi tay vào "intended_changes"
+dưới dạng [câu hỏi, kết quả mới, lý do]. Câu làm bản gốc lỗi được ghi trong
+"cases" là {"exception": tên lỗi}.
+"""
+import asyncio
+import json
+import os
+from datetime import date, datetime
+
+import pytest
+
+from custom_components.am_lich import amlich_core, amlich_engine
+from custom_components.am_lich.lunar_tables import EventIndex, LunarData, LunarDayTable
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'query_corpus.json')
+
+# Các năm dương lịch có trong bảng ngày dùng cho bộ mẫu
+TABLE_YEARS = range(2020, 2033)
+
+
+def _load_corpus():
+    with open(CORPUS_PATH, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _fixed_datetime(today):
+    class FixedDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return cls(today.year, today.month, today.day, 9, 0)
+
+    return FixedDatetime
+
+
+def _lunar_data():
+    """Bảng ngày dựng từ amlich_engine, thay cho file ICS."""
+    entries = {}
+    first = date(TABLE_YEARS[0], 1, 1).toordinal()
+    last = date(TABLE_YEARS[-1], 12, 31).toordinal()
+    for ordinal in range(first, last + 1):
+        day, month, _year, leap = amlich_engine.solar_to_lunar(date.fromordinal(ordinal))
+        entries[ordinal] = (day, month, leap)
+    return LunarData(1, LunarDayTable.build(entries), EventIndex.build({}, None))
+
+
+async def _parse_all(queries, data):
+    return [
+        await amlich_core.parse_input(None, query, is_fixed=True, data=data)
+        for query in queries
+    ]
+
+
+@pytest.fixture(scope='module')
+def corpus():
+    return _load_corpus()
+
+
+@pytest.fixture(scope='module')
+def results(corpus):
+    today = date.fromisoformat(corpus['today'])
+    original = amlich_core.datetime, amlich_core.GEMINI_API_KEY
+    amlich_core.datetime = _fixed_datetime(today)
+    amlich_core.GEMINI_API_KEY = None
+    try:
+        queries = [query for query, _expected in corpus['cases']]
+        return dict(zip(queries, asyncio.run(_parse_all(queries, _lunar_data()))))
+    finally:
+        amlich_core.datetime, amlich_core.GEMINI_API_KEY = original
+
+
+def test_corpus_is_not_empty(corpus):
+    assert len(corpus['cases']) > 1000
+
+
+def test_intended_changes_differ_from_baseline(corpus):
+    baseline = dict(corpus['cases'])
+    stale = [
+        query for query, expected, _reason in corpus['intended_changes']
+        if query not in baseline or baseline[query] == expected
+    ]
+    assert not stale, f"intended_changes có câu không có trong cases hoặc trùng kết quả gốc: {stale[:5]}"
+
+
+def test_parse_input_matches_baseline(corpus, results):
+    expected = dict(corpus['cases'])
+    expected.update((query, result) for query, result, _reason in corpus['intended_changes'])
+    mismatches = [
+        (query, expected[query], results[query])
+        for query, _baseline in corpus['cases']
+        if results[query] != expected[query]
+    ]
+    assert not mismatches, f"{len(mismatches)} câu khác kết quả mong đợi, ví dụ: {mismatches[:5]}"